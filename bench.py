@@ -0,0 +1,292 @@
+# Benchmarks for the pugsbot code that runs on every click
+# Times the queue, waiting room and ready up embeds, re-queue sorting, matchup generation, filling the queue and
+# saving and loading the PUG, against fake members with waiting rooms from 10 to 10,000 players.
+# Results are saved as JSON, and a previous result file can be compared against to find regressions.
+# Usage: python bench.py --compare bench_results/abc1234.json
+import io
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+import logging
+from datetime import datetime, timedelta, timezone
+
+import pugsbot
+from pugsbot import Phase, OrderedUserSet
+from loadgen import RestRecorder, FakeMember, FakeMessage, FakeChannel
+
+default_sizes = [10, 100, 1000, 10000]  # waiting room sizes
+default_histories = [100, 1000, 10000]  # numbers of recently ended matches for re-queue sorting
+default_shown = [0, 60, 120]  # matchups already shown before a re-roll, out of the 126 possible 5v5 matchups
+
+class BenchPug():  # a PUG session with fake members, set up in whatever phase a benchmark needs
+    def __init__(self, size):
+        self.rest = RestRecorder(0)
+        self.channel = FakeChannel(self.rest, 1)
+        self.channel.get_partial_message = lambda message_id: saved_message(self.channel, message_id)
+        self.players = [FakeMember(self.rest, user_id) for user_id in range(1000, 1000 + size + pugsbot.queue_size_required * 4)]
+        self.channel.guild.members = {player.id: player for player in self.players}
+        pugsbot.bot.get_channel = lambda channel_id: self.channel
+        self.session = pugsbot.PugSession(self.channel.id)
+        self.match_players = self.players[:pugsbot.queue_size_required]
+        self.waiting = self.players[pugsbot.queue_size_required * 4:]
+
+    # sets up a match being played and the waiting room for the next queue, with players re-queueing from the match
+    def set_up_play(self):
+        session = self.session
+        session.phase = Phase.PLAY
+        match = pugsbot.PugMatch(session, 1, self.match_players)
+        match.phase = Phase.PLAY
+        session.matches[1] = session.active_matches[1] = session.current_match = match
+        session.waiting_room = OrderedUserSet(self.waiting)
+        return match
+
+    # sets up a queue that is full, with a match being set up and another being played
+    def set_up_queue(self):
+        session = self.session
+        self.set_up_play()
+        session.phase = Phase.MAP
+        setup_match = pugsbot.PugMatch(session, 2, self.players[pugsbot.queue_size_required:pugsbot.queue_size_required * 2])
+        session.matches[2] = session.current_match = setup_match
+        session.match_number = 2
+
+    # sets up a ready check with half of the players ready and the waiting room on standby
+    def set_up_ready(self):
+        session = self.session
+        session.phase = Phase.READY
+        session.queue = OrderedUserSet(self.match_players)
+        session.queue_sorted = list(session.queue)
+        session.ready_players = set(self.match_players[:pugsbot.queue_size_required // 2])
+        session.standby = OrderedUserSet(self.waiting)
+        session.ready_end = datetime.now(timezone.utc) + timedelta(seconds=pugsbot.ready_up_time)
+
+    # records ended matches of random players from the waiting room and the match, for the re-queue order
+    def record_history(self, num_matches):
+        match = self.session.current_match
+        now = datetime.now(timezone.utc)
+        pool = self.match_players + self.waiting
+        for match_number in range(100000, 100000 + num_matches):
+            ended = pugsbot.PugMatch(self.session, match_number, random.sample(pool, pugsbot.queue_size_required))
+            ended.start_time = now - timedelta(minutes=40)
+            ended.end_time = now - timedelta(seconds=random.randrange(int(pugsbot.recent_time.total_seconds())))
+            ended.wound_score = random.choice([-3, -2, -1, 1, 2, 3])
+            self.session.player_activity.record_match(ended)
+        match.setup_start_time = now
+
+# gets a fake message with the given id, for the messages of a saved PUG
+def saved_message(channel, message_id):
+    message = FakeMessage(channel, None)
+    message.id = message_id
+    return message
+
+# times a function, returns the seconds per call of each repeat, each timing as many calls as fit in min_time
+def time_calls(func, repeat, min_time):
+    times = []
+    number = 1
+    while True:  # find how many calls fit in min_time
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number = max(number * 2, int(number * min_time / max(elapsed, 1e-9)))
+    times.append(elapsed / number)
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter() - start) / number)
+    return times
+
+# gets the benchmarks to run, as a list of (name, parameter, setup) where setup returns the function to time
+def benchmarks(args):
+    cases = []
+    def case(name, params):
+        def add(setup):
+            cases.extend([(name, param, setup) for param in params])
+            return setup
+        return add
+
+    @case('queue_embed', args.sizes)
+    def queue_embed(size):
+        pug = BenchPug(size)
+        pug.set_up_queue()
+        return pug.session.queue_embed
+
+    @case('waiting_room_embed', args.sizes)
+    def waiting_room_embed(size):
+        pug = BenchPug(size)
+        pug.set_up_play()
+        return pug.session.waiting_room_embed
+
+    @case('ready_up_embed', args.sizes)
+    def ready_up_embed(size):
+        pug = BenchPug(size)
+        pug.set_up_ready()
+        return pug.session.ready_up_embed
+
+    @case('re_queue_sort_key', args.histories)
+    def re_queue_sort_key(num_matches):
+        pug = BenchPug(1000)
+        pug.set_up_play()
+        pug.record_history(num_matches)
+        users = pug.players
+        def sort_keys():  # the sort keys of every player in the waiting room
+            for user in users:
+                pug.session.re_queue_sort_key(user)
+        return sort_keys
+
+    @case('update_re_queue', args.histories)
+    def update_re_queue(num_matches):
+        pug = BenchPug(1000)
+        match = pug.set_up_play()
+        pug.record_history(num_matches)
+        return match.update_re_queue
+
+    @case('proceed_to_matchups_phase', args.shown)
+    def proceed_to_matchups_phase(num_shown):
+        pug = BenchPug(10)
+        match = pug.set_up_play()
+        match.phase = pug.session.phase = Phase.MAP
+        shown = set(pugsbot.random_team_splits(len(match.players), num_shown, set()))
+        async def reroll():
+            match.shown_splits = set(shown)
+            await match.proceed_to_matchups_phase(pug.channel)
+            await pugsbot.edit_scheduler.flush_all()
+        return lambda: args.loop.run_until_complete(reroll())
+
+    @case('add_waiting_room_players_to_queue', args.sizes)
+    def add_waiting_room_players_to_queue(size):
+        pug = BenchPug(size)
+        pug.set_up_play()
+        session = pug.session
+        def fill_queue():  # moves the front of the waiting room into the queue, then back to the end of the waiting room
+            session.queue = OrderedUserSet()
+            session.add_waiting_room_players_to_queue()
+            session.waiting_room.extend(session.queue)
+        return fill_queue
+
+    @case('save_pug', args.sizes)
+    def save_pug(size):
+        pug = BenchPug(size)
+        pug.set_up_queue()
+        pug.session.queue_message = saved_message(pug.channel, 1)
+        return lambda: pug.session.save_pug(io.StringIO())
+
+    @case('saved_state', args.sizes)
+    def saved_state(size):  # the part of a save that runs on the event loop, the journal thread serializes and writes it
+        pug = BenchPug(size)
+        pug.set_up_queue()
+        pug.session.queue_message = saved_message(pug.channel, 1)
+        return pug.session.saved_state
+
+    @case('load_pug', args.sizes)
+    def load_pug(size):
+        pug = BenchPug(size)
+        pug.set_up_queue()
+        pug.session.queue_message = saved_message(pug.channel, 1)
+        save_file = io.StringIO()
+        pug.session.save_pug(save_file)
+        saved = save_file.getvalue()
+        return lambda: pugsbot.PugSession(pug.channel.id).load_pug(pug.channel.guild, io.StringIO(saved), full=True)
+
+    return cases
+
+# gets the commit being benchmarked, or 'local' if it is not a git checkout
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'local'
+
+# runs the benchmarks, returns the results as a dict that can be saved as JSON
+def run_benchmarks(args):
+    random.seed(args.seed)
+    results = {}
+    for name, param, setup in benchmarks(args):
+        key = f'{name}[{param}]'
+        if args.filter and args.filter not in key:
+            continue
+        pugsbot.display_name_cache.clear()
+        pugsbot.sort_key_cache.clear()
+        times = sorted(time_calls(setup(param), args.repeat, args.min_time))
+        results[key] = {'median': times[len(times) // 2], 'min': times[0], 'max': times[-1]}
+        print(f'{key:<40}{times[len(times) // 2] * 1e6:>14.1f}{times[0] * 1e6:>14.1f}', flush=True)
+        for key in list(pugsbot.timers.timers):  # matchup votes arm vote timers
+            pugsbot.timers.cancel(key)
+    return {'commit': args.label, 'time': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(), 'platform': platform.platform(), 'results': results}
+
+# prints how each result changed from a previous run, returns the number of regressions
+def compare_results(old, new, threshold):
+    print(f'\nCompared with {old["commit"]} ({old["time"]}), median time per call:')
+    print(f'{"benchmark":<40}{"old us":>12}{"new us":>12}{"change":>10}')
+    num_regressions = 0
+    for key, result in new['results'].items():
+        if key not in old['results']:
+            continue
+        old_median = old['results'][key]['median']
+        ratio = result['median'] / old_median
+        flag = ''
+        if ratio > threshold:
+            flag = '  REGRESSION'
+            num_regressions += 1
+        elif ratio < 1 / threshold:
+            flag = '  faster'
+        print(f'{key:<40}{old_median * 1e6:>12.1f}{result["median"] * 1e6:>12.1f}{ratio:>9.2f}x{flag}')
+    return num_regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the pugsbot code that runs on every click against fake members')
+    parser.add_argument('--sizes', type=int, nargs='+', default=default_sizes, help='waiting room sizes')
+    parser.add_argument('--histories', type=int, nargs='+', default=default_histories, help='recently ended matches for re-queue sorting')
+    parser.add_argument('--shown', type=int, nargs='+', default=default_shown, help='matchups already shown before a re-roll')
+    parser.add_argument('--repeat', type=int, default=5, help='timings of each benchmark, the median is reported')
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds that each timing runs for at least')
+    parser.add_argument('--filter', default='', help='only run benchmarks whose name contains this')
+    parser.add_argument('--label', default=current_commit(), help='name of the version being benchmarked, the git commit by default')
+    parser.add_argument('--output', help='file to save the results to, bench_results/<label>.json by default')
+    parser.add_argument('--compare', help='results file of a previous run to compare against')
+    parser.add_argument('--threshold', type=float, default=1.25, help='report a regression when a benchmark is this many times slower')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    output_path = os.path.abspath(args.output or os.path.join('bench_results', f'{args.label}.json'))
+    compare_path = os.path.abspath(args.compare) if args.compare else None
+
+    # run in a temporary folder so the saved PUGs of a real bot are not touched
+    pugsbot.logger.addHandler(logging.NullHandler())
+    pugsbot.edit_scheduler.window = 0
+    with tempfile.TemporaryDirectory() as temp_dir:
+        cwd = os.getcwd()
+        os.chdir(temp_dir)
+        args.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(args.loop)
+        try:
+            print(f'{"benchmark":<40}{"median us":>14}{"min us":>14}')
+            results = run_benchmarks(args)
+        finally:
+            tasks = asyncio.all_tasks(args.loop)  # the timer service
+            for task in tasks:
+                task.cancel()
+            args.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            args.loop.close()
+            os.chdir(cwd)
+
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with open(output_path, 'w') as output_file:
+        json.dump(results, output_file, indent=1)
+    print(f'\nSaved results to {output_path}')
+    if compare_path:
+        with open(compare_path) as compare_file:
+            num_regressions = compare_results(json.load(compare_file), results, args.threshold)
+        if num_regressions:
+            print(f'{num_regressions} benchmarks are more than {args.threshold:g}x slower')
+            sys.exit(1)
@@ -0,0 +1,352 @@
+# Headless load generator for pugsbot
+# Plays full match cycles through the real button and command handlers using fake discord objects,
+# then reports throughput, handler latency and the discord REST calls made for each match.
+# Usage: python loadgen.py --players 2000 --channels 4 --matches 25
+import os
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import itertools
+import logging
+from collections import Counter, defaultdict
+
+import discord
+
+import pugsbot
+from pugsbot import Phase
+
+message_ids = itertools.count(1)
+
+class RestRecorder():  # counts the discord REST calls made by the bot, optionally waiting to simulate latency
+    def __init__(self, latency):
+        self.latency = latency  # seconds to wait for each call
+        self.counts = Counter()  # number of calls of each kind
+
+    async def call(self, kind):
+        self.counts[kind] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+class FakeMember():  # stand-in for discord.Member
+    def __init__(self, rest, user_id):
+        self.rest = rest
+        self.id = user_id
+        self.name = f'player{user_id}'
+        self.nick = None
+        self.display_name = self.name
+        self.mention = f'<@{user_id}>'
+
+    def __str__(self):
+        return self.name
+
+    async def send(self, content=None, **kwargs):
+        await self.rest.call('dm')
+
+class FakeMessage():  # stand-in for discord.Message
+    def __init__(self, channel, view):
+        self.id = next(message_ids)
+        self.channel = channel
+        self.view = view
+
+    async def edit(self, **kwargs):
+        await self.channel.rest.call('edit_message')
+        if 'view' in kwargs:
+            self.view = kwargs['view']
+        return self
+
+    async def delete(self):
+        await self.channel.rest.call('delete_message')
+
+class FakeGuild():  # stand-in for discord.Guild
+    def __init__(self):
+        self.members = {}  # dict of members (user id, FakeMember)
+
+    def get_member(self, user_id):
+        return self.members.get(user_id)
+
+class FakeChannel():  # stand-in for discord.TextChannel
+    def __init__(self, rest, channel_id):
+        self.rest = rest
+        self.id = channel_id
+        self.guild = FakeGuild()
+
+    def __str__(self):
+        return f'channel{self.id}'
+
+    async def send(self, content=None, view=None, **kwargs):
+        await self.rest.call('send_message')
+        return FakeMessage(self, view)
+
+class FakeResponse():  # stand-in for discord.InteractionResponse
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self.done = False
+
+    async def send_message(self, content=None, **kwargs):
+        await self.interaction.message.channel.rest.call('interaction_response')
+        self.done = True
+
+    async def edit_message(self, **kwargs):
+        await self.interaction.message.channel.rest.call('interaction_response')
+        if 'view' in kwargs:
+            self.interaction.message.view = kwargs['view']
+        self.done = True
+
+    async def defer(self, **kwargs):
+        await self.interaction.message.channel.rest.call('defer')
+        self.done = True
+
+    def is_done(self):
+        return self.done
+
+class FakeFollowup():  # stand-in for the discord.Webhook used for interaction followups
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send(self, content=None, **kwargs):
+        await self.interaction.message.channel.rest.call('followup')
+
+class FakeInteraction(discord.Interaction):  # stand-in for discord.Interaction from a button click, so the bot defers it like a real click
+    # these are properties of discord.Interaction that read its gateway payload, so the fake shadows them with its own values
+    guild = None
+    response = None
+    followup = None
+
+    def __init__(self, user, message):  # discord.Interaction.__init__ parses a gateway payload, so it is not called
+        self.user = user
+        self.message = message
+        self.channel = message.channel
+        self.guild = message.channel.guild
+        self.extras = {}
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+
+    async def edit_original_response(self, **kwargs):
+        await self.message.channel.rest.call('edit_original_response')
+        if 'view' in kwargs:
+            self.message.view = kwargs['view']
+        return self.message
+
+class FakeContext():  # stand-in for commands.Context
+    def __init__(self, channel, author):
+        self.channel = channel
+        self.message = FakeMessage(channel, None)
+        self.message.author = author
+        self.message.guild = channel.guild
+        self.message.attachments = []
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+class ChannelDriver():  # plays match cycles in one queue channel with its own pool of players
+    def __init__(self, args, channel_id, first_user_id):
+        self.args = args
+        self.rest = RestRecorder(args.rest_latency / 1000)
+        self.channel = FakeChannel(self.rest, channel_id)
+        self.players = [FakeMember(self.rest, user_id) for user_id in range(first_user_id, first_user_id + args.players)]
+        self.channel.guild.members = {player.id: player for player in self.players}
+        self.session = pugsbot.get_session(channel_id)
+        self.latencies = defaultdict(list)  # dict of handler latencies in seconds (handler name, list)
+        self.match_rest_counts = []  # REST call counts for each match
+        self.match_times = []  # seconds taken by each match
+        self.num_interactions = 0
+
+    # clicks a button on a message and records how long the handler took
+    async def click(self, message, label, user, handler_name):
+        for item in message.view.children:
+            if getattr(item, 'label', None) == label:
+                start = time.perf_counter()
+                await item.callback(FakeInteraction(user, message))
+                self.latencies[handler_name].append(time.perf_counter() - start)
+                self.num_interactions += 1
+                return
+        raise KeyError(f'No {label} button on message')
+
+    # checks if a player is already in the queue, waiting room, or a match being set up or played
+    def is_busy(self, player):
+        matches = list(self.session.active_matches.values())
+        if self.session.current_match is not None:
+            matches.append(self.session.current_match)
+        return (player in self.session.queue or player in self.session.waiting_room or
+                any([player in match.re_queue or player in match.players for match in matches]))
+
+    # gets a random player that is not in the queue
+    def random_idle_player(self):
+        while True:
+            player = random.choice(self.players)
+            if not self.is_busy(player):
+                return player
+
+    # gets the message with the join and leave buttons: the waiting room while the most matches are played, else the queue
+    def queue_board(self):
+        return self.session.waiting_room_message if self.session.phase == Phase.PLAY else self.session.queue_message
+
+    # plays all matches, up to max_active_matches at the same time like the bot allows
+    # the oldest match is completed once no more can start, so the queue starts again, and the rest are completed at the end
+    async def run(self, num_matches):
+        self.session.phase = Phase.QUEUE
+        self.session.queue_message = await self.channel.send(embed=self.session.queue_embed(), view=pugsbot.QueueView(self.session))
+        playing = []  # matches being played, oldest first
+        for i in range(num_matches):
+            rest_counts = self.rest.counts.copy()
+            start = time.perf_counter()
+            playing.append(await self.start_match())
+            while playing and (self.session.phase == Phase.PLAY or i == num_matches - 1):
+                await self.complete_match(playing.pop(0))
+            await pugsbot.edit_scheduler.flush_all()  # count the edits of this match with this match
+            self.match_times.append(time.perf_counter() - start)
+            self.match_rest_counts.append(self.rest.counts - rest_counts)
+
+    # sets up one match from filling the queue to voting for its matchup, and returns it once it is being played
+    async def start_match(self):
+        session = self.session
+        # fill the queue, some players leave again and the rest wait for the next match
+        while session.phase == Phase.QUEUE:
+            player = self.random_idle_player()
+            await self.click(session.queue_message, 'Join Queue', player, 'join_queue')
+            if random.random() < self.args.leave_chance and session.phase == Phase.QUEUE and player in session.queue:
+                await self.click(session.queue_message, 'Leave Queue', player, 'leave_queue')
+        for i in range(self.args.waiting):
+            if session.total_queue_size() < self.args.max_queue:
+                await self.click(session.queue_message, 'Join Queue', self.random_idle_player(), 'join_queue')
+
+        # ready up, with some players bailing out and being filled by waiting room players on standby
+        ready_message = session.ready_message
+        queue_players = list(session.queue)
+        waiting_players = list(session.waiting_room)
+        bailing_players = random.sample(queue_players, min(random.randint(0, self.args.max_bailouts), len(waiting_players)))
+        for player in waiting_players[:len(bailing_players)]:
+            await self.click(ready_message, 'Ready Up / Standby', player, 'standby')
+        for player in queue_players:
+            if session.phase != Phase.READY:
+                break
+            if player in bailing_players:
+                await self.click(ready_message, 'Bail Out', player, 'bail_out')
+                await self.click(ready_message, 'Bail Out', player, 'bail_out')
+            else:
+                await self.click(ready_message, 'Ready Up / Standby', player, 'ready_up')
+
+        # vote for one of the first two maps until one is picked
+        match = session.current_match
+        voters = list(match.players)
+        random.shuffle(voters)
+        for player in voters:
+            if match.phase != Phase.MAP:
+                break
+            game_map = random.choice(pugsbot.map_choices[:2])
+            await self.click(match.map_voting_message, str(game_map), player, 'map_vote')
+
+        # sometimes re-roll the matchups, then vote until a matchup wins
+        if random.random() < self.args.reroll_chance:
+            for player in voters[:pugsbot.votes_required]:
+                await self.click(match.voting_message, 'Re-roll 🎲', player, 'matchup_vote')
+        for player in voters:
+            if match.phase != Phase.MATCHUP:
+                break
+            await self.click(match.voting_message, f'Matchup {random.choice([1, 1, 2, 3])}', player, 'matchup_vote')
+        for player in itertools.cycle(voters):
+            if match.phase != Phase.MATCHUP:
+                break
+            await self.click(match.voting_message, 'Matchup 1', player, 'matchup_vote')
+
+        # while the match is played, some players join the next queue or the waiting room and some match players leave the re-queue
+        for i in range(self.args.waiting):
+            if session.total_queue_size() < self.args.max_queue:
+                await self.click(self.queue_board(), 'Join Queue', self.random_idle_player(), 'join_queue')
+        for player in voters:
+            if random.random() < self.args.leave_chance:
+                await self.click(self.queue_board(), 'Leave Queue', player, 'leave_queue')
+        return match
+
+    # marks a match as complete and reports its result
+    async def complete_match(self, match):
+        voters = list(match.players)
+        for player in voters[:pugsbot.reset_queue_votes_required]:
+            await self.click(match.final_matchup_message, 'Match Complete', player, 'reset_vote')
+        start = time.perf_counter()
+        await pugsbot.wounds_cmd(FakeContext(self.channel, voters[0]), str(random.choice([-3, -2, -1, 1, 2, 3])), match.match_number)
+        self.latencies['wounds_cmd'].append(time.perf_counter() - start)
+
+# gets a percentile of a sorted list
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+# prints the results of all channels
+def print_report(drivers, total_time):
+    num_matches = sum([len(driver.match_times) for driver in drivers])
+    num_interactions = sum([driver.num_interactions for driver in drivers])
+    print(f'Played {num_matches} matches in {len(drivers)} channels in {total_time:.2f} s '
+          f'({num_matches / total_time:.1f} matches/s, {num_interactions / total_time:.0f} interactions/s)')
+    match_times = sorted([t for driver in drivers for t in driver.match_times])
+    print(f'Match cycle time: p50 {percentile(match_times, 0.5) * 1000:.1f} ms, p95 {percentile(match_times, 0.95) * 1000:.1f} ms')
+
+    print(f'\n{"handler":<14}{"calls":>8}{"p50 ms":>10}{"p95 ms":>10}{"max ms":>10}')
+    latencies = defaultdict(list)
+    for driver in drivers:
+        for handler_name, values in driver.latencies.items():
+            latencies[handler_name].extend(values)
+    for handler_name, values in sorted(latencies.items()):
+        values.sort()
+        print(f'{handler_name:<14}{len(values):>8}{percentile(values, 0.5) * 1000:>10.2f}'
+              f'{percentile(values, 0.95) * 1000:>10.2f}{values[-1] * 1000:>10.2f}')
+
+    print(f'\n{"REST call":<22}{"per match":>10}{"total":>8}')
+    totals = Counter()
+    for driver in drivers:
+        for counts in driver.match_rest_counts:
+            totals.update(counts)
+    for kind, total in sorted(totals.items()):
+        print(f'{kind:<22}{total / num_matches:>10.1f}{total:>8}')
+    print(f'{"all":<22}{sum(totals.values()) / num_matches:>10.1f}{sum(totals.values()):>8}')
+
+async def main(args):
+    random.seed(args.seed)
+    pugsbot.edit_scheduler.window = args.edit_window
+    pugsbot.interaction_defer_time = args.defer_time
+    drivers = [ChannelDriver(args, channel_id, 1000000 * channel_id) for channel_id in range(1, args.channels + 1)]
+    channels = {driver.channel.id: driver.channel for driver in drivers}
+    pugsbot.bot.get_channel = channels.get
+    start = time.perf_counter()
+    await asyncio.gather(*[driver.run(args.matches) for driver in drivers])
+    total_time = time.perf_counter() - start
+    for session in pugsbot.sessions.values():
+        session.reset_game()  # stop the ready up and DM tasks
+    return drivers, total_time
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Plays PUG matches against fake discord objects and reports the load')
+    parser.add_argument('--players', type=int, default=1000, help='players in each channel')
+    parser.add_argument('--channels', type=int, default=1, help='queue channels played at the same time')
+    parser.add_argument('--matches', type=int, default=20, help='matches played in each channel')
+    parser.add_argument('--waiting', type=int, default=3, help='players joining the waiting room in each phase')
+    parser.add_argument('--max-queue', type=int, default=30, help='no more players join the waiting room once this many are queued')
+    parser.add_argument('--leave-chance', type=float, default=0.1, help='chance that a player leaves after joining')
+    parser.add_argument('--max-bailouts', type=int, default=2, help='most players that bail out of a ready up')
+    parser.add_argument('--reroll-chance', type=float, default=0.3, help='chance that the matchups are re-rolled')
+    parser.add_argument('--rest-latency', type=float, default=0.0, help='milliseconds that each REST call takes')
+    parser.add_argument('--defer-time', type=float, default=pugsbot.interaction_defer_time,
+                        help='seconds a click waits for its state change before it is deferred')
+    parser.add_argument('--edit-window', type=float, default=pugsbot.edit_coalesce_window, help='seconds to merge message edits')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--verbose', action='store_true', help='show the bot log')
+    args = parser.parse_args()
+
+    # run in a temporary folder so the saved PUGs and match history of a real bot are not touched
+    with tempfile.TemporaryDirectory() as temp_dir:
+        cwd = os.getcwd()
+        os.chdir(temp_dir)
+        try:
+            if args.verbose:
+                pugsbot.start_logging('')
+            else:
+                pugsbot.logger.addHandler(logging.NullHandler())
+            drivers, total_time = asyncio.run(main(args))
+            for session in pugsbot.sessions.values():
+                session.pug_journal.close()
+            pugsbot.match_history.close()
+        finally:
+            pugsbot.stop_logging()
+            os.chdir(cwd)
+    print_report(drivers, total_time)
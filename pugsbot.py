@@ -1,19 +1,44 @@
 import os
+import io
+import json
+import sys
 import random
 import asyncio
+import bisect
+import functools
+import glob
+import hashlib
+import hmac
+import heapq
+import logging
+import logging.handlers
+import sqlite3
+import threading
+import time
+from queue import SimpleQueue
+from concurrent.futures import ThreadPoolExecutor
 from collections import defaultdict
+from contextlib import contextmanager
+from itertools import islice
 from datetime import datetime, timedelta, timezone
 from enum import IntEnum
+from typing import Optional
 import math
 
+import aiohttp
 import discord
 from discord.ext import commands
 from discord.ui import View, Button
 from dotenv import load_dotenv
+try:
+    from PIL import Image  # optional, used to downscale scoreboard images
+except ImportError:
+    Image = None
 
 # Load the bot token from the .env file
 load_dotenv()
 TOKEN = os.getenv('DISCORD_TOKEN')
+HANDOFF_SECRET = os.getenv('HANDOFF_SECRET', '')  # shared by the running and the new bot process, handoff is off without it
 
 class LogLevel(IntEnum):  # Log level order enum
     NONE = 1
@@ -30,6 +55,16 @@ class GameMap():
     def __str__(self):
         return f'{self.name} {self.emoji}'
 
+class DmResult(IntEnum):  # Ready up DM delivery result enum
+    SENT = 1
+    BLOCKED = 2
+    FAILED = 3
+
+class InputState(IntEnum):  # Whether the bot handles button clicks and commands
+    STARTING = 1  # resuming saved PUGs, a bot process that is being replaced still handles input meanwhile
+    ACCEPTING = 2
+    HANDING_OFF = 3  # saving the PUGs for a new bot process that takes over
+
 class RequeueOrder(IntEnum):  # Re-queue order enum
     QUEUE_ORDER = 1
     RANDOM = 2
@@ -39,21 +74,77 @@ class RequeueOrder(IntEnum):  # Re-queue order enum
 
 # Constants for settings
 has_initialized_after_first_login = False
-log_level = LogLevel.VERBOSE
+input_state = InputState.STARTING  # set to ACCEPTING once saved PUGs are resumed
+log_level = LogLevel.VERBOSE  # can be changed while running with !log_level
+log_file_path = 'pugsbot.log'  # Also write the log to this file, moving old lines to pugsbot.log.1 etc. when it gets too big, '' to only log to the console
+log_file_max_bytes = 5000000  # Start a new log file after 5 MB
+log_file_backups = 3  # Keep the 3 most recent old log files
 bot_activity = discord.Activity(type=discord.ActivityType.playing, name="Gigantic PUGs")
-queue_channel_id = 0
 ready_up_time = 90  # Set the ready-up time to 90 seconds
+ready_reminder_time = 30  # Remind players who have not readied up when 30 seconds are left
+vote_time = 180  # Pick the map or matchup with the most votes if the vote has not finished after 3 minutes
+vote_reminder_time = 60  # Remind players who have not voted when 60 seconds are left
+match_idle_time = timedelta(hours=3)  # Mark a match as complete after 3 hours without any votes or results
 queue_size_required = 10  # 10 players required for 5v5
 team_size = queue_size_required // 2 # // is integer division, / is float division which gives a float
 reset_queue_votes_required = 4  # Require 4 votes to reset the queue
+max_active_matches = 3  # Play up to 3 matches at the same time, the queue starts again when a match starts until this many are being played
 votes_required = 5  # Require 5 votes to pick maps, matchups, or re-roll
 map_total_votes_required = 7  # Require 7 total votes to choose a map
-save_file_path = 'stored_pug.txt'  # Stores saved PUG data to load on next startup
+save_file_path = 'stored_pug_{}.txt'  # Stores saved PUG data for each queue channel to load on next startup
+journal_file_path = 'stored_pug_{}.journal'  # Stores PUG events for each queue channel since the last save, replayed on top of the save file
+legacy_save_file_path = 'stored_pug.txt'  # Save file from before PUGs were run per channel, moved to its channel's save file on startup
+legacy_journal_file_path = 'stored_pug.journal'  # Journal file from before PUGs were run per channel
+journal_compact_events = 200  # Rewrite the save file and clear the journal after 200 events
+pug_snapshot_version = 3  # Version of the JSON save file, the save file before it was a list of user ids
+pug_snapshot_delay = 1.0  # Save the full PUG state 1 second after a phase change or a full journal, so ready checks, votes and matches survive a restart
+pug_snapshot_interval = 30.0  # Otherwise save the full PUG state at most every 30 seconds while players change it, joins and leaves are in the journal meanwhile
+history_db_path = 'match_history.db'  # SQLite database of finished matches, used for match history
+display_names_file_path = 'display_names.json'  # Stores display names of players, used to show restored queues before their members are fetched
+member_query_batch = 100  # Fetch at most 100 members per request, the most discord allows when fetching members by id
+member_query_retries = 2  # Retry a member request that discord did not answer in time up to 2 times
+scoreboard_dir = 'scoreboards'  # Stores scoreboard images named by the hash of their content, so an image uploaded twice is stored once
+scoreboard_max_bytes = 10_000_000  # Scoreboard images must be less than 10 MB
+scoreboard_chunk_size = 65536  # Stream scoreboard images to disk 64 KB at a time
+scoreboard_preview_size = 1920  # Show scoreboards in discord downscaled to at most 1920 pixels wide or high, needs Pillow
+history_max_results = 10  # Show the 10 most recent matches when looking up match history
+rating_initial = 1500.0  # Rating of a player without any rated matches
+rating_k_factor = 32.0  # Most rating a player can gain or lose from a match won with 1 wound remaining
+rating_wound_weight = 0.5  # Each remaining wound after the first makes rating changes 50% bigger
 msg_fade1 = 8  # very simple ephemeral messages auto-delete after 8 seconds
 msg_fade2 = 30  # simple ephemeral messages auto-delete after 30 seconds
+list_page_timeout = 300  # the page buttons of a waiting room list stop working after 5 minutes
 re_queue_order = RequeueOrder.NUM_WOUNDS  # order to use when re-queueing players in a match
 recent_time = timedelta(hours=3)  # if ordering by playtime or wounds, only look at games in the last 3 hours
-max_matches_in_memory = 10  # Only hold onto the last 10 matches in memory
+max_matches_in_memory = 200  # Only hold onto the last 200 matches in memory
+ready_dm_concurrency = 5  # Send at most 5 ready up DMs at the same time
+ready_dm_retries = 2  # Retry a failed ready up DM up to 2 times
+ready_dm_backoff = 1.0  # Wait 1 second before retrying a ready up DM, doubling after each retry
+metrics_host = '127.0.0.1'  # Address to serve handler metrics on, only reachable from this machine by default
+metrics_port = 9108  # Port to serve handler metrics on at /metrics, 0 to turn off the metrics server
+handoff_host = '127.0.0.1'  # Address a new bot process connects to when taking over from the running one, only reachable from this machine
+handoff_port = 9109  # Port the running bot listens on for a new bot process taking over, 0 or no HANDOFF_SECRET in .env to turn off handoff
+handoff_timeout = 15  # A new bot process waits at most 15 seconds for the running one to save its PUGs and stop
+handing_off_msg = 'The bot is restarting, try again in a few seconds.'  # reply to clicks and commands while handing off to a new bot process
+span_buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 120]  # upper bounds in seconds of the handler latency histogram buckets
+edit_coalesce_window = 0.5  # wait 0.5 seconds for more edits to the same message before sending one combined edit
+actor_batch_size = 8  # Refresh messages and answer clicks after at most 8 state changes in a row, even if more are waiting
+actor_batch_time = 0.5  # Refresh messages and answer clicks once state changes in a row have taken 0.5 seconds, even if more are waiting
+interaction_defer_time = 2.0  # Defer a click that has waited 2 seconds for its state change, discord fails clicks not answered within 3 seconds
+game_servers = [  # Game servers that matches are assigned to (command name, address, port, probe port), each name is also a command that shows its join commands
+    # the game ports are UDP, so a server is only probed with a TCP connection to its probe port, such as a web admin port
+    # servers without a probe port are not checked and are assumed to be up
+    ('a7', 'anhur.servegame.com', 7777, None),
+    ('a8', 'anhur.servegame.com', 7778, None),
+    ('f7', 'floof.servegame.com', 7777, None),
+    ('f8', 'floof.servegame.com', 7778, None),
+    ('s7', 'syco.servegame.com', 7777, None),
+    ('s8', 'syco.servegame.com', 7778, None),
+    ('s9', 'syco.servegame.com', 7779, None),
+    ('s0', 'syco.servegame.com', 7780, None)
+]
+server_probe_interval = 60  # Check that each game server with a probe port accepts connections on it every 60 seconds
+server_probe_timeout = 3.0  # A game server that does not accept a connection on its probe port within 3 seconds is down
 vote_pip = '\u25c9 '  # pip to use when displaying votes
 vote_win_pip = '✅ '  # pip to use when displaying votes for the winning option
 map_choices = [  # List of GameMap objects describing maps
@@ -92,29 +183,30 @@ admin_ids = [ # ids of admin users
 divider = '——————————————————————————'  # divider string for votes
 reroll_key = 'reroll'  # key for reroll votes in votes dict
 custom_teams_key = 'custom'  # key for custom votes in votes dict
+num_matchup_choices = 3  # number of matchups in each matchup vote, one for each matchup button
+embed_field_limit = 1024  # most characters discord allows in an embed field value
+names_per_field = 25  # most names shown in a list of players, 25 names of up to 32 characters fit in an embed field
+list_page_fields = 4  # fields of names on each page of the waiting room list, 100 names with 25 names per field
 command_help = {  # Help info for commands
     'ct1': '!ct1 - use with user names to set Team 1 for Custom teams',
     'ct2': '!ct2 - use with user names to set Team 2 for Custom teams',
     'trade': '!trade - trades two players on opposite teams',
     'fill': '!fill - replaces a player in the match with one not in the match',
-    'a7': '!a7 - show the server join commands for anhur.servegame.com port 7777',
-    'a8': '!a8 - show the server join commands for anhur.servegame.com port 7778',
-    'f7': '!f7 - show the server join commands for floof.servegame.com port 7777',
-    'f8': '!f8 - show the server join commands for floof.servegame.com port 7778',
-    's7': '!s7 - show the server join commands for syco.servegame.com port 7777',
-    's8': '!s8 - show the server join commands for syco.servegame.com port 7778',
-    's9': '!s9 - show the server join commands for syco.servegame.com port 7779',
-    's0': '!s0 - show the server join commands for syco.servegame.com port 7780',
+    **{name: f'!{name} - show the server join commands for {address} port {port}' for name, address, port, _ in game_servers},
+    'servers': '!servers - show which game servers are up and which matches are being played on them',
     'custom_server': '!custom_server - set the address for the custom server used with c7 and c8 commands',
     'c7': '!c7 - show the server join commands for the custom server port 7777',
     'c8': '!c8 - show the server join commands for the custom server port 7778',
-    'sb': '''!sb - use with an attached image to set the scoreboard of the current 
+    'history': '!history - show your recent matches, can also pass in a user and/or a map name',
+    'rating': '!rating - show your rating, can also pass in a user',
+    'sb': '''!sb - use with an attached image to set the scoreboard of your 
      match, can also pass in the remaining wounds to set it at the 
-     same time ex. !sb -1''',
-    'wounds': '''!wounds - use with a number to indicate which team won the current
+     same time ex. !sb -1, and a match number for another match ex. !sb -1 12''',
+    'wounds': '''!wounds - use with a number to indicate which team won your
          match and how many wounds, + for Team1 win, - for Team2 win:
          !wounds 2    (Team 1 won the match with 2 wounds remaining)
-         !wounds -3   (Team 2 won the match with 3 wounds remaining)'''
+         !wounds -3   (Team 2 won the match with 3 wounds remaining)
+         !wounds -3 12   (Team 2 won Match #12 with 3 wounds remaining)'''
 }
 
 # Set up the bot with necessary intents
@@ -122,40 +214,476 @@ intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True  # To access member information
 
-bot = commands.Bot(command_prefix='!', intents=intents)
-
-# custom server address used for c7 and c8 commands
-custom_server_address = ''
-
-# gets a timestamp to use when logging
-def get_timestamp():
-    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-# gets a prefix for the given log level
-def get_log_level_prefix(level: LogLevel):
-    match level:
-        case LogLevel.ERROR:
+# Don't wait for every member of every guild to be downloaded before on_ready, members are fetched when needed instead
+bot = commands.Bot(command_prefix='!', intents=intents, chunk_guilds_at_startup=False)
+launch_time = time.perf_counter()  # for logging how long startup takes
+
+logging_levels = {  # logging module level for each log level
+    LogLevel.NONE: logging.CRITICAL + 10,  # always shown
+    LogLevel.ERROR: logging.ERROR,
+    LogLevel.WARNING: logging.WARNING,
+    LogLevel.INFO: logging.INFO,
+    LogLevel.VERBOSE: 15,
+    LogLevel.ASYNC_CALLSTACK: 5
+}
+logger = logging.getLogger('pugsbot')
+logger.setLevel(1)  # messages are filtered by log_level in log_msg
+logger.propagate = False  # discord.py sets up its own console logging on the root logger
+log_listener = None  # writes log records from a background thread, started by start_logging
+
+# gets a prefix for the given logging module level
+def get_log_level_prefix(levelno):
+    match levelno:
+        case logging.ERROR:
             return 'ERROR: '
-        case LogLevel.WARNING:
+        case logging.WARNING:
             return 'WARNING: '
     return ''
 
-# logs a message
-def log_msg(level: LogLevel, msg: str):
-    if level <= log_level:
-        print(f'{get_timestamp()} - {get_log_level_prefix(level)}{msg}')
+class LogFormatter(logging.Formatter):  # formats log lines as "timestamp - PREFIX: message"
+    def __init__(self):
+        super().__init__('%(asctime)s - %(level_prefix)s%(message)s', datefmt='%Y-%m-%d %H:%M:%S')
 
-# logs the start of an async call
-def log_async_start(name):
-    log_msg(LogLevel.ASYNC_CALLSTACK, f'▼ async {name}() ▼')
+    def format(self, record):
+        record.level_prefix = get_log_level_prefix(record.levelno)
+        return super().format(record)
 
-# logs the end of an async call
-def log_async_end(name):
-    log_msg(LogLevel.ASYNC_CALLSTACK, f'▲ async {name}() ▲')
+class DeferredQueueHandler(logging.handlers.QueueHandler):  # queues log records as they are, so they are formatted on the log thread
+    def prepare(self, record):
+        return record  # the message args are formatted later, so they must not be changed after logging
+
+# logs a message, msg is formatted with % and args on the log thread, and only if the level is being logged
+def log_msg(level: LogLevel, msg: str, *args):
+    if level <= log_level:
+        logger.log(logging_levels[level], msg, *args)
+
+# starts writing log records from a background thread to the console, and to a rotating log file if given a path
+def start_logging(file_path):
+    global log_listener
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if file_path:
+        handlers.append(logging.handlers.RotatingFileHandler(file_path, maxBytes=log_file_max_bytes,
+                                                             backupCount=log_file_backups, encoding='utf-8'))
+    for handler in handlers:
+        handler.setFormatter(LogFormatter())
+    log_queue = SimpleQueue()
+    logger.addHandler(DeferredQueueHandler(log_queue))
+    log_listener = logging.handlers.QueueListener(log_queue, *handlers)
+    log_listener.start()
+
+# writes any log records that are still queued and stops the log thread
+def stop_logging():
+    if log_listener:
+        log_listener.stop()
+
+class SpanMetrics():  # latency histograms and counters of timing spans, shown in the Prometheus text format
+    def __init__(self, buckets):
+        self.buckets = buckets  # upper bounds of the histogram buckets in seconds
+        self.bucket_counts = defaultdict(lambda: [0] * (len(self.buckets) + 1))  # dict of counts in each bucket and above the last (span name, list)
+        self.sums = defaultdict(float)  # dict of total seconds (span name, seconds)
+        self.errors = defaultdict(int)  # dict of spans that ended with an exception (span name, count)
+        self.in_progress = defaultdict(int)  # dict of spans that have started but not ended (span name, count)
+
+    # records a span that has ended
+    def observe(self, name, seconds, error):
+        self.bucket_counts[name][bisect.bisect_left(self.buckets, seconds)] += 1
+        self.sums[name] += seconds
+        if error:
+            self.errors[name] += 1
+
+    # gets all metrics in the Prometheus text format
+    def prometheus_text(self):
+        lines = ['# HELP pugsbot_span_seconds Time taken by bot handlers.', '# TYPE pugsbot_span_seconds histogram']
+        for name, counts in sorted(self.bucket_counts.items()):
+            total = 0
+            for bound, count in zip(self.buckets + ['+Inf'], counts):
+                total += count
+                lines.append(f'pugsbot_span_seconds_bucket{{span="{name}",le="{bound}"}} {total}')
+            lines.append(f'pugsbot_span_seconds_sum{{span="{name}"}} {self.sums[name]}')
+            lines.append(f'pugsbot_span_seconds_count{{span="{name}"}} {total}')
+        lines += ['# HELP pugsbot_span_errors_total Bot handlers that ended with an exception.', '# TYPE pugsbot_span_errors_total counter']
+        lines += [f'pugsbot_span_errors_total{{span="{name}"}} {count}' for name, count in sorted(self.errors.items())]
+        lines += ['# HELP pugsbot_span_in_progress Bot handlers that are running.', '# TYPE pugsbot_span_in_progress gauge']
+        lines += [f'pugsbot_span_in_progress{{span="{name}"}} {count}' for name, count in sorted(self.in_progress.items())]
+        lines += ['# HELP pugsbot_message_edits_total Message edits sent to discord or saved by merging.', '# TYPE pugsbot_message_edits_total counter',
+                  f'pugsbot_message_edits_total{{result="sent"}} {edit_scheduler.num_sent}',
+                  f'pugsbot_message_edits_total{{result="in_response"}} {edit_scheduler.num_in_response}',
+                  f'pugsbot_message_edits_total{{result="saved"}} {edit_scheduler.num_saved}',
+                  f'pugsbot_message_edits_total{{result="unchanged"}} {edit_scheduler.num_unchanged}']
+        return '\n'.join(lines) + '\n'
+
+span_metrics = SpanMetrics(span_buckets)
+metrics_server = None  # server for /metrics, started after first login
+handoff_server = None  # listens for a new bot process taking over, started by init_on_first_login
+
+# times a block of code and logs its start and end, the span is recorded even after an early return or exception
+@contextmanager
+def timing_span(name):
+    log_msg(LogLevel.ASYNC_CALLSTACK, '▼ async %s() ▼', name)
+    span_metrics.in_progress[name] += 1
+    start = time.perf_counter()
+    error = False
+    try:
+        yield
+    except Exception:  # a cancelled task is not an error
+        error = True
+        raise
+    finally:
+        span_metrics.observe(name, time.perf_counter() - start, error)
+        span_metrics.in_progress[name] -= 1
+        log_msg(LogLevel.ASYNC_CALLSTACK, '▲ async %s() ▲', name)
+
+# decorator that times every call of an async function as a span named after the function
+def async_span(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with timing_span(func.__name__):
+            return await func(*args, **kwargs)
+    return wrapper
+
+# handles a request to the metrics server
+async def handle_metrics_request(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b'\r\n', b'\n', b''):
+            pass  # skip the headers
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = '200 OK', span_metrics.prometheus_text()
+        else:
+            status, body = '404 Not Found', 'Not found, metrics are at /metrics\n'
+        body_bytes = body.encode()
+        writer.write(f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                     f'Content-Length: {len(body_bytes)}\r\nConnection: close\r\n\r\n'.encode() + body_bytes)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+# starts the metrics server if it is turned on
+async def start_metrics_server():
+    if not metrics_port:
+        return None
+    try:
+        server = await asyncio.start_server(handle_metrics_request, metrics_host, metrics_port)
+    except OSError as e:
+        log_msg(LogLevel.ERROR, f'Failed to start metrics server on {metrics_host}:{metrics_port}: {e}')
+        return None
+    log_msg(LogLevel.INFO, 'Serving metrics at http://%s:%s/metrics', metrics_host, metrics_port)
+    return server
+
+class MessageEditScheduler():  # merges bursts of edits to the same message into a single edit
+    def __init__(self, window):
+        self.window = window  # seconds to wait for more edits before sending
+        self.pending = {}  # dict of pending edits (message id, (message, edit kwargs))
+        self.tasks = {}  # dict of scheduled flush tasks (message id, task)
+        self.locks = defaultdict(asyncio.Lock)  # keeps edits to the same message in order
+        self.num_sent = 0  # number of edits actually sent to discord
+        self.num_saved = 0  # number of edits merged into another pending edit
+        self.num_unchanged = 0  # number of edits dropped because they would not change the message
+        self.num_in_response = 0  # number of edits sent in the response to a button click instead of on their own
+        self.sent_hashes = {}  # dict of content last sent to each message (message id, dict (edit field, hash))
+
+    # sends a message and remembers its content, so edits that would not change it are dropped
+    async def send(self, channel, **kwargs):
+        message = await channel.send(**kwargs)
+        self.sent_hashes[message.id] = {field: edit_field_hash(field, value) for field, value in kwargs.items()}
+        return message
+
+    # requests an edit of the message, newer values replace older values that are still pending
+    def request_edit(self, message, **kwargs):
+        if message.id in self.pending:
+            self.pending[message.id][1].update(kwargs)
+            self.num_saved += 1
+            return
+        self.pending[message.id] = (message, dict(kwargs))
+        self.tasks[message.id] = asyncio.create_task(self.flush_after_window(message.id))
+
+    # waits for the coalesce window to close, then sends the edit
+    async def flush_after_window(self, message_id):
+        await asyncio.sleep(self.window)
+        self.tasks.pop(message_id, None)
+        await self.flush(message_id)
+
+    # takes the pending edit for the message, keeping only the fields that would change it (message, edit kwargs, field hashes)
+    def take_changes(self, message_id):
+        message, kwargs = self.pending.pop(message_id)
+        sent_hashes = self.sent_hashes.setdefault(message_id, {})
+        new_hashes = {field: edit_field_hash(field, value) for field, value in kwargs.items()}
+        kwargs = {field: value for field, value in kwargs.items()
+                  if new_hashes[field] is None or new_hashes[field] != sent_hashes.get(field)}
+        if not kwargs:
+            self.num_unchanged += 1
+        return message, kwargs, {field: new_hashes[field] for field in kwargs}
+
+    # sends the pending edit for the message immediately
+    async def flush(self, message_id):
+        async with self.locks[message_id]:
+            if message_id not in self.pending:
+                return
+            sent_hashes = self.sent_hashes.setdefault(message_id, {})
+            message, kwargs, new_hashes = self.take_changes(message_id)
+            if not kwargs:
+                return
+            edit_kwargs = open_attachments(kwargs)
+            try:
+                await message.edit(**edit_kwargs)
+                self.num_sent += 1
+                sent_hashes.update(new_hashes)
+            except discord.NotFound:
+                log_msg(LogLevel.WARNING, 'Message was deleted before edit was sent')
+            except discord.HTTPException as e:
+                log_msg(LogLevel.ERROR, f'Failed to edit message {message_id}: {e}')
+            finally:
+                close_attachments(edit_kwargs)
+
+    # answers a button click with the pending edit of the clicked message, so one REST call both acknowledges the click and edits the message
+    # if the click did not change the message, the confirmation msg is sent as an ephemeral reply instead, or the click is just acknowledged
+    async def edit_in_response(self, interaction: discord.Interaction, msg=None, delete_after=None):
+        message_id = interaction.message.id
+        task = self.tasks.pop(message_id, None)  # the edit is sent here, so its flush is not needed
+        if task:
+            task.cancel()
+        deferred = await wait_for_defer(interaction)
+        async with self.locks[message_id]:
+            sent_hashes = self.sent_hashes.setdefault(message_id, {})
+            message, kwargs, new_hashes = (self.take_changes(message_id) if message_id in self.pending
+                                           else (interaction.message, {}, {}))
+            edit_kwargs = open_attachments(kwargs)
+            try:
+                if kwargs:
+                    if deferred:
+                        await interaction.edit_original_response(**edit_kwargs)
+                    else:
+                        await interaction.response.edit_message(**edit_kwargs)
+                    self.num_in_response += 1
+                    sent_hashes.update(new_hashes)
+                elif msg:
+                    if deferred:
+                        await interaction.followup.send(msg, ephemeral=True)
+                    else:
+                        await interaction.response.send_message(msg, ephemeral=True, delete_after=delete_after)
+                elif not deferred:
+                    await interaction.response.defer()
+            except discord.HTTPException as e:
+                log_msg(LogLevel.WARNING, f'Failed to respond to interaction on message {message_id}: {e}')
+                if kwargs:  # the interaction expired, so send the edit on its own
+                    self.request_edit(message, **kwargs)
+            finally:
+                close_attachments(edit_kwargs)
+
+    # sends all pending edits immediately
+    async def flush_all(self):
+        for task in self.tasks.values():
+            task.cancel()
+        self.tasks.clear()
+        await asyncio.gather(*[self.flush(message_id) for message_id in list(self.pending)])
+
+    # drops any pending edit for the message, used before a message is deleted
+    def cancel(self, message):
+        task = self.tasks.pop(message.id, None)
+        if task:
+            task.cancel()
+        self.pending.pop(message.id, None)
+        self.locks.pop(message.id, None)
+        self.sent_hashes.pop(message.id, None)
+
+    # gets a summary of the edits that have been sent and saved
+    def stats_str(self):
+        return (f'{self.num_sent} edits sent, {self.num_in_response} edits sent in click responses, '
+                f'{self.num_saved} edits saved by merging, {self.num_unchanged} unchanged edits dropped, {len(self.pending)} pending')
+
+class AttachmentFile():  # a file to attach in a message edit, opened only when the edit is sent, so merged and dropped edits leave no open files
+    def __init__(self, path, filename):
+        self.path = path  # path of the file on disk
+        self.filename = filename  # name of the attachment in discord
+
+# gets edit kwargs with the attachment files opened, to send the edit with, attachments that can't be opened are left out
+def open_attachments(kwargs):
+    if 'attachments' not in kwargs:
+        return kwargs
+    attachments = []
+    for attachment in kwargs['attachments']:
+        if isinstance(attachment, AttachmentFile):
+            try:
+                attachment = discord.File(attachment.path, filename=attachment.filename)
+            except OSError as e:
+                log_msg(LogLevel.ERROR, f'Failed to open attachment {attachment.filename}: {e}')
+                continue
+        attachments.append(attachment)
+    edit_kwargs = {field: value for field, value in kwargs.items() if field != 'attachments'}
+    if attachments:  # an empty list would remove the message's current attachments
+        edit_kwargs['attachments'] = attachments
+    return edit_kwargs
+
+# closes the attachment files opened for an edit, discord.py closes them once sent but not if the edit failed before that
+def close_attachments(kwargs):
+    for attachment in kwargs.get('attachments', []):
+        if isinstance(attachment, discord.File):
+            attachment.close()
+
+# gets a hash of the value of an edit field to check if an edit would change it, None if it can't be compared
+def edit_field_hash(field, value):
+    match field:
+        case 'embed':
+            return hash(json.dumps(value.to_dict(), sort_keys=True, default=str)) if value else 0
+        case 'content':
+            return hash(value)
+        case 'view':
+            return id(value) if value else 0  # views are not changed after they are sent
+    return None  # attachments are always sent
+
+edit_scheduler = MessageEditScheduler(edit_coalesce_window)
+
+class TimerService():  # runs deadlines from a single background task, each deadline can be cancelled or moved by its key
+    def __init__(self):
+        self.heap = []  # heap of armed deadlines (timestamp, seq, key), entries of cancelled or moved deadlines are skipped
+        self.timers = {}  # dict of armed deadlines (key, (deadline, seq, callback, args))
+        self.seq = 0  # number of deadlines armed, identifies the current heap entry of each key
+        self.wakeup = asyncio.Event()  # set when a deadline is armed earlier than the one being waited for
+        self.task = None
+
+    # arms a deadline to call a coroutine function at a datetime, replacing any deadline with the same key
+    def arm(self, key, deadline, callback, *args):
+        self.seq += 1
+        self.timers[key] = (deadline, self.seq, callback, args)
+        heapq.heappush(self.heap, (deadline.timestamp(), self.seq, key))
+        if len(self.heap) > 2 * len(self.timers) + 64:  # drop the entries of cancelled and moved deadlines
+            self.heap = [(entry[0].timestamp(), entry[1], key) for key, entry in self.timers.items()]
+            heapq.heapify(self.heap)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        elif self.heap[0][1] == self.seq:  # earlier than the deadline being waited for
+            self.wakeup.set()
+
+    # cancels a deadline if it is armed
+    def cancel(self, key):
+        self.timers.pop(key, None)
+
+    # gets the datetime of an armed deadline, or None
+    def deadline(self, key):
+        entry = self.timers.get(key)
+        return entry[0] if entry else None
+
+    # waits for the earliest deadline and calls its callback in the background, so a slow callback doesn't delay other deadlines
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            now = time.time()
+            while self.heap and self.heap[0][0] <= now:
+                timestamp, seq, key = heapq.heappop(self.heap)
+                entry = self.timers.get(key)
+                if entry and entry[1] == seq:
+                    del self.timers[key]
+                    run_in_background(entry[2](*entry[3]))
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.heap[0][0] - now if self.heap else None)
+            except asyncio.TimeoutError:
+                pass
+
+timers = TimerService()
+
+class GameServer():  # a game server that matches are played on
+    def __init__(self, name, address, port, probe_port=None):
+        self.name = name  # name of the command that shows the join commands of the server
+        self.address = address
+        self.port = port
+        self.probe_port = probe_port  # TCP port that is connected to to check that the server is up, None if it is not checked
+        self.up = None  # True if the server accepted a connection in the last probe, False if it did not, None before the first probe
+        self.latency = None  # seconds the last successful probe took to connect
+        self.match = None  # match being played on the server, if any
+
+    def __str__(self):
+        return f'{self.address}:{self.port}'
+
+    # checks if matches can be assigned to the server, servers that are not probed are assumed to be up
+    def is_usable(self):
+        return self.up if self.probe_port else True
+
+    # gets a string of the server's status from the last probe
+    def status_str(self):
+        if not self.probe_port:
+            return 'not checked'
+        if self.up is None:
+            return 'not checked yet'
+        if not self.up:
+            return 'down'
+        return f'up, {self.latency * 1000:.0f} ms'
+
+class ServerPool():  # probes the game servers in the background and assigns free servers to matches
+    def __init__(self, servers):
+        self.servers = {name: GameServer(name, address, port, probe_port) for name, address, port, probe_port in servers}  # dict of game servers (name, GameServer)
+        self.task = None
+
+    # starts probing the servers that have a probe port in the background
+    def start(self):
+        if any(server.probe_port for server in self.servers.values()) and (self.task is None or self.task.done()):
+            self.task = asyncio.create_task(self.run())
+
+    # probes every server each probe interval
+    async def run(self):
+        while True:
+            await self.probe_all()
+            await asyncio.sleep(server_probe_interval)
+
+    # probes all servers that have a probe port at the same time
+    async def probe_all(self):
+        await asyncio.gather(*[self.probe(server) for server in self.servers.values() if server.probe_port])
+
+    # checks that a server accepts a connection on its probe port, and how long connecting takes
+    async def probe(self, server):
+        start = time.perf_counter()
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(server.address, server.probe_port), server_probe_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            if server.up is not False:
+                log_msg(LogLevel.WARNING, f'Game server {server.name} ({server}) is down: {e!r}')
+            server.up = False
+            server.latency = None
+            return
+        server.latency = time.perf_counter() - start
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+        if not server.up:
+            log_msg(LogLevel.INFO, 'Game server %s (%s) is up, %.0f ms', server.name, server, server.latency * 1000)
+        server.up = True
+
+    # assigns the free server with the lowest latency to a match, then the first free server that is not probed, returns None if no free server is up
+    def assign(self, match):
+        free_servers = [server for server in self.servers.values() if server.is_usable() and server.match is None]
+        if not free_servers:
+            return None
+        server = min(free_servers, key=lambda server: (server.latency is None, server.latency or 0))
+        self.occupy(server, match)
+        return server
+
+    # marks a server as being used by a match, releasing the server the match used before
+    def occupy(self, server, match):
+        self.release(match)
+        server.match = match
+        match.server = server
+
+    # releases the server a match is being played on, the match keeps it to show which server it was played on
+    def release(self, match):
+        if match.server and match.server.match is match:
+            match.server.match = None
+
+    # releases the servers of every match of a PUG session
+    def release_session(self, session):
+        for server in self.servers.values():
+            if server.match and server.match.session is session:
+                server.match = None
+
+server_pool = ServerPool(game_servers)
+background_tasks = set()  # tasks that are not awaited, such as interaction replies sent by the session actor
 
 @bot.event
+@async_span
 async def on_ready():
-    log_async_start('on_ready')
     global has_initialized_after_first_login
     if bot_activity:
         await bot.change_presence(status=discord.Status.online, activity=bot_activity)
@@ -165,7 +693,29 @@ async def on_ready():
     if not has_initialized_after_first_login:
         has_initialized_after_first_login = True
         await init_on_first_login()
-    log_async_end('on_ready')
+
+# clears the cached names of a member when their nickname changes
+@bot.event
+@async_span
+async def on_member_update(before, after):
+    if before.nick != after.nick or before.display_name != after.display_name:
+        forget_display_name(after.id)
+
+# clears the cached names of a user when their name changes
+@bot.event
+@async_span
+async def on_user_update(before, after):
+    forget_display_name(after.id)
+
+# handles commands only while accepting input, so a starting bot process does not answer commands the process it replaces still answers
+@bot.event
+async def on_message(message):
+    if input_state == InputState.ACCEPTING:
+        if message.content.startswith(bot.command_prefix) and not message.author.bot:
+            refresh_display_name(message.author)
+        await bot.process_commands(message)
+    elif input_state == InputState.HANDING_OFF and message.content.startswith(bot.command_prefix) and not message.author.bot:
+        await message.channel.send(handing_off_msg, delete_after=msg_fade1)
 
 class Phase(IntEnum):  # Phase enum
     NONE = 1
@@ -177,11 +727,12 @@ class Phase(IntEnum):  # Phase enum
     RESET = 7
 
 class PugMatch():  # holds data for a single pug match
-    def __init__(self, match_number, players):
+    def __init__(self, session, match_number, players):
+        self.session = session  # PUG session that the match belongs to
         self.phase = Phase.MAP
-        self.initial_players = list(players)  # Initial players that accepted queue
+        self.initial_players = OrderedUserSet(players)  # Initial players that accepted queue
         self.players = list(players)  # Players in match
-        self.re_queue = list(players)  # Players re-queueing after current match
+        self.re_queue = OrderedUserSet(players)  # Players re-queueing after current match
         #random.shuffle(self.re_queue)  # Randomize re-queue order
         self.match_number = match_number  # Match number
         self.setup_start_time = datetime.now(timezone.utc)  # Start time of match setup
@@ -193,6 +744,7 @@ class PugMatch():  # holds data for a single pug match
         self.map_voting_message = None  # To store the map voting message
 
         self.matchups = []
+        self.shown_splits = set()  # team splits already shown in matchup votes (bitmasks of indexes in self.players)
         self.custom_team1 = []  # custom team 1 users
         self.custom_team2 = []  # custom team 2 users
         self.votes = defaultdict(int)
@@ -209,34 +761,40 @@ class PugMatch():  # holds data for a single pug match
         self.end_time = None
         self.scoreboard_filename = None
         self.wound_score = 0
+        self.rating_changes = {}  # rating changes from the result of this match (user id, change)
         self.reset_queue_votes = 0
         self.reset_voted_users = set()
         self.reset_in_progress = False  # Flag to prevent multiple resets
         self.final_matchup_message = None  # For the final matchup message
         self.waiting_room_message = None  # For the waiting room message
+        self.server = None  # game server the match is played on, assigned when the final matchup is declared
+        self.vote_deadline = None  # when the current map or matchup vote is decided by the votes so far
+        self.idle_deadline = None  # when the match is marked as complete if nothing happens before then
     
     # Sets the phase of this match
     def set_phase(self, new_phase):
-        global phase
-        phase = new_phase
+        self.session.phase = new_phase
         self.phase = new_phase
     
     # updates the re-queue
     def update_re_queue(self):
-        self.re_queue = list(self.players)  # Players re-queueing after current match
-        random.shuffle(self.re_queue)  # Randomize re-queue order
+        re_queue = list(self.players)  # Players re-queueing after current match
+        random.shuffle(re_queue)  # Randomize re-queue order
         if re_queue_order != RequeueOrder.RANDOM:  # sort re-queue order
-            self.re_queue.sort(key=re_queue_sort_key)
-            for user in self.re_queue:
-                log_msg(LogLevel.VERBOSE, f'sort key: {user} => {re_queue_sort_key(user)}')
+            sort_keys = {user.id: self.session.re_queue_sort_key(user) for user in re_queue}
+            re_queue.sort(key=lambda user: sort_keys[user.id])
+            for user in re_queue:
+                log_msg(LogLevel.VERBOSE, 'sort key: %s => %s', user, sort_keys[user.id])
+        self.re_queue = OrderedUserSet(re_queue)
     
     # Proceed to map voting
+    @async_span
     async def proceed_to_map_voting(self, channel):
-        log_async_start('proceed_to_map_voting')
+        self.vote_deadline = datetime.now(timezone.utc) + timedelta(seconds=vote_time)
         embed = self.map_voting_embed()
         # Send the message with the MapVotingView
-        self.map_voting_message = await channel.send(embed=embed, view=MapVotingView(self))
-        log_async_end('proceed_to_map_voting')
+        self.map_voting_message = await edit_scheduler.send(channel, embed=embed, view=MapVotingView(self))
+        self.arm_vote_timers(channel)
 
     # Gets the vote pip string for a given map
     def map_vote_pips(self, game_map: GameMap):
@@ -252,50 +810,48 @@ class PugMatch():  # holds data for a single pug match
         # add extra empty fields so that there are 3 fields per row
         for _ in range(-len(map_choices) % 3):
             embed.add_field(name='\u200b', value='\u200b', inline=True)
+        if self.phase == Phase.MAP:
+            embed.add_field(name='\u200b', value=f'-# Expires: <t:{datetime_to_int(self.vote_deadline)}:R>', inline=False)
         return embed
                 
     # Update the map voting message
+    @async_span
     async def update_map_voting_message(self):
-        log_async_start('update_map_voting_message')
         if self.map_voting_message:
             embed = self.map_voting_embed()
             if self.phase != Phase.MAP:
-                await self.map_voting_message.edit(embed=embed, view=None)  # remove buttons if not voting
+                edit_scheduler.request_edit(self.map_voting_message, embed=embed, view=None)  # remove buttons if not voting
             else:
-                await self.map_voting_message.edit(embed=embed)
-        log_async_end('update_map_voting_message')
+                edit_scheduler.request_edit(self.map_voting_message, embed=embed)
     
     # handles a user voting for a map
+    @async_span
     async def register_map_vote(self, interaction, game_map):
-        log_async_start('register_map_vote')
         # do nothing if no longer in map voting phase
         if self.phase != Phase.MAP:
-            await interaction.response.send_message('This button is no longer active.', ephemeral=True, delete_after=msg_fade1)
-            log_async_end('register_map_vote')
+            send_reply(interaction, 'This button is no longer active.', delete_after=msg_fade1)
             return
         
         user = interaction.user
         if user not in self.players:
-            await interaction.response.send_message('You are not part of the match.', ephemeral=True, delete_after=msg_fade1)
-            log_async_end('register_map_vote')
+            send_reply(interaction, 'You are not part of the match.', delete_after=msg_fade1)
             return
 
         # Allow user to change their vote
         if user in self.map_voted_users:
             map_previous_vote = self.map_voted_users[user]
             if map_previous_vote == game_map:
-                await interaction.response.send_message(f'You have already voted for {game_map}.', ephemeral=True, delete_after=msg_fade1)
-                log_async_end('register_map_vote')
+                send_reply(interaction, f'You have already voted for {game_map}.', delete_after=msg_fade1)
                 return
             else:
                 self.map_votes[map_previous_vote] -= 1  # Remove their previous map vote
 
         self.map_votes[game_map] += 1
         self.map_voted_users[user] = game_map
-        await interaction.response.send_message(f'You voted for {game_map}.', ephemeral=True, delete_after=msg_fade2)
+        self.session.acknowledge(interaction, f'You voted for {game_map}.', delete_after=msg_fade2)
 
         # Update the voting message
-        await self.update_map_voting_message()
+        self.session.refresh_later(self.update_map_voting_message)
 
         # Check if the map has 5 votes (for 5v5)
         if (self.map_votes[game_map] >= votes_required) and not self.selected_map_sent:
@@ -310,53 +866,50 @@ class PugMatch():  # holds data for a single pug match
             top_maps = [gm for gm, count in self.map_votes.items() if count == max_votes]
             self.selected_map = random.choice(top_maps)  # If tie, select randomly among top maps
             await self.declare_selected_map(interaction.message.channel)
-        log_async_end('register_map_vote')
 
     # Function to declare the selected map and proceed to matchups
+    @async_span
     async def declare_selected_map(self, channel):
-        log_async_start('declare_selected_map')
         await self.proceed_to_matchups_phase(channel)
         await self.update_map_voting_message()  # final update of map vote message
-        log_async_end('declare_selected_map')
 
     # Adjusted function to proceed to matchups
+    @async_span
     async def proceed_to_matchups_phase(self, channel):
-        log_async_start('proceed_to_matchups_phase')
         self.set_phase(Phase.MATCHUP)
-        player_pool = list(self.players)
-        unique_team_ids = set()
-        # if team size is greater than 2, avoid rerolling a team from the last set of matchups
-        if team_size > 2 and self.matchups:
-            for team1, team2 in self.matchups:
-                team1_ids = ' '.join([str(user.id) for user in team1])
-                team2_ids = ' '.join([str(user.id) for user in team2])
-                unique_team_ids.add(team1_ids)
-                unique_team_ids.add(team2_ids)
-                
         # clear old matchups and votes
         self.matchups = []
         self.votes.clear()  # Clear votes only at the start of new matchups
         self.voted_users.clear()  # Reset users who voted
-
-        # Generate matchups for 5v5
-        while len(self.matchups) < 3:
-            random.shuffle(player_pool)
-            team1 = player_pool[:team_size]  # 5 players on team 1
-            team2 = player_pool[team_size:]  # 5 players on team 2
-            team1.sort(key=user_sort_key)
-            team2.sort(key=user_sort_key)
-            team1_ids = ' '.join([str(user.id) for user in team1])
-            team2_ids = ' '.join([str(user.id) for user in team2])
-            # check to make sure that generated matchup is unique before adding it
-            if team1_ids not in unique_team_ids:
-                unique_team_ids.add(team1_ids)
-                unique_team_ids.add(team2_ids)
-                self.matchups.append((team1.copy(), team2.copy()))
+        self.vote_deadline = datetime.now(timezone.utc) + timedelta(seconds=vote_time)  # each re-roll gets the full vote time
+        self.arm_vote_timers(channel)
+
+        # Generate matchups from team splits that have not been shown yet in this match
+        num_splits = num_team_splits(len(self.players))
+        splits = random_team_splits(len(self.players), num_matchup_choices, self.shown_splits)
+        if not splits:  # every split has been shown, so start over
+            await channel.send(f'All {num_splits} possible matchups have been shown, starting over.')
+            self.shown_splits.clear()
+            splits = random_team_splits(len(self.players), num_matchup_choices, self.shown_splits)
+        elif len(splits) < num_matchup_choices:
+            await channel.send(f'Only {len(splits)} new matchups left, all {num_splits} possible matchups have now been shown.')
+        for split in splits:
+            self.shown_splits.add(split)
+            self.matchups.append(self.split_teams(split))
                 
         # Display the matchups
         await self.display_matchup_votes(channel)
-        log_async_end('proceed_to_matchups_phase')
     
+    # gets the teams (team1, team2) for a team split, each sorted by name
+    def split_teams(self, split):
+        team1 = [user for index, user in enumerate(self.players) if split >> index & 1]
+        team2 = [user for index, user in enumerate(self.players) if not split >> index & 1]
+        team1.sort(key=user_sort_key)
+        team2.sort(key=user_sort_key)
+        if random.random() < 0.5:  # the first player is always in the split, so pick a random side for it
+            return team2, team1
+        return team1, team2
+
     # gets the vote pip string for a given matchup
     def matchup_vote_pips(self, m):
         if m == self.selected_matchup:
@@ -364,8 +917,8 @@ class PugMatch():  # holds data for a single pug match
         return f' {vote_pip * self.votes[m]}'
 
     # Function to display the voting embed with votes count and enhanced readability
+    @async_span
     async def display_matchup_votes(self, channel):
-        log_async_start('display_matchup_votes')
         if self.phase == Phase.MATCHUP:
             embed = discord.Embed(title='Matchup Vote', description='Vote for your preferred matchup or vote to re-roll.',
                                   color=discord.Color.green())
@@ -405,16 +958,17 @@ class PugMatch():  # holds data for a single pug match
                 team2_names = '\n'.join([get_display_name(user) for user in self.custom_team2])
                 embed.add_field(name='Team 1', value=team1_names, inline=True)
                 embed.add_field(name='Team 2', value=team2_names, inline=True)
+        if self.phase == Phase.MATCHUP:
+            embed.add_field(name='\u200b', value=f'-# Expires: <t:{datetime_to_int(self.vote_deadline)}:R>', inline=False)
 
         # If the voting message exists, edit it, otherwise send a new one
         if self.voting_message:
             if self.phase != Phase.MATCHUP:
-                await self.voting_message.edit(embed=embed, view=None)
+                edit_scheduler.request_edit(self.voting_message, embed=embed, view=None)
             else:
-                await self.voting_message.edit(embed=embed)
+                edit_scheduler.request_edit(self.voting_message, embed=embed)
         else:
-            self.voting_message = await channel.send(embed=embed, view=MatchupVotingView(self))
-        log_async_end('display_matchup_votes')
+            self.voting_message = await edit_scheduler.send(channel, embed=embed, view=MatchupVotingView(self))
     
     # Gets a string representation of the matchup    
     def get_matchup_str(self, m):
@@ -425,36 +979,35 @@ class PugMatch():  # holds data for a single pug match
         return f'Matchup {m}'
     
     # handles registering a matchup vote
+    @async_span
     async def register_matchup_vote(self, interaction, m):
-        log_async_start('register_matchup_vote')
         # do nothing if no longer in team voting phase
         if self.phase != Phase.MATCHUP:
-            await interaction.response.send_message('This button is no longer active.', ephemeral=True, delete_after=msg_fade1)
-            log_async_end('register_matchup_vote')
+            send_reply(interaction, 'This button is no longer active.', delete_after=msg_fade1)
+            return
+        if isinstance(m, int) and m > len(self.matchups):  # fewer matchups when running out of team splits
+            send_reply(interaction, f'There is no {self.get_matchup_str(m)} in this vote.', delete_after=msg_fade1)
             return
         
         user = interaction.user
         if user not in self.players:
-            await interaction.response.send_message('You are not part of the match.', ephemeral=True, delete_after=msg_fade1)
-            log_async_end('register_matchup_vote')
+            send_reply(interaction, 'You are not part of the match.', delete_after=msg_fade1)
             return
         if user in self.voted_users:  # if already voted
             previous_vote = self.voted_users[user]
             if previous_vote == m:  # check if same vote
-                await interaction.response.send_message(f'You have already voted for {self.get_matchup_str(m)}.', ephemeral=True, delete_after=msg_fade1)
-                log_async_end('register_matchup_vote')
+                send_reply(interaction, f'You have already voted for {self.get_matchup_str(m)}.', delete_after=msg_fade1)
                 return
             self.votes[previous_vote] -= 1  # remove their previous vote
         self.voted_users[user] = m  # set user vote
         self.votes[m] += 1  # update matchup vote count
-        await interaction.response.send_message(f'You voted for {self.get_matchup_str(m)}.', ephemeral=True, delete_after=msg_fade2)
+        self.session.acknowledge(interaction, f'You voted for {self.get_matchup_str(m)}.', delete_after=msg_fade2)
 
         # Check if any matchup type has enough votes
         if self.votes[m] >= votes_required:
             if m == reroll_key:
                 await interaction.message.channel.send('Re-rolling the matchups!')
                 await self.proceed_to_matchups_phase(interaction.message.channel)
-                log_async_end('register_matchup_vote')
                 return
             elif m == custom_teams_key and not self.final_matchup_sent:
                 self.final_matchup_sent = True  # Ensure this block runs only once
@@ -464,15 +1017,14 @@ class PugMatch():  # holds data for a single pug match
                 await self.declare_matchup(interaction.message.channel, m)
 
         # Update the voting message
-        await self.display_matchup_votes(interaction.message.channel)
-        log_async_end('register_matchup_vote')
+        self.session.refresh_later(self.display_matchup_votes, interaction.message.channel)
     
     # Declare the chosen matchup
+    @async_span
     async def declare_matchup(self, channel, matchup_number):
-        log_async_start('declare_matchup')
-        global results_match
         self.set_phase(Phase.PLAY)
-        results_match = self
+        self.cancel_timers()
+        self.session.results_match = self
         self.start_time = datetime.now(timezone.utc)
         if matchup_number == -1:  # custom teams
             self.selected_matchup = custom_teams_key
@@ -483,27 +1035,99 @@ class PugMatch():  # holds data for a single pug match
             self.final_team1, self.final_team2 = self.matchups[matchup_number - 1]
         self.final_team1_names = ', '.join([get_display_name(user) for user in self.final_team1]) or 'custom'
         self.final_team2_names = ', '.join([get_display_name(user) for user in self.final_team2]) or 'custom'
+        server_pool.assign(self)
 
         embed = self.final_matchup_embed()
-        self.final_matchup_message = await channel.send(embed=embed, view=FinalMatchupView(self))
-
-        # Create the new waiting room after final matchup
-        await create_waiting_room(channel)
-        await update_queue_message() # single update of queue message for new phase
-        log_async_end('declare_matchup')
+        self.final_matchup_message = await edit_scheduler.send(channel, embed=embed, view=FinalMatchupView(self))
+
+        self.session.active_matches[self.match_number] = self
+        self.session.journal_phase()
+        await self.session.on_match_started(channel)
+        self.record_activity()
+
+    # gets the key of a timer of this match
+    def timer_key(self, name):
+        return (self.session.channel_id, self.match_number, name)
+
+    # arms the timers that decide the current vote and remind players who have not voted
+    def arm_vote_timers(self, channel):
+        timers.arm(self.timer_key('vote'), self.vote_deadline, self.session.run_action, self.expire_vote, channel)
+        reminder_time = self.vote_deadline - timedelta(seconds=vote_reminder_time)
+        if reminder_time > datetime.now(timezone.utc):
+            timers.arm(self.timer_key('vote_reminder'), reminder_time, self.session.run_action, self.remind_vote, channel)
+        else:  # too late to remind, and a reminder of the previous vote must not go off
+            timers.cancel(self.timer_key('vote_reminder'))
+
+    # arms the timer that marks the match as complete once it has been idle for too long
+    def arm_idle_timer(self, channel):
+        timers.arm(self.timer_key('idle'), self.idle_deadline, self.session.run_action, self.expire_idle_match, channel)
+
+    # restarts the idle timer of a match that is being played
+    def record_activity(self):
+        if self.phase == Phase.PLAY and self.final_matchup_message:
+            self.idle_deadline = datetime.now(timezone.utc) + match_idle_time
+            self.arm_idle_timer(self.final_matchup_message.channel)
+
+    # cancels all timers of the match
+    def cancel_timers(self):
+        for name in ('vote', 'vote_reminder', 'idle'):
+            timers.cancel(self.timer_key(name))
+
+    # reminds players who have not voted yet in the current vote
+    @async_span
+    async def remind_vote(self, channel):
+        if self.phase == Phase.MAP:
+            not_voted = [user for user in self.players if user not in self.map_voted_users]
+            vote_str = 'a map'
+        elif self.phase == Phase.MATCHUP:
+            not_voted = [user for user in self.players if user not in self.voted_users]
+            vote_str = 'a matchup'
+        else:
+            return
+        if not_voted:
+            mentions = ' '.join([user.mention for user in not_voted])
+            await channel.send(f'⏰ {vote_reminder_time} seconds left to vote for {vote_str}! {mentions}')
+
+    # decides a vote that has timed out with the votes so far, picking randomly between ties
+    @async_span
+    async def expire_vote(self, channel):
+        if self.phase == Phase.MAP and not self.selected_map_sent:
+            self.selected_map_sent = True
+            max_votes = max([self.map_votes[game_map] for game_map in map_choices])
+            self.selected_map = random.choice([game_map for game_map in map_choices if self.map_votes[game_map] == max_votes])
+            await channel.send(f'Map vote timed out, {self.selected_map} was picked with {max_votes} votes.')
+            await self.declare_selected_map(channel)
+        elif self.phase == Phase.MATCHUP and not self.final_matchup_sent:
+            choices = list(range(1, len(self.matchups) + 1))  # re-roll is not a choice, it would start another vote
+            if self.custom_team1 and self.custom_team2:
+                choices.append(custom_teams_key)
+            max_votes = max([self.votes[m] for m in choices])
+            m = random.choice([m for m in choices if self.votes[m] == max_votes])
+            self.final_matchup_sent = True
+            await channel.send(f'Matchup vote timed out, {self.get_matchup_str(m)} was picked with {max_votes} votes.')
+            await self.declare_matchup(channel, -1 if m == custom_teams_key else m)
+            self.session.refresh_later(self.display_matchup_votes, channel)
+
+    # marks the match as complete when nothing has happened in it for too long
+    @async_span
+    async def expire_idle_match(self, channel):
+        if self.phase != Phase.PLAY or self.reset_in_progress or self.match_number not in self.session.active_matches:
+            return
+        self.reset_in_progress = True
+        idle_hours = match_idle_time.total_seconds() / 3600
+        await self.session.complete_match(self, channel, f'Match #{self.match_number} had no activity for {idle_hours:g} hours, marking it as complete.')
     
     # Updates the final matchup message
+    @async_span
     async def update_final_matchup(self):
-        log_async_start('update_final_matchup')
         embed = self.final_matchup_embed()
         if self.final_matchup_message:
             if self.phase != Phase.PLAY:
                 all_mentions = ' '.join([user.mention for user in self.players])
                 content = f'-# pug_mh {self.match_number} {self.selected_map.name.casefold()} {all_mentions}'
-                await self.final_matchup_message.edit(content=content, embed=embed, view=None)
+                edit_scheduler.request_edit(self.final_matchup_message, content=content, embed=embed, view=None)
             else:
-                await self.final_matchup_message.edit(embed=embed)
-        log_async_end('update_final_matchup')
+                edit_scheduler.request_edit(self.final_matchup_message, embed=embed)
 
     # gets the matchup length in seconds
     def matchup_length(self):
@@ -532,6 +1156,11 @@ class PugMatch():  # holds data for a single pug match
                               color=discord.Color.gold())
         embed.add_field(name=f'Team 1 {self.score_display(1)}', value=self.final_team1_names, inline=False)
         embed.add_field(name=f'Team 2 {self.score_display(2)}', value=self.final_team2_names, inline=False)
+        if self.phase <= Phase.PLAY and server_pool.servers:
+            if self.server:
+                embed.add_field(name=f'Server !{self.server.name}', value='\n'.join(server_join_commands(self.server.address, self.server.port)), inline=False)
+            else:
+                embed.add_field(name='Server', value=f'No free game server is up, pick one with a server command such as !{next(iter(server_pool.servers))}.', inline=False)
         if self.wound_score == 0 and self.phase <= Phase.PLAY:
             embed.add_field(name='Remaining Wounds', value='Report result with !wounds x.  + for Team1, - for Team2', inline=False)
         if self.scoreboard_filename:
@@ -543,41 +1172,38 @@ class PugMatch():  # holds data for a single pug match
         return embed
     
     # Handles a match complete vote
+    @async_span
     async def register_reset_vote(self, interaction):
-        log_async_start('register_reset_vote')
         user = interaction.user
         if user in self.reset_voted_users:
-            await interaction.response.send_message('You have already marked the match as complete.', ephemeral=True, delete_after=msg_fade1)
-            log_async_end('register_reset_vote')
+            send_reply(interaction, 'You have already marked the match as complete.', delete_after=msg_fade1)
             return
         if user not in self.players:
-            await interaction.response.send_message('You are not in the current match and cannot mark the match as complete.', ephemeral=True, delete_after=msg_fade1)
-            log_async_end('register_reset_vote')
+            send_reply(interaction, 'You are not in the current match and cannot mark the match as complete.', delete_after=msg_fade1)
             return
         if self.reset_in_progress:  # Prevent triggering multiple resets
-            await interaction.response.send_message('Queue reset is already in progress.', ephemeral=True, delete_after=msg_fade1)
-            log_async_end('register_reset_vote')
+            send_reply(interaction, 'Queue reset is already in progress.', delete_after=msg_fade1)
             return
            
         self.reset_queue_votes += 1
         self.reset_voted_users.add(user)
-        await interaction.response.send_message(
+        self.record_activity()
+        self.session.acknowledge(interaction,
             f'{user.mention} marked the match as complete ({self.reset_queue_votes}/{reset_queue_votes_required} votes).',
-            ephemeral=True, delete_after=msg_fade2)
+            delete_after=msg_fade2)
        
-        await update_waiting_room_message()  # update reset vote display
+        self.session.refresh_later(self.session.update_waiting_room_message)  # update reset vote display
         # Check if the required number of votes have been reached
         if self.reset_queue_votes >= reset_queue_votes_required and not self.reset_in_progress:
             self.reset_in_progress = True  # Prevent multiple resets
-            await interaction.message.channel.send(f'Match #{self.match_number} marked as complete by vote.  Resetting queue...')
-            await restart_queue(interaction.message.channel)  # Reset the queue and send a new queue message
-        log_async_end('register_reset_vote')
+            await self.session.complete_match(self, interaction.message.channel, f'Match #{self.match_number} marked as complete by vote.')
 
     # replaces a player in the match
+    @async_span
     async def replace_player(self, p_out, p_in, channel):
-        log_async_start('replace_player')
         replace_list_item(self.players, p_out, p_in)
-        replace_list_item(self.re_queue, p_out, p_in)
+        if p_out in self.re_queue:
+            self.re_queue.replace(p_out, p_in)
         if self.phase == Phase.MAP:
             if p_out in self.map_voted_users:  # remove map vote
                 previous_vote = self.map_voted_users[p_out]
@@ -616,12 +1242,13 @@ class PugMatch():  # holds data for a single pug match
                 self.final_team2.sort(key=user_sort_key)
                 self.final_team2_names = ', '.join([get_display_name(user) for user in self.final_team2]) or 'custom'
             await self.update_final_matchup()  # update embed
-        log_async_end('replace_player')
+        self.record_result()  # update recent activity and history if the match has ended
+        self.record_activity()
             
     
     # updates UI when custom teams are changed
+    @async_span
     async def on_custom_teams_changed(self, channel):
-        log_async_start('on_custom_teams_changed')
         self.custom_team1.sort(key=user_sort_key)
         self.custom_team2.sort(key=user_sort_key)
         if self.phase == Phase.MATCHUP:
@@ -632,11 +1259,11 @@ class PugMatch():  # holds data for a single pug match
             self.final_team1_names = ', '.join([get_display_name(user) for user in self.final_team1]) or 'custom'
             self.final_team2_names = ', '.join([get_display_name(user) for user in self.final_team2]) or 'custom'
             await self.update_final_matchup()
-        log_async_end('on_custom_teams_changed')
+            self.record_activity()
     
     # updates UI when final teams are changed by a trade or fill
+    @async_span
     async def on_final_teams_changed(self, channel):
-        log_async_start('on_final_teams_changed')
         self.final_team1.sort(key=user_sort_key)
         self.final_team2.sort(key=user_sort_key)
         self.final_team1_names = ', '.join([get_display_name(user) for user in self.final_team1]) or 'custom'
@@ -648,7 +1275,8 @@ class PugMatch():  # holds data for a single pug match
             await self.display_matchup_votes(channel)
         elif self.phase == Phase.PLAY:
             await self.update_final_matchup()
-        log_async_end('on_final_teams_changed')
+        self.record_result()  # update history if the match has ended
+        self.record_activity()
     
     # updates final matchup start time to the current time
     def update_start_time(self):
@@ -659,353 +1287,1819 @@ class PugMatch():  # holds data for a single pug match
     def update_end_time(self):
         if self.phase >= Phase.PLAY and not self.end_time:
             self.end_time = datetime.now(timezone.utc)
+
+    # records the result of an ended match in the recent activity index and match history
+    def record_result(self):
+        if self.end_time:
+            self.session.player_activity.record_match(self)
+            self.update_ratings()
+            save_match_history(self)
+
+    # updates player ratings from the result of the match, replacing the changes from an earlier result
+    def update_ratings(self):
+        player_ratings.revert(self.rating_changes)
+        team1_ids = [user.id for user in self.final_team1 or []]
+        team2_ids = [user.id for user in self.final_team2 or []]
+        self.rating_changes = player_ratings.apply_result(team1_ids, team2_ids, self.wound_score)
+
+    # gets a row for the match history database
+    def history_row(self):
+        team1_ids = [user.id for user in self.final_team1 or []]
+        team2_ids = [user.id for user in self.final_team2 or []]
+        return {
+            'channel_id': self.session.channel_id,
+            'match_number': self.match_number,
+            'map': self.selected_map.name if self.selected_map else None,
+            'wound_score': self.wound_score,
+            'start_time': datetime_to_int(self.start_time) if self.start_time else None,
+            'end_time': datetime_to_int(self.end_time) if self.end_time else None,
+            'team1_names': self.final_team1_names,
+            'team2_names': self.final_team2_names,
+            'scoreboard_filename': self.scoreboard_filename,
+            'players': [(user_id, 1) for user_id in team1_ids] + [(user_id, 2) for user_id in team2_ids],
+            'rating_changes': list(self.rating_changes.items())
+        }
+
+    # gets the state of the match to save, so it can be resumed after a restart
+    def snapshot(self):
+        return {
+            'match_number': self.match_number,
+            'phase': int(self.phase),
+            'initial_players': user_ids(self.initial_players),
+            'players': user_ids(self.players),
+            're_queue': user_ids(self.re_queue),
+            'setup_start_time': datetime_to_int(self.setup_start_time),
+            'map_votes': [[user.id, game_map.name] for user, game_map in self.map_voted_users.items()],
+            'selected_map': self.selected_map.name if self.selected_map else None,
+            'map_voting_message': message_id(self.map_voting_message),
+            'matchups': [[user_ids(team1), user_ids(team2)] for team1, team2 in self.matchups],
+            'shown_splits': list(self.shown_splits),
+            'custom_team1': user_ids(self.custom_team1),
+            'custom_team2': user_ids(self.custom_team2),
+            'votes': [[user.id, m] for user, m in self.voted_users.items()],
+            'selected_matchup': self.selected_matchup,
+            'voting_message': message_id(self.voting_message),
+            'final_team1': user_ids(self.final_team1) if self.final_team1 is not None else None,
+            'final_team2': user_ids(self.final_team2) if self.final_team2 is not None else None,
+            'start_time': datetime_to_int(self.start_time) if self.start_time else None,
+            'end_time': datetime_to_int(self.end_time) if self.end_time else None,
+            'scoreboard_filename': self.scoreboard_filename,
+            'wound_score': self.wound_score,
+            'rating_changes': list(self.rating_changes.items()),
+            'reset_votes': user_ids(self.reset_voted_users),
+            'final_matchup_message': message_id(self.final_matchup_message),
+            'server': self.server.name if self.server else None,
+            'vote_deadline': datetime_to_int(self.vote_deadline) if self.vote_deadline else None,
+            'idle_deadline': datetime_to_int(self.idle_deadline) if self.idle_deadline else None
+        }
+
+    # restores the state of the match from a snapshot, reattaching to its messages in the channel
+    def load_snapshot(self, data, get_user, channel):
+        self.phase = Phase(data['phase'])
+        self.initial_players = OrderedUserSet(get_users(get_user, data['initial_players']))
+        self.re_queue = OrderedUserSet(get_users(get_user, data['re_queue']))
+        self.setup_start_time = int_to_datetime(data['setup_start_time'])
+        for user_id, map_name in data['map_votes']:
+            user = get_user(user_id)
+            game_map = find_game_map(map_name)
+            if user and game_map:
+                self.map_voted_users[user] = game_map
+                self.map_votes[game_map] += 1
+        self.selected_map = find_game_map(data['selected_map'] or '')
+        self.selected_map_sent = self.selected_map is not None
+        self.matchups = [(get_users(get_user, team1), get_users(get_user, team2)) for team1, team2 in data['matchups']]
+        if len(self.players) == len(data['players']):  # splits are indexes in self.players, so only keep them if every player was found
+            self.shown_splits = set(data['shown_splits'])
+        self.custom_team1 = get_users(get_user, data['custom_team1'])
+        self.custom_team2 = get_users(get_user, data['custom_team2'])
+        for user_id, m in data['votes']:
+            user = get_user(user_id)
+            if user:
+                self.voted_users[user] = m
+                self.votes[m] += 1
+        self.selected_matchup = data['selected_matchup']
+        self.final_matchup_sent = self.selected_matchup is not None
+        if data['final_team1'] is not None:
+            self.final_team1 = get_users(get_user, data['final_team1'])
+            self.final_team2 = get_users(get_user, data['final_team2'])
+            self.final_team1_names = ', '.join([get_display_name(user) for user in self.final_team1]) or 'custom'
+            self.final_team2_names = ', '.join([get_display_name(user) for user in self.final_team2]) or 'custom'
+        self.start_time = int_to_datetime(data['start_time']) if data['start_time'] else None
+        self.end_time = int_to_datetime(data['end_time']) if data['end_time'] else None
+        self.scoreboard_filename = data['scoreboard_filename']
+        self.wound_score = data['wound_score']
+        self.rating_changes = {user_id: change for user_id, change in data['rating_changes']}
+        self.reset_voted_users = set(get_users(get_user, data['reset_votes']))
+        self.reset_queue_votes = len(self.reset_voted_users)
+        self.vote_deadline = int_to_datetime(data['vote_deadline']) if data.get('vote_deadline') else None
+        self.idle_deadline = int_to_datetime(data['idle_deadline']) if data.get('idle_deadline') else None
+        self.server = server_pool.servers.get(data.get('server'))
+        self.map_voting_message = reattach_message(channel, data['map_voting_message'], MapVotingView(self))
+        self.voting_message = reattach_message(channel, data['voting_message'], MatchupVotingView(self))
+        self.final_matchup_message = reattach_message(channel, data['final_matchup_message'], FinalMatchupView(self))
+
+    # replaces the stand-ins of restored players with their fetched members (members by user id)
+    def replace_saved_users(self, members):
+        self.initial_players = OrderedUserSet(swap_users(members, self.initial_players))
+        self.players = swap_users(members, self.players)
+        self.re_queue = OrderedUserSet(swap_users(members, self.re_queue))
+        self.map_voted_users = {members.get(user.id, user): game_map for user, game_map in self.map_voted_users.items()}
+        self.matchups = [(swap_users(members, team1), swap_users(members, team2)) for team1, team2 in self.matchups]
+        self.custom_team1 = swap_users(members, self.custom_team1)
+        self.custom_team2 = swap_users(members, self.custom_team2)
+        self.voted_users = {members.get(user.id, user): m for user, m in self.voted_users.items()}
+        if self.final_team1 is not None:
+            self.final_team1 = swap_users(members, self.final_team1)
+            self.final_team2 = swap_users(members, self.final_team2)
+            self.final_team1_names = ', '.join([get_display_name(user) for user in self.final_team1]) or 'custom'
+            self.final_team2_names = ', '.join([get_display_name(user) for user in self.final_team2]) or 'custom'
+        self.reset_voted_users = set(swap_users(members, self.reset_voted_users))
     
-    # updates the scoreboard for the match
-    async def update_scoreboard(self, ctx, scoreboard_img):
-        log_async_start('update_scoreboard')
-        self.scoreboard_filename = scoreboard_img.filename
-        await self.final_matchup_message.edit(attachments=[scoreboard_img])
-        await self.update_final_matchup()
+    # updates the scoreboard for the match to an image in the scoreboard store, shown in discord from upload_path
+    @async_span
+    async def update_scoreboard(self, ctx, filename, upload_path):
+        if filename == self.scoreboard_filename:  # same image content, so there is nothing to upload
+            await ctx.send(f'Match #{self.match_number} already has this scoreboard.')
+            return
+        self.scoreboard_filename = filename  # also links the match history to the stored image
+        edit_scheduler.request_edit(self.final_matchup_message, attachments=[AttachmentFile(upload_path, filename)])
+        await self.update_final_matchup()  # sent together with the new attachment
         await ctx.send(f'Updated scoreboard for Match #{self.match_number}.')
         self.update_end_time()  # update match end time
-        log_async_end('update_scoreboard')
+        self.record_result()
+        self.record_activity()
     
     # updates the number of remaining wounds for the match
+    @async_span
     async def update_wounds(self, ctx, score):
-        log_async_start('update_wounds')
         new_score = max(-3, min(3, score))
         if self.wound_score == new_score:
             await ctx.send(f'The remaining wounds of Match #{self.match_number} have already been set to {new_score}.')
-            log_async_end('update_wounds')
             return
         self.wound_score = new_score
+        self.record_result()  # update wounds count if the match has ended
+        self.record_activity()
+        self.session.journal_event('result', match=self.match_number, wounds=self.wound_score)
         await self.update_final_matchup()
         if self.wound_score == 0:
             await ctx.send(f'The winner and remaining wounds of Match #{self.match_number} have been cleared.')
         else:
             win_team = (-self.wound_score // abs(self.wound_score) + 1) // 2 + 1
             await ctx.send(f'Team {win_team} is the winner of Match #{self.match_number} with {abs(self.wound_score)} wounds remaining.')
-        log_async_end('update_wounds')
     
-# Global variables to keep track of the queue and game states
-phase = Phase.NONE
-queue = []  # Players in queue
-waiting_room = []  # Players in waiting room
-matches = {}  # dict of matches (int, PugMatch)
-match_number = 1  # Match number
-current_match = None  # Current match being set up or played
-results_match = None  # Most recent match to update results
-game_in_progress = False
-queue_message = None
-
-queue_sorted = []
-ready_players = set()
-bailouts_unc = []  # Players who have clicked bailout once but not confirmed
-bailouts = []  # Players who are bailing out
-standby = []  # Players on standby to fill for players that do not ready up
-ready_start = None  # for storing the timestamp of the start of the ready up countdown
-ready_end = None  # for storing the timestamp of the end of the ready up countdown
-ready_up_timed_out = False  # Track if the ready up timer reached zero
-all_ready_sent = False  # Track if the all players ready has been sent
-ready_message = None  # To store the ready-up message
-ready_up_task = None  # For tracking the countdown task
-
-waiting_room_message = None  # For the waiting room message
-
-
-# Helper function to reset the game state but keep the waiting room intact
-def reset_game():
-    global phase, queue, game_in_progress, queue_message
-    global queue_sorted, ready_players, bailouts_unc, bailouts, standby, ready_start, ready_end, ready_up_timed_out, all_ready_sent, ready_message, ready_up_task
-    phase = Phase.QUEUE
-    queue = []
-    # waiting_room is not reset
-    game_in_progress = False
-    queue_message = None
+class OrderedUserSet():  # insertion-ordered set of users keyed by user id, with O(1) contains, remove and position
+    def __init__(self, users=()):
+        self.users = {}  # dict of users in order (position, user)
+        self.positions = {}  # dict of user positions (user id, position)
+        self.next_position = 0  # position given to the next user added
+        self.extend(users)
+
+    def __contains__(self, user):
+        return user.id in self.positions
+
+    def __len__(self):
+        return len(self.users)
+
+    def __iter__(self):
+        return iter(self.users.values())
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if (index.start or 0) >= 0 and (index.stop is None or index.stop >= 0) and index.step is None:
+                return list(islice(self.users.values(), index.start, index.stop))  # only walk the front of the set
+            return list(self)[index]
+        if index == 0 and self.users:
+            return next(iter(self.users.values()))
+        return list(self)[index]
+
+    def __repr__(self):
+        return f'OrderedUserSet({list(self)})'
+
+    # adds a user to the end if they are not already in the set, returns True if added
+    def append(self, user):
+        if user.id in self.positions:
+            return False
+        self.positions[user.id] = self.next_position
+        self.users[self.next_position] = user
+        self.next_position += 1
+        return True
+
+    # adds users to the end in order, skipping users already in the set
+    def extend(self, users):
+        for user in users:
+            self.append(user)
+
+    # removes a user, raises ValueError if they are not in the set
+    def remove(self, user):
+        if user.id not in self.positions:
+            raise ValueError(f'{user} is not in the set')
+        del self.users[self.positions.pop(user.id)]
+
+    # removes a user if they are in the set
+    def discard(self, user):
+        if user.id in self.positions:
+            del self.users[self.positions.pop(user.id)]
+
+    # gets a key for the user's position, users earlier in the set have smaller keys
+    def position(self, user):
+        return self.positions[user.id]
+
+    # replaces a user with a different user in the same position
+    def replace(self, old_user, new_user):
+        if new_user.id != old_user.id:
+            self.discard(new_user)  # the new user only keeps the old user's position
+        position = self.positions.pop(old_user.id)
+        self.positions[new_user.id] = position
+        self.users[position] = new_user
+
+    # removes and returns up to count users from the front
+    def pop_front(self, count):
+        users = self[:count]
+        for user in users:
+            del self.users[self.positions.pop(user.id)]
+        return users
+
+    # removes all users
+    def clear(self):
+        self.users.clear()
+        self.positions.clear()
+
+    # reorders the users by the given key
+    def sort(self, key):
+        users = sorted(self, key=key)
+        self.clear()
+        self.extend(users)
+
+class PlayerActivityIndex():  # rolling per-player totals of play time, games and wounds from recently ended matches
+    def __init__(self):
+        self.recorded = {}  # dict of recorded matches (match number, (end time, player ids, play time, wounds))
+        self.end_times = []  # heap of (end time, match number) used to expire old matches
+        self.totals = {}  # dict of recent totals (user id, [play time, number of games, number of wounds])
+
+    # adds or updates an ended match, replacing anything previously recorded for it
+    def record_match(self, match):
+        if not match.end_time:
+            return
+        self.record(match.match_number, match.end_time, [user.id for user in match.players], match.matchup_length(), match.wound_score)
+
+    # adds or updates an ended match from its end time, player ids, play time in seconds and wound score
+    def record(self, match_number, end_time, player_ids, play_time, wound_score):
+        self.remove_match(match_number)
+        num_wounds = 6 - abs(wound_score)
+        self.recorded[match_number] = (end_time, player_ids, play_time, num_wounds)
+        heapq.heappush(self.end_times, (end_time, match_number))
+        for user_id in player_ids:
+            totals = self.totals.setdefault(user_id, [0.0, 0, 0])
+            totals[0] += play_time
+            totals[1] += 1
+            totals[2] += num_wounds
+
+    # removes a match from the totals
+    def remove_match(self, match_number):
+        if match_number not in self.recorded:
+            return
+        end_time, player_ids, play_time, num_wounds = self.recorded.pop(match_number)
+        for user_id in player_ids:
+            totals = self.totals[user_id]
+            totals[0] -= play_time
+            totals[1] -= 1
+            totals[2] -= num_wounds
+            if totals[1] == 0:
+                del self.totals[user_id]
+
+    # removes matches that ended before the given time, the time is expected to only move forward
+    def expire(self, min_end_time):
+        while self.end_times and self.end_times[0][0] < min_end_time:
+            end_time, match_number = heapq.heappop(self.end_times)
+            if match_number in self.recorded and self.recorded[match_number][0] == end_time:
+                self.remove_match(match_number)
+
+    # gets (play time, number of games, number of wounds) for a user from matches that ended after min_end_time
+    def recent_totals(self, user, min_end_time):
+        self.expire(min_end_time)
+        play_time, num_games, num_wounds = self.totals.get(user.id, (0.0, 0, 0))
+        return play_time, num_games, num_wounds
+
+
+class SessionClosedError(Exception):  # raised for state changes requested after a session was handed off to a new bot process
+    pass
+
+class PugSession():  # holds the queue and match state for one queue channel
+    def __init__(self, channel_id):
+        self.channel_id = channel_id  # id of the queue channel
+        self.phase = Phase.NONE
+        self.queue = OrderedUserSet()  # Players in queue
+        self.waiting_room = OrderedUserSet()  # Players in waiting room
+        self.matches = {}  # dict of matches (int, PugMatch)
+        self.player_activity = PlayerActivityIndex()  # recent activity of players, used to order the re-queue
+        self.match_number = 1  # Match number
+        self.current_match = None  # Current match being set up or played
+        self.results_match = None  # Most recent match to update results
+        self.active_matches = {}  # dict of matches being played (int, PugMatch)
+        self.game_in_progress = False
+        self.queue_message = None
+        self.queue_sorted = []
+        self.ready_players = set()
+        self.bailouts_unc = OrderedUserSet()  # Players who have clicked bailout once but not confirmed
+        self.bailouts = OrderedUserSet()  # Players who are bailing out
+        self.standby = OrderedUserSet()  # Players on standby to fill for players that do not ready up
+        self.ready_start = None  # for storing the timestamp of the start of the ready up countdown
+        self.ready_end = None  # for storing the timestamp of the end of the ready up countdown
+        self.all_ready_sent = False  # Track if the all players ready has been sent
+        self.ready_message = None  # To store the ready-up message
+        self.ready_dm_results = {}  # dict of ready up DM results (user id, DmResult)
+        self.ready_dm_task = None  # For tracking the ready up DM task
+        self.waiting_room_message = None  # For the waiting room message
+        self.save_file_path = save_file_path.format(channel_id)
+        self.journal_file_path = journal_file_path.format(channel_id)
+        self.pug_journal = PugJournal(self.save_file_path, self.journal_file_path, journal_compact_events)
+        self.custom_server_address = ''  # custom server address used for c7 and c8 commands
+        self.actions = asyncio.Queue()  # state changes waiting to be applied, in the order they were requested
+        self.actor_task = None  # task that applies the queued state changes one at a time
+        self.pending_refreshes = {}  # dict of message refreshes to run once the queued state changes are applied (refresh, args)
+        self.applying_actions = False  # True while the actor is applying state changes or refreshing messages
+        self.acknowledged = []  # list of button clicks to answer with the refreshed clicked message (interaction, msg, delete_after)
+        self.save_task = None  # For tracking the task that saves the full PUG state once state changes stop
+        self.save_soon = False  # True if the full PUG state is saved after pug_snapshot_delay instead of pug_snapshot_interval
+        self.saved_phases = None  # phases of the session and its matches in the last full save, see phases()
+        self.save_time = 0.0  # event loop time at which the scheduled save of the full PUG state runs
+        self.closed = False  # True once the session is handed off to a new bot process, which owns its save files from then on
+
+    # Runs a state change on the session actor after all earlier ones, and returns its result once the messages it changed are refreshed
+    async def run_action(self, action, *args, **kwargs):
+        if self.closed:
+            raise SessionClosedError(f'PUG session of channel {self.channel_id} was handed off')
+        if asyncio.current_task() is self.actor_task:  # already applying a state change, so run it as part of that one
+            return await action(*args, **kwargs)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        for arg in args:
+            if isinstance(arg, discord.Interaction):  # a click, which must be answered before discord fails it
+                defer_handle = loop.call_later(interaction_defer_time, defer_waiting_interaction, arg, future)
+                future.add_done_callback(lambda _, handle=defer_handle: handle.cancel())
+        self.actions.put_nowait((action, args, kwargs, future))
+        if self.actor_task is None or self.actor_task.done():
+            self.actor_task = asyncio.create_task(self.run_actor())
+        return await future
+
+    # Applies queued state changes one at a time, refreshing messages once the queue runs empty or the batch gets too long
+    async def run_actor(self):
+        applied = []  # list of state changes applied since the last refresh (future, result, exception)
+        batch_size = 0  # number of state changes since the last refresh
+        batch_start = 0.0  # when the first state change since the last refresh started
+        while True:
+            action, args, kwargs, future = await self.actions.get()
+            self.applying_actions = True
+            if batch_size == 0:
+                batch_start = time.perf_counter()
+            batch_size += 1
+            if self.closed:  # queued before the session was handed off, but must not change the state the new bot process resumed
+                applied.append((future, None, SessionClosedError(f'PUG session of channel {self.channel_id} was handed off')))
+            elif not future.done():  # skip state changes whose caller was cancelled
+                try:
+                    applied.append((future, await action(*args, **kwargs), None))
+                except Exception as e:
+                    applied.append((future, None, e))
+            # a long state change or a steady stream of clicks must not keep earlier clicks from being answered
+            if self.actions.empty() or batch_size >= actor_batch_size or time.perf_counter() - batch_start >= actor_batch_time:
+                await self.run_refreshes()
+                self.answer_acknowledged()
+                for future, result, exception in applied:
+                    if future.done():
+                        continue
+                    if exception:
+                        future.set_exception(exception)
+                    else:
+                        future.set_result(result)
+                applied = []
+                batch_size = 0
+                self.applying_actions = False
+                self.save_later()
+
+    # Saves the full PUG state soon after a phase change or a full journal, otherwise once per snapshot interval, so bursts of clicks are saved once
+    def save_later(self):
+        if self.closed:
+            return
+        loop = asyncio.get_running_loop()
+        soon = self.save_soon or self.phases() != self.saved_phases
+        save_time = loop.time() + (pug_snapshot_delay if soon else pug_snapshot_interval)
+        if self.save_task and not self.save_task.done():
+            if self.save_time <= save_time:  # already saving soon enough
+                return
+            self.save_task.cancel()
+        self.save_time = save_time
+        self.save_task = asyncio.create_task(self.save_when_idle(save_time - loop.time()))
+
+    # gets the phases of the session and its matches, the full state is saved soon after any of them change
+    def phases(self):
+        return (self.phase, self.match_number, tuple((match.match_number, match.phase) for match in self.matches.values()))
+
+    # Saves the full PUG state unless the actor is busy, in which case it calls save_later again when it is done
+    async def save_when_idle(self, delay):
+        await asyncio.sleep(delay)
+        if self.phase != Phase.NONE and not self.applying_actions and self.actions.empty():
+            self.try_save_pug()
+
+    # Stops applying state changes, run on the actor so the state changes queued before it are applied first
+    async def close(self):
+        self.closed = True
+
+    # Requests a message refresh once the queued state changes are applied, so a burst of clicks refreshes each message once
+    def refresh_later(self, refresh, *args):
+        self.pending_refreshes[refresh] = args
+
+    # Acknowledges a button click once the messages are refreshed, by editing the clicked message in the interaction response
+    # msg is only sent if the click did not change the clicked message, otherwise the edit itself confirms the click
+    def acknowledge(self, interaction: discord.Interaction, msg, delete_after=None):
+        self.acknowledged.append((interaction, msg, delete_after))
+
+    # Answers the acknowledged button clicks in the background
+    def answer_acknowledged(self):
+        for interaction, msg, delete_after in self.acknowledged:
+            run_in_background(edit_scheduler.edit_in_response(interaction, msg, delete_after))
+        self.acknowledged = []
+
+    # Runs the requested message refreshes, including any requested by the refreshes themselves
+    @async_span
+    async def run_refreshes(self):
+        while self.pending_refreshes:
+            refreshes = self.pending_refreshes
+            self.pending_refreshes = {}
+            for refresh, args in refreshes.items():
+                try:
+                    await refresh(*args)
+                except Exception as e:
+                    log_msg(LogLevel.ERROR, 'Failed to refresh %s: %s', refresh.__name__, e)
+
+    # Helper function to reset the game state but keep the waiting room intact
+    def reset_game(self):
+        self.phase = Phase.QUEUE
+        self.queue = OrderedUserSet()
+        # waiting_room is not reset
+        self.game_in_progress = False
+        self.queue_message = None
     
-    queue_sorted = []
-    ready_players = set()
-    bailouts_unc = []
-    bailouts = []
-    standby = []
-    ready_start = None
-    ready_end = None
-    ready_up_timed_out = False
-    all_ready_sent = False
-    ready_message = None
-    if ready_up_task is not None:  # Cancel the countdown task if it's running
-        ready_up_task.cancel()
-        ready_up_task = None
+        self.queue_sorted = []
+        self.ready_players = set()
+        self.bailouts_unc = OrderedUserSet()
+        self.bailouts = OrderedUserSet()
+        self.standby = OrderedUserSet()
+        self.ready_start = None
+        self.ready_end = None
+        self.all_ready_sent = False
+        self.ready_message = None
+        self.cancel_ready_timers()
+        self.ready_dm_results = {}
+        if self.ready_dm_task is not None:  # Stop sending ready up DMs if they are still going
+            self.ready_dm_task.cancel()
+            self.ready_dm_task = None
+        
+        # waiting_room_message is not reset
+
+    # Get a key to sort users for re-queue
+    def re_queue_sort_key(self, user):
+        if self.current_match:
+            if re_queue_order == RequeueOrder.QUEUE_ORDER:
+                if user in self.current_match.initial_players:
+                    return self.current_match.initial_players.position(user)
+                return -1
+            # get totals from recent matches that the player was in
+            min_end_time = self.current_match.setup_start_time - recent_time
+            play_time, num_games, num_wounds = self.player_activity.recent_totals(user, min_end_time)
+            match re_queue_order:
+                case RequeueOrder.PLAY_TIME:
+                    return play_time
+                case RequeueOrder.NUM_GAMES:
+                    return num_games
+                case RequeueOrder.NUM_WOUNDS:
+                    return num_wounds
+        return 0
+
+    # Function to make the queue embed
+    def queue_embed(self):
+        if self.phase < Phase.PLAY:
+            embed = discord.Embed(title='PUGs Queue', color=discord.Color.blue())
+            if self.current_match:
+                match_names = ', '.join([get_display_name(user) for user in self.current_match.players]) or 'No players in match.'
+                embed.add_field(name=f'Setting Up Match #{self.match_number}', value=match_names, inline=False)
+            else:
+                queue_names = names_str(self.queue, empty='*Empty*')
+                embed.add_field(name=f'In Queue ({len(self.queue)}/{queue_size_required})', value=queue_names, inline=False)
+        
+            if self.waiting_room:
+                waiting_names = names_str(self.waiting_room)
+                embed.add_field(name=f'Waiting Room ({len(self.waiting_room)})', value=waiting_names, inline=False)
+            if self.current_match and self.current_match.re_queue and self.phase > Phase.READY:
+                re_queue_names = names_str(self.current_match.re_queue)
+                embed.add_field(name=f'Re-Queueing ({len(self.current_match.re_queue)})', value=re_queue_names, inline=False)
+            if self.active_matches:
+                playing_names = ', '.join([f'#{match_number}' for match_number in self.active_matches])
+                embed.add_field(name=f'Matches In Progress ({len(self.active_matches)}/{max_active_matches})', value=playing_names, inline=False)
+        elif self.current_match:
+            match_names = ', '.join([get_display_name(user) for user in self.current_match.players]) or 'No players in match.'
+            embed = discord.Embed(title=f'PUGs Match #{self.current_match.match_number}', description=match_names, color=discord.Color.blue())
+        return embed
+
+    # Function to handle when a user clicks a join button for queue or waiting room
+    @async_span
+    async def handle_queue_join(self, interaction: discord.Interaction):
+        user = interaction.user
+        match = self.match_of_player(user)  # match that the user is setting up or playing
+        if match and user in match.re_queue:
+            send_reply(interaction, 'You are already set to re-queue.', delete_after=msg_fade1)
+            return
+        if user in self.waiting_room:
+            send_reply(interaction, 'You are already in the waiting room.', delete_after=msg_fade1)
+            return
+        elif match:  # past the ready phase, so set player to re-queue once their match is complete
+            match.re_queue.append(user)
+            if match.phase >= Phase.PLAY:  # re-queue is only saved once the match is being played
+                self.journal_event('join', id=user.id, to='requeue')
+            self.acknowledge(interaction, f'{user.mention} is set to re-queue!', delete_after=msg_fade2)
+        elif user in self.queue:
+            send_reply(interaction, 'You are already in the queue.', delete_after=msg_fade1)
+            return
+        else:  # user not in queue or waiting room yet
+            if len(self.queue) < queue_size_required:  # if room in the queue add the user
+                self.queue.append(user)
+                self.journal_event('join', id=user.id, to='players')
+                self.acknowledge(interaction, f'{user.mention} joined the queue!', delete_after=msg_fade2)
+            else:  # otherwise add to waiting room
+                self.waiting_room.append(user)
+                self.journal_event('join', id=user.id, to='waiting')
+                self.acknowledge(interaction, f'{user.mention} joined the waiting room!', delete_after=msg_fade2)
     
-    # waiting_room_message is not reset
+        if self.phase == Phase.PLAY:
+            self.refresh_later(self.update_waiting_room_message)
+        else:
+            self.refresh_later(self.update_queue_message)
+    
+    # Function to handle when a user clicks a leave button for queue or waiting room
+    @async_span
+    async def handle_queue_leave(self, interaction: discord.Interaction):
+        user = interaction.user
+        match = self.match_of_player(user)  # match that the user is setting up or playing
+        if match and user in match.re_queue:
+            match.re_queue.remove(user)
+            if match.phase >= Phase.PLAY:  # re-queue is only saved once the match is being played
+                self.journal_event('leave', id=user.id, section='requeue')
+            self.acknowledge(interaction, f'{user.mention} will not re-queue!', delete_after=msg_fade2)
+        elif user in self.waiting_room:
+            if self.phase == Phase.READY and user in self.standby:
+                send_reply(interaction, 'You cannot leave the queue while on Standby.', delete_after=msg_fade1)
+                return
+            self.waiting_room.remove(user)
+            self.journal_event('leave', id=user.id, section='waiting')
+            self.acknowledge(interaction, f'{user.mention} left the waiting room!', delete_after=msg_fade2)
+        elif match:  # past the ready phase, player is already set to NOT re-queue
+            send_reply(interaction, 'You already will not re-queue.', delete_after=msg_fade1)
+            return
+        elif user in self.queue:
+            if self.phase == Phase.READY:
+                send_reply(interaction, 'You cannot leave the queue during Ready Up.', delete_after=msg_fade1)
+                return
+            self.queue.remove(user)
+            self.journal_event('leave', id=user.id, section='players')
+            self.acknowledge(interaction, f'{user.mention} left the queue.', delete_after=msg_fade2)
+        else:
+            send_reply(interaction, 'You are not in the queue.', delete_after=msg_fade1)
+            return
+    
+        if self.phase >= Phase.PLAY:
+            self.refresh_later(self.update_waiting_room_message)
+        else:
+            self.refresh_later(self.update_queue_message)
+
+    # Function to get the total number of players in queue + waiting room
+    def total_queue_size(self):
+        num_re_queue = sum([len(match.re_queue) for match in self.active_matches.values()])
+        if self.phase >= Phase.PLAY:
+            return len(self.waiting_room) + num_re_queue
+        return len(self.queue) + len(self.waiting_room) + num_re_queue
+
+    # Function to update the queue message (editing the original message)
+    @async_span
+    async def update_queue_message(self):
+        embed = self.queue_embed()
+
+        if self.queue_message:
+            if self.phase >= Phase.PLAY:
+                edit_scheduler.request_edit(self.queue_message, embed=embed, view=None)  # Remove the buttons once the match is in progress
+            else:
+                edit_scheduler.request_edit(self.queue_message, embed=embed)
+        else:
+            self.queue_message = await edit_scheduler.send(bot.get_channel(self.channel_id), embed=embed, view=QueueView(self))
+
+        # If we have the required number of players, move to ready check
+        if self.phase == Phase.QUEUE:
+            await self.check_full_queue()
+
+    # Function that checks if we have the required number of players, and if so moves to ready check
+    @async_span
+    async def check_full_queue(self):
+        if len(self.queue) == queue_size_required and not self.game_in_progress:
+            self.game_in_progress = True
+            await self.start_ready_check(self.queue_message.channel)
+
+    # Function to start the ready check
+    @async_span
+    async def start_ready_check(self, channel):
+        self.phase = Phase.READY
+        self.ready_players = set()
+        self.bailouts_unc = OrderedUserSet()
+        self.bailouts = OrderedUserSet()
+        self.standby = OrderedUserSet()
+        self.ready_dm_results = {}
+
+        # Gather all player mentions
+        mentions = ' '.join([user.mention for user in self.queue])
+
+        # create sorted queue
+        self.queue_sorted = list(self.queue)
+        self.queue_sorted.sort(key=user_sort_key)
+
+        # Get start and end times
+        self.ready_start = datetime.now(timezone.utc)
+        self.ready_end = self.ready_start + timedelta(seconds=ready_up_time)
+
+        # Send a message pinging all players that the queue has popped
+        await channel.send(f"The queue is full with {len(self.queue)} players! {mentions} please ready up!")
+
+        # Start the ready-up process and display the message
+        await self.display_ready_up(channel)
+
+        # Send a DM to each player in the queue in the background, so slow DMs don't use up the ready up time
+        self.ready_dm_task = asyncio.create_task(self.send_ready_dms(list(self.queue)))
+
+        # Start the ready-up timers
+        self.arm_ready_timers(channel)
+
+    # Sends a ready up DM to each user, a limited number at a time
+    @async_span
+    async def send_ready_dms(self, users):
+        dm_slots = asyncio.Semaphore(ready_dm_concurrency)
+        async def send_with_slot(user):
+            async with dm_slots:
+                self.ready_dm_results[user.id] = await send_ready_dm(user)
+            await self.update_ready_up_message()  # show DM progress, edits are merged by the edit scheduler
+        await asyncio.gather(*[send_with_slot(user) for user in users])
+        num_sent = sum([1 for result in self.ready_dm_results.values() if result == DmResult.SENT])
+        log_msg(LogLevel.VERBOSE, 'Sent ready up DMs to %d/%d players', num_sent, len(users))
+
+    # Function to display the ready-up message
+    @async_span
+    async def display_ready_up(self, channel):
+        embed = self.ready_up_embed()
+
+        # Send the ready-up message and store its reference
+        if self.ready_message:
+            edit_scheduler.request_edit(self.ready_message, embed=embed)
+        else:
+            self.ready_message = await edit_scheduler.send(channel, embed=embed, view=ReadyUpView(self))
+
+    # Function to update the ready-up message (players and timer)
+    @async_span
+    async def update_ready_up_message(self):
+        if self.ready_message:
+            embed = self.ready_up_embed()
+            edit_scheduler.request_edit(self.ready_message, embed=embed)
+
+    # gets the key of a timer of this session
+    def timer_key(self, name):
+        return (self.channel_id, name)
+
+    # arms the timers that end the ready up phase and remind players who have not readied up
+    def arm_ready_timers(self, channel):
+        # Timeout reached: proceed with ready players or reset queue
+        timers.arm(self.timer_key('ready'), self.ready_end, self.run_action, self.end_ready_up, channel)
+        reminder_time = self.ready_end - timedelta(seconds=ready_reminder_time)
+        if reminder_time > datetime.now(timezone.utc):
+            timers.arm(self.timer_key('ready_reminder'), reminder_time, self.run_action, self.remind_ready_up, channel)
+
+    # cancels the ready up timers
+    def cancel_ready_timers(self):
+        timers.cancel(self.timer_key('ready'))
+        timers.cancel(self.timer_key('ready_reminder'))
+
+    # reminds players who have not readied up yet
+    @async_span
+    async def remind_ready_up(self, channel):
+        if self.phase != Phase.READY:
+            return
+        not_ready = [user for user in self.queue if user not in self.ready_players and user not in self.bailouts]
+        if not_ready:
+            mentions = ' '.join([user.mention for user in not_ready])
+            await channel.send(f'⏰ {ready_reminder_time} seconds left to ready up! {mentions}')
+
+    # Ends a ready up phase, called when either the timer runs out or all players have readied/bailed
+    @async_span
+    async def end_ready_up(self, channel):
+        if self.phase != Phase.READY or self.all_ready_sent:
+            return
+        self.all_ready_sent = True
+        
+        non_ready_players = [user for user in self.queue if user not in self.ready_players]
+        num_ready = len(self.ready_players)
+        num_non_ready = len(non_ready_players)
+        # remove non-ready players from queue
+        for user in non_ready_players:
+            self.queue.remove(user)
+    
+        # If enough on standby to fill queue
+        if len(self.standby) >= num_non_ready:
+            if num_non_ready > 0:
+                fills = self.standby[:num_non_ready]
+                mentions = ' '.join([user.mention for user in fills])
+                # move users from standby to queue
+                self.queue.extend(fills)
+                self.ready_players = set(self.queue)
+                # remove queued players from waiting room
+                for user in fills:
+                    self.waiting_room.discard(user)
+                await self.proceed_to_match_setup(channel, f"Standby players have joined the match: {mentions}.  Thank you for filling in!")
+            else:
+                await self.proceed_to_match_setup(channel)
+            return
+    
+        # Ready up failed, move users from waiting room to queue
+        self.queue.extend(self.waiting_room.pop_front(num_non_ready))
+        self.ready_players.clear()  # Clear the ready players set for the next ready check
+        self.bailouts_unc.clear()
+        self.bailouts.clear()
+        self.standby.clear()
+        # Start new queue to trigger a new ready check
+        self.phase = Phase.QUEUE
+        self.game_in_progress = False
+        self.all_ready_sent = False
+        old_messages = (self.ready_message, self.queue_message)
+        self.ready_message = None
+        self.queue_message = None
+        # delete the old messages while posting a new queue message with ready players after the announcement
+        await asyncio.gather(remove_messages(*old_messages),
+                             run_in_order(channel.send(f"{queue_killstreak_str(num_non_ready)} Re-queuing {num_ready} ready players."),
+                                          self.start_new_queue(channel)))
+
+    # gets a string with the queue icon and display name of a user in the queue
+    def queue_icon_name(self, user):
+        if user in self.ready_players:
+            return f'✅ {get_display_name(user)}'
+        if user in self.bailouts:
+            return f'❌ {get_display_name(user)}'
+        return f'⌛ {get_display_name(user)}{self.dm_result_icon(user)}'
+
+    # gets an icon for a user whose ready up DM could not be delivered
+    def dm_result_icon(self, user):
+        match self.ready_dm_results.get(user.id):
+            case DmResult.BLOCKED:
+                return ' 🔕'
+            case DmResult.FAILED:
+                return ' ⚠️'
+        return ''
+
+    # gets a string describing how many ready up DMs were delivered
+    def dm_results_str(self):
+        num_sent = sum([1 for result in self.ready_dm_results.values() if result == DmResult.SENT])
+        num_failed = len(self.ready_dm_results) - num_sent
+        if len(self.ready_dm_results) < len(self.queue_sorted):
+            return f'-# Sending DMs ({len(self.ready_dm_results)}/{len(self.queue_sorted)})'
+        if num_failed:
+            return f'-# DMs delivered {num_sent}/{len(self.queue_sorted)} (🔕 DMs blocked, ⚠️ DM failed)'
+        return f'-# DMs delivered {num_sent}/{len(self.queue_sorted)}'
+
+    # Function to make the ready up embed
+    def ready_up_embed(self):
+        queue_names = '\n'.join([self.queue_icon_name(user) for user in self.queue_sorted])
+
+        embed = discord.Embed(title='Match Found!',
+                              description='Please ready up!  Players in the waiting room can standby to fill.',
+                              color=discord.Color.green())
+        embed.add_field(name=f'Match Players ({len(self.ready_players)}/{queue_size_required})', value=queue_names, inline=True)
+        if self.standby:
+            standby_names = names_str(self.standby, separator='\n', empty='\u200b')
+            embed.add_field(name=f'On Standby ({len(self.standby)}/{queue_size_required - len(self.ready_players)})', value=standby_names, inline=True)
+        embed.add_field(name='\u200b', value=f'-# Expires: <t:{datetime_to_int(self.ready_end)}:R>\n{self.dm_results_str()}', inline=False)
+        return embed
+
+    # handles a user clicking the ready up / standby button
+    @async_span
+    async def handle_ready_up(self, interaction: discord.Interaction):
+        user = interaction.user
+        if user in self.queue:
+            if user in self.ready_players:
+                send_reply(interaction, 'You are already ready.', delete_after=msg_fade1)
+                return
+            if user in self.bailouts:
+                send_reply(interaction, 'Cannot ready after clicking bail out.', delete_after=msg_fade1)
+                return
+            
+            if user in self.bailouts_unc:
+                self.bailouts_unc.remove(user)
+            self.ready_players.add(user)
+            self.acknowledge(interaction, f'{user.mention} is ready!', delete_after=ready_up_time)
+            self.refresh_later(self.update_ready_up_message)  # Update the ready-up message with new players
+            await self.check_ready_complete(interaction.message.channel)
+        else:
+            if user in self.standby:
+                send_reply(interaction, 'You are already on standby.', delete_after=msg_fade1)
+                return
+            match = self.match_of_player(user)
+            if match:
+                send_reply(interaction, f'You cannot standby while playing in Match #{match.match_number}.', delete_after=msg_fade1)
+                return
+            if user not in self.waiting_room:
+                self.waiting_room.append(user)
+                self.journal_event('join', id=user.id, to='waiting')
+                self.refresh_later(self.update_queue_message)
+            # add user to standby list and order standby list by waiting room
+            self.standby.append(user)
+            self.standby.sort(key=self.waiting_room.position)
+            self.acknowledge(interaction, f'{user.mention} is on standby!', delete_after=ready_up_time)
+            self.refresh_later(self.update_ready_up_message)
+            await self.check_ready_complete(interaction.message.channel)
+
+    # handles a user clicking the bail out button
+    @async_span
+    async def handle_bail_out(self, interaction: discord.Interaction):
+        user = interaction.user
+        if user in self.ready_players or user in self.standby:
+            send_reply(interaction, 'Cannot bail out after clicking ready.', delete_after=msg_fade1)
+        elif user in self.queue:
+            if user not in self.bailouts_unc:
+                self.bailouts_unc.append(user)
+                send_reply(interaction, 'Are you sure you want to bail out?  Click again to confirm.', delete_after=ready_up_time)
+            else:
+                self.bailouts_unc.remove(user)
+                self.bailouts.append(user)
+                self.acknowledge(interaction, f'{user.mention} is bailing out!', delete_after=ready_up_time)
+                self.refresh_later(self.update_ready_up_message)
+                await self.check_ready_complete(interaction.message.channel)
+        else:
+            send_reply(interaction, 'You are not in the queue.', delete_after=msg_fade1)
+
+    # checks if enough players have readied for the queue to go through
+    @async_span
+    async def check_ready_complete(self, channel):
+        num_non_ready = queue_size_required - len(self.ready_players)
+        if num_non_ready == 0:  # if all users are ready
+            await self.end_ready_up(channel)
+            return
+        # if all non-ready are bailing out, make sure that there are enough
+        # players on standby and that they are all at the top of the waiting room
+        if (num_non_ready == len(self.bailouts) and
+            len(self.standby) >= num_non_ready and
+            self.standby[:num_non_ready] == self.waiting_room[:num_non_ready]):  
+            await self.end_ready_up(channel)
+
+    # proceeds to match setup, sending the announcement before the match setup messages
+    @async_span
+    async def proceed_to_match_setup(self, channel, announcement=None):
+        self.phase = Phase.MAP
+        # Cancel the ready-up timers to prevent them from running after this point
+        self.cancel_ready_timers()
+
+        old_messages = (self.ready_message, self.queue_message)
+        self.ready_message = None
+        self.queue_message = None
+        # create match
+        new_match = PugMatch(self, self.match_number, self.queue)
+        self.matches[self.match_number] = new_match
+        self.current_match = new_match
+        new_match.update_re_queue() # update requeue order
+        # remove old matches
+        if len(self.matches) > max_matches_in_memory:
+            min_match_number = next(iter(self.matches))  # matches are added in order
+            del self.matches[min_match_number]
+        # the old messages are deleted while the new ones are sent
+        await asyncio.gather(remove_messages(*old_messages), self.send_match_setup(channel, new_match, announcement))
+
+    # sends the messages of a new match in order: the announcement, a new queue message and the map vote
+    @async_span
+    async def send_match_setup(self, channel, new_match, announcement):
+        if announcement:
+            await channel.send(announcement)
+        # Send a completely new queue message instead of editing the old one
+        embed = self.queue_embed()
+        self.queue_message = await edit_scheduler.send(channel, embed=embed, view=QueueView(self))
+        self.journal_phase()
+    
+        await new_match.proceed_to_map_voting(channel)
+
+    # Create a waiting room for players not in the Final Matchup
+    @async_span
+    async def create_waiting_room(self, channel):
+       embed = self.waiting_room_embed()
+       if self.waiting_room_message:
+           edit_scheduler.request_edit(self.waiting_room_message, embed=embed)
+       else:
+           self.waiting_room_message = await edit_scheduler.send(channel, embed=embed, view=QueueView(self))
+
+    # Function to update the waiting room message
+    @async_span
+    async def update_waiting_room_message(self):
+       if self.waiting_room_message:
+           embed = self.waiting_room_embed()
+           edit_scheduler.request_edit(self.waiting_room_message, embed=embed)
+
+    # gets the number of pages of the waiting room list
+    def num_waiting_room_pages(self):
+        return max(1, math.ceil(len(self.waiting_room) / (names_per_field * list_page_fields)))
+
+    # Function to make a page of the waiting room list, each field has the names of one range of positions
+    def waiting_room_list_embed(self, page):
+        page_start = page * names_per_field * list_page_fields
+        page_end = min(page_start + names_per_field * list_page_fields, len(self.waiting_room))
+        embed = discord.Embed(title=f'Waiting Room ({len(self.waiting_room)})', color=discord.Color.purple())
+        for start in range(page_start, page_end, names_per_field):
+            end = min(start + names_per_field, page_end)
+            embed.add_field(name=f'{start + 1}-{end}', value=names_str(self.waiting_room, start=start, count=end - start), inline=False)
+        if not self.waiting_room:
+            embed.description = 'No players in waiting room.'
+        embed.set_footer(text=f'Page {page + 1}/{self.num_waiting_room_pages()}')
+        return embed
+
+    # Function to make the waiting room embed
+    def waiting_room_embed(self):
+        waiting_room_names = names_str(self.waiting_room, empty='No players in waiting room.')
+        votes_str = ', '.join([f'#{match.match_number} {match.reset_queue_votes}/{reset_queue_votes_required} votes'
+                               for match in self.active_matches.values() if match.reset_queue_votes > 0])
+        if votes_str:
+            votes_str = f' ({votes_str})'
+        embed = discord.Embed(
+            title="PUGs Queue",
+            description=f'Waiting for match to complete.{votes_str}',
+            color=discord.Color.purple()
+        )
+        embed.add_field(name=f'Waiting Room ({len(self.waiting_room)})', value=waiting_room_names, inline=False)
+        re_queue = [user for match in self.active_matches.values() for user in match.re_queue]
+        if re_queue:
+            re_queue_names = names_str(re_queue)
+            embed.add_field(name=f'Re-Queueing ({len(re_queue)})', value=re_queue_names, inline=False)
+        return embed
+
+
+    # moves on once a match has started, starting the next queue right away if another match can be played at the same time
+    @async_span
+    async def on_match_started(self, channel):
+        if len(self.active_matches) < max_active_matches:
+            await self.restart_queue(channel)
+            return
+        # Create the new waiting room after final matchup
+        await self.create_waiting_room(channel)
+        await self.update_queue_message() # single update of queue message for new phase
+
+    # marks a match as complete after sending the announcement, its re-queueing players go back to the waiting room or the queue
+    @async_span
+    async def complete_match(self, match, channel, announcement):
+        match.phase = Phase.RESET
+        match.update_end_time()
+        match.record_result()
+        match.cancel_timers()
+        server_pool.release(match)
+        self.active_matches.pop(match.match_number, None)
+        self.journal_event('result', match=match.match_number, wounds=match.wound_score, end=datetime_to_int(match.end_time))
+        await match.update_final_matchup()  # final update of final matchup message
+        if self.phase == Phase.NONE:  # the PUG has ended
+            await channel.send(announcement)
+            return
+        self.waiting_room.extend(match.re_queue)  # players already in the waiting room are skipped
+        if self.phase == Phase.PLAY:  # the queue was waiting for a match to complete
+            await channel.send(f'{announcement}  Resetting queue...')
+            await self.restart_queue(channel)
+            return
+        await channel.send(announcement)
+        if self.phase == Phase.QUEUE:
+            self.add_waiting_room_players_to_queue()
+        self.journal_phase()  # record the re-queued players
+        self.refresh_later(self.update_queue_message)  # starts the ready check if the queue is full
+
+    # restart queue once the current match has started or a match is complete
+    @async_span
+    async def restart_queue(self, channel):
+        self.phase = Phase.RESET
+        await self.update_queue_message()  # final update of old queue message
+        # reset queue state
+        self.reset_game()
+        self.add_waiting_room_players_to_queue()  # Now add waiting room players to the empty queue
+        self.match_number += 1  # increment match number
+        self.current_match = None
+        await self.start_new_queue(channel)  # Start a new queue with waiting room players
+
+    # Add waiting room players to the queue
+    def add_waiting_room_players_to_queue(self):
+        # Move players out of the waiting room until queue is full or waiting room is empty
+        self.queue.extend(self.waiting_room.pop_front(queue_size_required - len(self.queue)))
+
+    # gets the match that a user is playing in or setting up, if any
+    def match_of_player(self, user):
+        for match in self.active_matches.values():
+            if user in match.players:
+                return match
+        if self.current_match and self.phase > Phase.READY and user in self.current_match.players:
+            return self.current_match
+        return None
+
+    # gets the started match that a command is for: the given match number, or else the user's match, or else the most recently started match
+    def played_match(self, user, match_number=None):
+        if match_number is not None:
+            match = self.matches.get(match_number)
+            return match if match and match.phase >= Phase.PLAY else None
+        match = self.match_of_player(user)
+        if match and match.phase >= Phase.PLAY:
+            return match
+        return self.results_match
+
+    # gets the match being set up or played that has any of the users as players, or else the current match
+    def match_of_players(self, users):
+        for user in users:
+            match = self.match_of_player(user)
+            if match:
+                return match
+        return self.current_match
+
+    # Start a new queue programmatically without needing the command context
+    @async_span
+    async def start_new_queue(self, channel):
+       self.phase = Phase.QUEUE
+       # Send a completely new queue message instead of editing the old one, deleting the waiting room message meanwhile
+       embed = self.queue_embed()
+       old_message = self.waiting_room_message
+       self.waiting_room_message = None
+       self.queue_message, _ = await asyncio.gather(edit_scheduler.send(channel, embed=embed, view=QueueView(self)),
+                                                    remove_message(old_message))
+       self.journal_phase()
+       await self.check_full_queue()
+
+    # resumes the PUG from saved data after first login
+    @async_span
+    async def resume_saved_pug(self):
+        channel = bot.get_channel(self.channel_id)
+        if not channel: # if the queue channel no longer exists, do not start queue
+            log_msg(LogLevel.WARNING, f'Queue channel not found for saved PUG: {self.save_file_path}')
+            return
+        # load saved data if it exists
+        if self.has_saved_pug():
+            self.queue = OrderedUserSet()
+            try:
+                resumed = self.restore_pug(None, full=True)
+                log_msg(LogLevel.NONE, f'PUG loaded in #{channel} on match #{self.match_number} with {self.total_queue_size()} players in queue')
+            except:
+                log_msg(LogLevel.ERROR, f'Failed to load saved PUG: {self.save_file_path}') 
+                self.reset_game()
+                self.phase = Phase.NONE
+                self.waiting_room = OrderedUserSet()
+                self.current_match = None
+                self.results_match = None
+                self.active_matches = {}
+                self.matches = {}
+                server_pool.release_session(self)
+                return
+            await self.load_recent_activity()
+            if resumed:
+                log_msg(LogLevel.NONE, f'Resuming {self.phase.name.lower()} phase in #{channel}')
+                await self.resume_phase(channel)
+                return
+            log_msg(LogLevel.NONE, f'Automatically starting queue in #{channel}')
+            self.phase = Phase.QUEUE
+            # send queue message
+            embed = self.queue_embed()
+            self.queue_message = await edit_scheduler.send(channel, embed=embed, view=QueueView(self))
+            # If we have the required number of players, move to ready check
+            await self.check_full_queue()
+
+    # restarts the timers of a resumed PUG and refreshes its messages with any changes replayed from the journal
+    @async_span
+    async def resume_phase(self, channel):
+        match = self.current_match
+        if match and match.phase in (Phase.MAP, Phase.MATCHUP) and match.vote_deadline:
+            match.arm_vote_timers(channel)
+        for match in self.active_matches.values():
+            if match.idle_deadline:
+                match.arm_idle_timer(channel)
+        if self.phase == Phase.READY:
+            self.arm_ready_timers(channel)  # ends the ready up right away if it expired during the restart
+            unsent_users = [user for user in self.queue if user.id not in self.ready_dm_results]
+            if unsent_users:  # the restart happened while ready up DMs were being sent
+                self.ready_dm_task = asyncio.create_task(self.send_ready_dms(unsent_users))
+        await self.run_action(self.refresh_resumed_messages)
+
+    # refreshes all messages of a resumed PUG
+    @async_span
+    async def refresh_resumed_messages(self):
+        self.refresh_later(self.update_queue_message)
+        self.refresh_later(self.update_ready_up_message)
+        self.refresh_later(self.update_waiting_room_message)
+
+    # replaces the stand-ins of restored players with their fetched members (members by user id)
+    @async_span
+    async def replace_saved_users(self, members):
+        self.queue = OrderedUserSet(swap_users(members, self.queue))
+        self.queue_sorted = sorted(swap_users(members, self.queue_sorted), key=user_sort_key)  # names were cached from the stand-ins
+        self.waiting_room = OrderedUserSet(swap_users(members, self.waiting_room))
+        self.ready_players = set(swap_users(members, self.ready_players))
+        self.bailouts_unc = OrderedUserSet(swap_users(members, self.bailouts_unc))
+        self.bailouts = OrderedUserSet(swap_users(members, self.bailouts))
+        self.standby = OrderedUserSet(swap_users(members, self.standby))
+        for match in self.matches.values():
+            match.replace_saved_users(members)
+        await self.refresh_resumed_messages()  # show the current display names
+        match = self.current_match
+        if match and match.phase == Phase.MATCHUP:
+            self.refresh_later(match.display_matchup_votes, match.voting_message.channel)
+        for match in self.active_matches.values():
+            self.refresh_later(match.update_final_matchup)
+
+    # checks if there is saved data for this session
+    def has_saved_pug(self):
+        return os.path.isfile(self.save_file_path) or os.path.isfile(self.journal_file_path)
+
+    # records an event in the PUG journal, compacting the journal into the save file soon when it gets long
+    def journal_event(self, event_type, **data):
+        if self.pug_journal.record(event_type, **data):
+            self.save_soon = True
+            self.save_later()
+
+    # records a phase change in the PUG journal along with the saved players, the full state is saved soon after
+    # the journal replay only resumes the queue after a phase change, so the new phase needs a full save to be resumed
+    def journal_phase(self):
+        self.save_soon = True  # also for players replaced without a phase change
+        self.journal_event('phase', phase=int(self.phase), match=self.saved_match_number(), channel=self.channel_id, **self.saved_player_ids())
+
+    # attempts to save the pug state to a file, the state is serialized and written in the background
+    def try_save_pug(self, full=True):
+        try:
+            self.pug_journal.compact(self.saved_state(full))
+            self.save_soon = False
+            self.saved_phases = self.phases()
+            log_msg(LogLevel.VERBOSE, 'PUG saved on match #%d with %d players in queue', self.match_number, self.total_queue_size())
+        except:
+            log_msg(LogLevel.ERROR, 'Error saving PUG data') 
+            return False
+        return True
+
+    # gets the match number to resume from when the pug is loaded
+    def saved_match_number(self):
+        if self.phase >= Phase.PLAY: # if final matchup has been posted, save the next match number
+            return self.match_number + 1
+        return self.match_number
+
+    # gets the ids of the players to save for each section (queue, waiting room, re-queue)
+    def saved_player_ids(self):
+        player_ids = {'players': [], 'waiting': [user.id for user in self.waiting_room],
+                      'requeue': [user.id for match in self.active_matches.values() for user in match.re_queue]}
+        if self.phase < Phase.PLAY:
+            player_ids['players'] = [user.id for user in self.queue]
+        return player_ids
+
+    # function to save the current PUG state to a file, full saves also include the ready check, matches and messages
+    def save_pug(self, file, full=True):
+        json.dump(self.saved_state(full), file)
+
+    # gets the PUG state to save, made of new lists and dicts only, so it can be serialized on another thread
+    def saved_state(self, full=True):
+        state = {'version': pug_snapshot_version, 'match': self.saved_match_number(), 'channel': self.channel_id,
+                 'seq': self.pug_journal.seq, **self.saved_player_ids()}
+        if full and self.phase != Phase.NONE:
+            state['session'] = self.snapshot()
+        return state
+
+    # gets the state of the session to save, so it can be resumed after a restart
+    def snapshot(self):
+        matches = {match.match_number: match for match in (self.current_match, self.results_match, *self.active_matches.values()) if match}
+        return {
+            'phase': int(self.phase),
+            'match_number': self.match_number,
+            'game_in_progress': self.game_in_progress,
+            'queue': user_ids(self.queue),
+            'ready': user_ids(self.ready_players),
+            'bailouts_unc': user_ids(self.bailouts_unc),
+            'bailouts': user_ids(self.bailouts),
+            'standby': user_ids(self.standby),
+            'ready_start': datetime_to_int(self.ready_start) if self.ready_start else None,
+            'ready_end': datetime_to_int(self.ready_end) if self.ready_end else None,
+            'ready_dm_results': [[user_id, int(result)] for user_id, result in self.ready_dm_results.items()],
+            'queue_message': message_id(self.queue_message),
+            'ready_message': message_id(self.ready_message),
+            'waiting_room_message': message_id(self.waiting_room_message),
+            'matches': [match.snapshot() for match in matches.values()],
+            'current_match': self.current_match.match_number if self.current_match else None,
+            'results_match': self.results_match.match_number if self.results_match else None,
+            'active_matches': list(self.active_matches),
+            'custom_server': self.custom_server_address
+        }
+
+    # function to load the PUG state from a save file and optional journal, returns True if the full state was resumed
+    def load_pug(self, guild, file, journal_file=None, full=False):
+        state = read_pug_state(file, self.match_number)
+        if journal_file:
+            replay_pug_journal(state, journal_file)
+        self.pug_journal.seq = max(self.pug_journal.seq, state['seq'])
+        if not guild: # if not coming from a !pug_start command, get the queue channel's guild
+            guild = bot.get_channel(self.channel_id).guild
+        if full and state.get('session') and state['session']['queue_message'] and state['session']['phase'] != Phase.RESET:
+            self.load_snapshot(state, guild)
+            return True
+        self.match_number = state['match']
+        for num in state['players'] + state['waiting'] + state['requeue']:
+            user = member_directory.get_user(guild, num) # num is user id
+            if len(self.queue) < queue_size_required:
+                if user not in self.queue:
+                    self.queue.append(user)
+            else:
+                if user not in self.waiting_room:
+                    self.waiting_room.append(user)
+        return False
+
+    # restores the full session state from a saved snapshot, reattaching to its messages in the queue channel
+    def load_snapshot(self, state, guild):
+        data = state['session']
+        channel = bot.get_channel(self.channel_id)
+        get_user = functools.partial(member_directory.get_user, guild)
+        self.phase = Phase(data['phase'])
+        self.match_number = data['match_number']
+        self.game_in_progress = data['game_in_progress']
+        # queue and waiting room come from the journal replay, which can have joins and leaves after the snapshot
+        self.queue = OrderedUserSet(get_users(get_user, state['players'] if self.phase < Phase.PLAY else data['queue']))
+        self.waiting_room = OrderedUserSet(get_users(get_user, state['waiting']))
+        self.ready_players = set(get_users(get_user, data['ready']))
+        self.bailouts_unc = OrderedUserSet(get_users(get_user, data['bailouts_unc']))
+        self.bailouts = OrderedUserSet(get_users(get_user, data['bailouts']))
+        self.standby = OrderedUserSet(get_users(get_user, data['standby']))
+        self.queue_sorted = sorted(self.queue, key=user_sort_key)  # the ready up players, shown in name order
+        self.ready_start = int_to_datetime(data['ready_start']) if data['ready_start'] else None
+        self.ready_end = int_to_datetime(data['ready_end']) if data['ready_end'] else None
+        self.ready_dm_results = {user_id: DmResult(result) for user_id, result in data['ready_dm_results']}
+        self.custom_server_address = data['custom_server']
+        for match_data in data['matches']:
+            match = PugMatch(self, match_data['match_number'], get_users(get_user, match_data['players']))
+            match.load_snapshot(match_data, get_user, channel)
+            self.matches[match.match_number] = match
+        self.current_match = self.matches.get(data['current_match'])
+        self.results_match = self.matches.get(data['results_match'])
+        if 'active_matches' in data:
+            self.active_matches = {match_number: self.matches[match_number] for match_number in data['active_matches']}
+        elif self.current_match and self.phase == Phase.PLAY:  # saved before matches could be played at the same time
+            self.active_matches = {self.current_match.match_number: self.current_match}
+        # re-queue comes from the journal replay, each player re-queues for the match they are playing in
+        for match in self.active_matches.values():
+            if match.server and match.server.match is None:
+                server_pool.occupy(match.server, match)
+            player_ids = set(user_ids(match.players))
+            match.re_queue = OrderedUserSet(get_users(get_user, [user_id for user_id in state['requeue'] if user_id in player_ids]))
+        self.queue_message = reattach_message(channel, data['queue_message'], QueueView(self))
+        self.ready_message = reattach_message(channel, data['ready_message'], ReadyUpView(self))
+        self.waiting_room_message = reattach_message(channel, data['waiting_room_message'], QueueView(self))
+
+    # records the recently ended matches of the channel from the match history, so the re-queue order is kept after a restart
+    async def load_recent_activity(self):
+        setup_times = [match.setup_start_time for match in self.matches.values() if match.setup_start_time]
+        min_end_time = min([datetime.now(timezone.utc)] + setup_times) - recent_time
+        rows = await asyncio.to_thread(match_history.recent_matches, self.channel_id, datetime_to_int(min_end_time))
+        for row in rows:
+            play_time = row['end_time'] - row['start_time'] if row['start_time'] else 0.0
+            self.player_activity.record(row['match_number'], int_to_datetime(row['end_time']), row['player_ids'], play_time, row['wound_score'])
+        for match in self.matches.values():  # resumed matches may have ended after their last history save
+            self.player_activity.record_match(match)
+
+    # restores the PUG state from the save file and the journal, then compacts the journal, returns True if the full state was resumed
+    def restore_pug(self, guild, full=False):
+        save_file = open(self.save_file_path, 'r') if os.path.isfile(self.save_file_path) else io.StringIO()
+        journal_file = open(self.journal_file_path, 'r') if os.path.isfile(self.journal_file_path) else None
+        try:
+            resumed = self.load_pug(guild, save_file, journal_file, full)
+        finally:
+            save_file.close()
+            if journal_file:
+                journal_file.close()
+        self.try_save_pug()
+        return resumed
+
+    # gets a message with commands to join a server game, with the teams of the match
+    def server_commands_msg(self, address, port, match):
+        cmd1, cmd2 = server_join_commands(address, port)
+        msg_lines = [cmd1]
+        if match and match.final_team1_names:
+            msg_lines.append(match.final_team1_names)
+            msg_lines.append('')
+        msg_lines.append(cmd2)
+        if match and match.final_team2_names:
+            msg_lines.append(match.final_team2_names)
+        return '\n'.join(msg_lines)
+
+    # gets a message with commands to join a custom server game
+    def custom_server_commands_msg(self, port, match):
+        return self.server_commands_msg(self.custom_server_address, port, match)
+
+sessions = {}  # dict of PUG sessions (queue channel id, PugSession)
+
+# gets the PUG session for a queue channel, creating it if needed
+def get_session(channel_id):
+    if channel_id not in sessions:
+        sessions[channel_id] = PugSession(channel_id)
+    return sessions[channel_id]
+
+# gets the PUG session for the channel a command was used in, replying if there isn't one
+async def get_command_session(ctx):
+    session = sessions.get(ctx.message.channel.id)
+    if not session:
+        await ctx.send('No PUG session is active in this channel.', ephemeral=True, delete_after=msg_fade1)
+    return session
+
+# Decorator that runs a command on the actor of the channel's PUG session, so it is ordered with button clicks
+def session_command(func):
+    @functools.wraps(func)
+    async def wrapper(ctx, *args, **kwargs):
+        session = sessions.get(ctx.message.channel.id)
+        if not session:  # nothing to order with, the command replies or creates the session itself
+            return await func(ctx, *args, **kwargs)
+        return await session.run_action(func, ctx, *args, **kwargs)
+    return wrapper
+
+# gets the ids of the queue channels that have saved PUG data
+def saved_channel_ids():
+    channel_ids = set()
+    for path_format in (save_file_path, journal_file_path):
+        prefix, suffix = path_format.split('{}')
+        for path in glob.glob(path_format.format('*')):
+            channel_id = path[len(prefix):len(path) - len(suffix)]
+            if channel_id.isdecimal():
+                channel_ids.add(int(channel_id))
+    return channel_ids
+
+# moves saved data from before PUGs were run per channel to the saved data of its channel
+def migrate_legacy_pug_save():
+    if not os.path.isfile(legacy_save_file_path):
+        return
+    with open(legacy_save_file_path, 'r') as file:
+        channel_id = read_pug_state(file)['channel']
+    if not channel_id: # if no channel id stored, there is no channel to move it to
+        log_msg(LogLevel.WARNING, f'No queue channel found in saved PUG: {legacy_save_file_path}')
+        return
+    os.replace(legacy_save_file_path, save_file_path.format(channel_id))
+    if os.path.isfile(legacy_journal_file_path):
+        os.replace(legacy_journal_file_path, journal_file_path.format(channel_id))
+    log_msg(LogLevel.NONE, f'Moved saved PUG to {save_file_path.format(channel_id)}')
 
+# initializes bot after first login
+@async_span
+async def init_on_first_login():
+    global metrics_server, handoff_server, input_state
+    step_times = {}  # dict of how long each startup step took (step, seconds)
+    step_start = time.perf_counter()
+    def end_step(step):
+        nonlocal step_start
+        step_end = time.perf_counter()
+        step_times[step] = step_end - step_start
+        step_start = step_end
+    if await take_over_running_bot():  # before anything is read from disk, the running bot saves its PUGs first
+        end_step('handoff')
+    metrics_server = await start_metrics_server()
+    end_step('metrics server')
+    server_pool.start()  # probes the game servers in the background, so they are known to be up before a match needs one
+    await load_ratings()
+    end_step('ratings')
+    member_directory.load()
+    end_step('display names')
+    migrate_legacy_pug_save()
+    # resume every queue channel that has saved data
+    channel_ids = saved_channel_ids()
+    await asyncio.gather(*[get_session(channel_id).resume_saved_pug() for channel_id in channel_ids])
+    end_step(f'resume {len(channel_ids)} channels')
+    handoff_server = await start_handoff_server()
+    input_state = InputState.ACCEPTING
+    steps_str = ', '.join(f'{step} {seconds:.3f} s' for step, seconds in step_times.items())
+    log_msg(LogLevel.NONE, f'Started in {step_start - launch_time:.2f} s: login {step_start - launch_time - sum(step_times.values()):.2f} s, {steps_str}')
+    run_in_background(fetch_restored_members())
+
+# asks the bot process that is running to save its PUGs and stop, returns True if it did
+# the running bot keeps handling input while this one logs in, so players only wait for the save and the resume
+@async_span
+async def take_over_running_bot():
+    if not handoff_port or not HANDOFF_SECRET:
+        return False
+    try:
+        reader, writer = await asyncio.open_connection(handoff_host, handoff_port)
+    except OSError:
+        return False  # no bot is running
+    start = time.perf_counter()
+    try:
+        writer.write(f'HANDOFF {HANDOFF_SECRET}\n'.encode())
+        await writer.drain()
+        reply = await asyncio.wait_for(reader.readline(), handoff_timeout)
+    except (asyncio.TimeoutError, ConnectionError) as e:
+        log_msg(LogLevel.ERROR, f'Running bot did not hand off its PUGs: {e!r}')
+        return False
+    finally:
+        writer.close()
+    if reply.strip() != b'DONE':
+        log_msg(LogLevel.ERROR, f'Running bot did not hand off its PUGs, it replied {reply!r}')
+        return False
+    log_msg(LogLevel.NONE, f'Running bot handed off its PUGs in {time.perf_counter() - start:.2f} s')
+    return True
+
+# listens for a new bot process taking over from this one
+async def start_handoff_server():
+    if not handoff_port or not HANDOFF_SECRET:
+        return None
+    try:
+        server = await asyncio.start_server(handle_handoff_request, handoff_host, handoff_port)
+    except OSError as e:
+        log_msg(LogLevel.ERROR, f'Failed to listen for handoff on {handoff_host}:{handoff_port}: {e}')
+        return None
+    log_msg(LogLevel.INFO, 'Listening for handoff on %s:%s', handoff_host, handoff_port)
+    return server
+
+# handles a new bot process taking over, replying once the PUGs are saved and then stopping the bot
+async def handle_handoff_request(reader, writer):
+    try:
+        request = await asyncio.wait_for(reader.readline(), timeout=5)
+    except (asyncio.TimeoutError, ConnectionError):
+        writer.close()
+        return
+    # any process on this machine can connect, so only a process that knows the secret can stop the bot
+    if not hmac.compare_digest(request.strip(), f'HANDOFF {HANDOFF_SECRET}'.encode()):
+        log_msg(LogLevel.WARNING, 'Refused a handoff request without the handoff secret')
+        writer.close()
+        return
+    if input_state != InputState.ACCEPTING:  # already handing off
+        writer.close()
+        return
+    log_msg(LogLevel.NONE, 'Handing off PUGs to a new bot process')
+    start = time.perf_counter()
+    try:
+        await hand_off()
+        writer.write(b'DONE\n')
+        await writer.drain()
+    except ConnectionError:
+        log_msg(LogLevel.ERROR, 'New bot process disconnected during handoff')
+    finally:
+        writer.close()
+    log_msg(LogLevel.NONE, f'Handed off PUGs in {time.perf_counter() - start:.2f} s, stopping')
+    await bot.close()
+
+# stops handling input and saves every PUG, with its messages, ready check, votes and deadlines, for the new bot process to resume
+@async_span
+async def hand_off():
+    global input_state
+    input_state = InputState.HANDING_OFF
+    # free the ports for the new bot process
+    for server in (handoff_server, metrics_server):
+        if server:
+            server.close()
+    # deadlines are saved and armed again by the new bot process
+    for task in (timers.task, server_pool.task):
+        if task:
+            task.cancel()
+    for session in sessions.values():
+        if session.ready_dm_task:  # DMs that were not sent yet are sent by the new bot process
+            session.ready_dm_task.cancel()
+    # let clicks and commands that were already received finish, state changes requested after this are rejected
+    await asyncio.gather(*[session.run_action(session.close) for session in sessions.values()])
+    await edit_scheduler.flush_all()
+    await asyncio.gather(*list(background_tasks), return_exceptions=True)
+    for session in sessions.values():
+        if session.save_task:
+            session.save_task.cancel()
+        if session.phase != Phase.NONE:
+            session.try_save_pug()
+    await asyncio.gather(*[asyncio.to_thread(session.pug_journal.close) for session in sessions.values()])
+    await match_history.wait_for_saves()  # the new bot process loads ratings from the match history
+    await asyncio.to_thread(match_history.close)
+    await asyncio.to_thread(member_directory.save, member_directory.current_names())
+
+# fetches the members of restored players in the background, replacing their stand-ins in every session
+@async_span
+async def fetch_restored_members():
+    if not member_directory.stand_ins:
+        return
+    start = time.perf_counter()
+    num_stand_ins = len(member_directory.stand_ins)
+    members = await member_directory.fetch_stand_ins()
+    for user_id in members:
+        forget_display_name(user_id)  # names were cached from the stand-ins
+    await asyncio.gather(*[session.run_action(session.replace_saved_users, members) for session in sessions.values()])
+    log_msg(LogLevel.NONE, f'Fetched {len(members)}/{num_stand_ins} restored players in {time.perf_counter() - start:.2f} s')
+    if len(members) < num_stand_ins:
+        log_msg(LogLevel.WARNING, f'{num_stand_ins - len(members)} restored players are no longer in the server')
+    await asyncio.to_thread(member_directory.save, member_directory.current_names())
 
 # converts a datetime to an integer number of seconds (offset)
 def datetime_to_int(dt):
     return int(dt.timestamp())
 
+# converts an integer number of seconds (offset) to a datetime
+def int_to_datetime(seconds):
+    return datetime.fromtimestamp(seconds, timezone.utc)
+
+# gets the ids of a list of users
+def user_ids(users):
+    return [user.id for user in users]
+
+# gets the users with the given ids, skipping users that can't be found
+def get_users(get_user, ids):
+    users = [get_user(user_id) for user_id in ids]
+    return [user for user in users if user]
+
+# gets the id of a message, or None if there is no message
+def message_id(message):
+    return message.id if message else None
+
+# gets a message in a channel by id without fetching it, registering its view so its buttons work again after a restart
+def reattach_message(channel, msg_id, view):
+    if not msg_id:
+        return None
+    bot.add_view(view, message_id=msg_id)
+    return channel.get_partial_message(msg_id)
+
 # replaces the first instance on an item in the list with a different item
 def replace_list_item(my_list, old_item, new_item):
     index = my_list.index(old_item)
     my_list[index] = new_item
     
+display_name_cache = {}  # dict of display names (user id, name), cleared for a user when their name changes
+sort_key_cache = {}  # dict of user sort keys (user id, key), cleared for a user when their name changes
+
 # Get a user's preferred display name
 def get_display_name(user):
-    return user.nick or user.display_name or user.name
+    name = display_name_cache.get(user.id)
+    if name is None:
+        name = display_name_cache[user.id] = user.nick or user.display_name or user.name
+    return name
     
 # Get a case insensitve key to sort users
 def user_sort_key(user):
-    return str.casefold(get_display_name(user))
-
-# Get a key to sort users for re-queue
-def re_queue_sort_key(user):
-    if current_match:
-        if re_queue_order == RequeueOrder.QUEUE_ORDER:
-            if user in current_match.initial_players:
-                return current_match.initial_players.index(user)
-            return -1
-        # get recent matches that the player was in
-        min_end_time = current_match.setup_start_time - recent_time
-        recent_matches = [m for n, m in matches.items() if (m.end_time and m.end_time >= min_end_time and 
-                                                            user in m.players)]
-        match re_queue_order:
-            case RequeueOrder.PLAY_TIME:
-                return sum([m.matchup_length() for m in recent_matches])
-            case RequeueOrder.NUM_GAMES:
-                return sum([1 for m in recent_matches])
-            case RequeueOrder.NUM_WOUNDS:
-                return sum([6 - abs(m.wound_score) for m in recent_matches])
-    return 0
-
-# Function to make the queue embed
-def queue_embed():
-    if phase < Phase.PLAY:
-        embed = discord.Embed(title='PUGs Queue', color=discord.Color.blue())
-        if current_match:
-            match_names = ', '.join([get_display_name(user) for user in current_match.players]) or 'No players in match.'
-            embed.add_field(name=f'Setting Up Match #{match_number}', value=match_names, inline=False)
+    key = sort_key_cache.get(user.id)
+    if key is None:
+        key = sort_key_cache[user.id] = str.casefold(get_display_name(user))
+    return key
+
+# clears the cached names of a user
+def forget_display_name(user_id):
+    display_name_cache.pop(user_id, None)
+    sort_key_cache.pop(user_id, None)
+
+# updates the cached names of the user of a click or command from their current member
+# members that are not in the member cache get no member update events, so this is how their name changes are seen
+def refresh_display_name(user):
+    name = getattr(user, 'nick', None) or user.display_name or user.name
+    if display_name_cache.get(user.id) != name:
+        forget_display_name(user.id)
+        display_name_cache[user.id] = name
+
+# gets the names of up to count users from a start position, followed by how many users come after them
+# only the shown names are looked up, so the cost does not grow with the number of users, and names are dropped if they go over the field limit
+def names_str(users, separator=', ', start=0, count=names_per_field, empty=''):
+    names = [get_display_name(user) for user in islice(users, start, start + count)]
+    while True:
+        text = separator.join(names)
+        num_more = len(users) - start - len(names)
+        if num_more > 0:
+            text = f'{text}{separator}+{num_more} more' if names else f'+{num_more} more'
+        if len(text) <= embed_field_limit or not names:
+            return text or empty
+        names.pop()
+
+class SavedUser(discord.user._UserTag):  # stand-in for a restored player whose guild member has not been fetched yet, discord users only compare equal to _UserTag objects
+    def __init__(self, user_id, name, guild):
+        self.id = user_id
+        self.name = name  # display name saved by the last run
+        self.nick = None
+        self.display_name = name
+        self.mention = f'<@{user_id}>'
+        self.guild = guild  # guild to fetch the member from
+
+    # equal to any user with the same id, so stand-ins can be found with the members of interactions and commands
+    def __eq__(self, other):
+        return getattr(other, 'id', None) == self.id
+
+    # same hash as discord users, so stand-ins and members are the same key in sets and dicts
+    def __hash__(self):
+        return self.id >> 22
+
+    def __str__(self):
+        return self.name
+
+    # sends a DM to the user
+    async def send(self, *args, **kwargs):
+        user = bot.get_user(self.id) or await bot.fetch_user(self.id)
+        return await user.send(*args, **kwargs)
+
+class MemberDirectory():  # gets restored players by id without waiting for the whole guild to be downloaded
+    def __init__(self, path):
+        self.path = path  # file of saved display names
+        self.saved_names = {}  # dict of display names saved by the last run (user id, name)
+        self.stand_ins = {}  # dict of stand-ins for members that are not fetched yet (user id, SavedUser)
+
+    # loads the saved display names
+    def load(self):
+        try:
+            with open(self.path, 'r') as file:
+                self.saved_names = {int(user_id): name for user_id, name in json.load(file).items()}
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            log_msg(LogLevel.WARNING, f'Could not load saved display names: {e}')
+
+    # gets the display names to save, including every name shown since startup
+    def current_names(self):
+        self.saved_names.update(display_name_cache)
+        return dict(self.saved_names)
+
+    # saves display names to the file, replacing it atomically
+    def save(self, names):
+        try:
+            temp_path = f'{self.path}.tmp'
+            with open(temp_path, 'w') as file:
+                json.dump(names, file)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            log_msg(LogLevel.ERROR, f'Could not save display names: {e}')
+
+    # gets the member with the given id if it is cached, otherwise a stand-in named from the saved display names
+    def get_user(self, guild, user_id):
+        member = guild.get_member(user_id)
+        if member:
+            return member
+        if user_id not in self.stand_ins:
+            self.stand_ins[user_id] = SavedUser(user_id, self.saved_names.get(user_id, f'<@{user_id}>'), guild)
+        return self.stand_ins[user_id]
+
+    # fetches the members of all stand-ins in batches, returns the dict of members found (user id, member)
+    async def fetch_stand_ins(self):
+        batches = []  # list of (guild, user ids) to fetch
+        for guild in {user.guild for user in self.stand_ins.values()}:
+            user_ids = [user_id for user_id, user in self.stand_ins.items() if user.guild == guild]
+            batches.extend((guild, user_ids[i:i + member_query_batch]) for i in range(0, len(user_ids), member_query_batch))
+        results = await asyncio.gather(*[self.fetch_batch(guild, user_ids) for guild, user_ids in batches])
+        members = {member.id: member for batch_members in results for member in batch_members}
+        for user_id in members:
+            self.stand_ins.pop(user_id, None)  # another fetch may have replaced it already
+        return members
+
+    # fetches a batch of members, retrying if discord does not answer in time, returns an empty list if it never does
+    async def fetch_batch(self, guild, user_ids):
+        for attempt in range(member_query_retries + 1):
+            try:
+                return await guild.query_members(user_ids=user_ids, limit=len(user_ids), cache=True)
+            except asyncio.TimeoutError:
+                log_msg(LogLevel.WARNING, f'Timed out fetching {len(user_ids)} restored players (attempt {attempt + 1}/{member_query_retries + 1})')
+        return []
+
+member_directory = MemberDirectory(display_names_file_path)
+
+# replaces stand-ins in a list of users with fetched members (members by user id)
+def swap_users(members, users):
+    return [members.get(user.id, user) for user in users]
+
+# gets the number of ways to split players into two teams, not counting swapping the teams
+def num_team_splits(num_players):
+    return math.comb(num_players - 1, num_players // 2 - 1)
+
+# gets the team split with the given rank as a bitmask of the player indexes on the same team as the first player
+def team_split_mask(num_players, rank):
+    mask = 1
+    remaining = num_players // 2 - 1  # teammates of the first player left to pick
+    for index in range(1, num_players):
+        if remaining == 0:
+            break
+        num_with_index = math.comb(num_players - index - 1, remaining - 1)  # splits that pick this index next
+        if rank < num_with_index:
+            mask |= 1 << index
+            remaining -= 1
         else:
-            queue_names = ', '.join([get_display_name(user) for user in queue]) or '*Empty*'
-            embed.add_field(name=f'In Queue ({len(queue)}/{queue_size_required})', value=queue_names, inline=False)
-        
-        if waiting_room:
-            waiting_names = ', '.join([get_display_name(user) for user in waiting_room])
-            embed.add_field(name=f'Waiting Room ({len(waiting_room)})', value=waiting_names, inline=False)
-        if current_match and current_match.re_queue and phase > Phase.READY:
-            re_queue_names = ', '.join([get_display_name(user) for user in current_match.re_queue])
-            embed.add_field(name=f'Re-Queueing ({len(current_match.re_queue)})', value=re_queue_names, inline=False)
-    elif current_match:
-        match_names = ', '.join([get_display_name(user) for user in current_match.players]) or 'No players in match.'
-        embed = discord.Embed(title=f'PUGs Match #{current_match.match_number}', description=match_names, color=discord.Color.blue())
-    return embed
+            rank -= num_with_index
+    return mask
+
+# gets up to count random team splits that are not excluded, checking at most count + len(excluded) splits
+def random_team_splits(num_players, count, excluded):
+    num_splits = num_team_splits(num_players)
+    # distinct ranks give distinct splits, so this many ranks always includes count splits that are not excluded
+    ranks = random.sample(range(num_splits), min(num_splits, count + len(excluded)))
+    splits = []
+    for rank in ranks:
+        split = team_split_mask(num_players, rank)
+        if split not in excluded:
+            splits.append(split)
+            if len(splits) == count:
+                break
+    return splits
+
+# prefixes the custom ids of a view's buttons with the channel and match they belong to, so the view can be registered again after a restart
+def scope_custom_ids(view, scope):
+    for item in view.children:
+        item.custom_id = f'{scope}:{item.custom_id}'
+
+# View whose buttons are only handled while accepting input, clicks while handing off to a new bot process are answered with a retry message
+class PugView(View):
+    async def interaction_check(self, interaction: discord.Interaction):
+        if input_state == InputState.ACCEPTING:
+            refresh_display_name(interaction.user)
+            return True
+        await interaction.response.send_message(handing_off_msg, ephemeral=True, delete_after=msg_fade1)
+        return False
 
 # View for the join/leave queue buttons
-class QueueView(View):
-    def __init__(self):
+class QueueView(PugView):
+    def __init__(self, session: PugSession):
         super().__init__(timeout=None)
+        self.session = session
+        scope_custom_ids(self, f'pug:{session.channel_id}')
 
-    @discord.ui.button(label='Join Queue', style=discord.ButtonStyle.green)
+    @discord.ui.button(label='Join Queue', style=discord.ButtonStyle.green, custom_id='join_queue')
+    @async_span
     async def join_queue(self, interaction: discord.Interaction, button: discord.ui.Button):
-        log_async_start('join_queue')
-        await handle_queue_join(interaction)
-        log_async_end('join_queue')
+        await self.session.run_action(self.session.handle_queue_join, interaction)
 
-    @discord.ui.button(label='Leave Queue', style=discord.ButtonStyle.red)
+    @discord.ui.button(label='Leave Queue', style=discord.ButtonStyle.red, custom_id='leave_queue')
+    @async_span
     async def leave_queue(self, interaction: discord.Interaction, button: discord.ui.Button):
-        log_async_start('leave_queue')
-        await handle_queue_leave(interaction)
-        log_async_end('leave_queue')
+        await self.session.run_action(self.session.handle_queue_leave, interaction)
     
-    @discord.ui.button(label='Match History', style=discord.ButtonStyle.grey)
+    @discord.ui.button(label='Waiting Room List', style=discord.ButtonStyle.grey, custom_id='waiting_room_list')
+    @async_span
+    async def waiting_room_list_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        view = WaitingRoomListView(self.session)
+        await interaction.response.send_message(embed=view.page_embed(), view=view, ephemeral=True)
+
+    @discord.ui.button(label='Match History', style=discord.ButtonStyle.grey, custom_id='match_history')
+    @async_span
     async def match_history_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        log_async_start('match_history_button')
         await reply_with_match_history(interaction)
-        log_async_end('match_history_button')
     
-    @discord.ui.button(label='Help', style=discord.ButtonStyle.grey)
+    @discord.ui.button(label='Help', style=discord.ButtonStyle.grey, custom_id='help')
+    @async_span
     async def help_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        log_async_start('help_button')
         await reply_with_help(interaction)
-        log_async_end('help_button')
-
-# Function to handle when a user clicks a join button for queue or waiting room
-async def handle_queue_join(interaction: discord.Interaction):
-    log_async_start('handle_queue_join')
-    user = interaction.user
-    if current_match and user in current_match.re_queue:
-        await interaction.response.send_message('You are already set to re-queue.', ephemeral=True, delete_after=msg_fade1)
-        log_async_end('handle_queue_join')
-        return
-    if user in waiting_room:
-        await interaction.response.send_message('You are already in the waiting room.', ephemeral=True, delete_after=msg_fade1)
-        log_async_end('handle_queue_join')
-        return
-    elif user in queue:
-        if phase > Phase.READY and current_match: # if past the ready phase, set player to re-queue
-            current_match.re_queue.append(user)
-            await interaction.response.send_message(f'{user.mention} is set to re-queue!', ephemeral=True, delete_after=msg_fade2)
-        else:
-            await interaction.response.send_message('You are already in the queue.', ephemeral=True, delete_after=msg_fade1)
-            log_async_end('handle_queue_join')
-            return
-    else:  # user not in queue or waiting room yet
-        if len(queue) < queue_size_required:  # if room in the queue add the user
-            queue.append(user)
-            await interaction.response.send_message(f'{user.mention} joined the queue!', ephemeral=True, delete_after=msg_fade2)
-        else:  # otherwise add to waiting room
-            waiting_room.append(user)
-            await interaction.response.send_message(f'{user.mention} joined the waiting room!', ephemeral=True, delete_after=msg_fade2)
-    
-    if phase == Phase.PLAY:
-        await update_waiting_room_message()
-    else:
-        await update_queue_message()
-    try_save_pug() # save state automatically
-    log_async_end('handle_queue_join')
-    
-# Function to handle when a user clicks a leave button for queue or waiting room
-async def handle_queue_leave(interaction: discord.Interaction):
-    log_async_start('handle_queue_leave')
-    user = interaction.user
-    if current_match and user in current_match.re_queue:
-        current_match.re_queue.remove(user)
-        await interaction.response.send_message(f'{user.mention} will not re-queue!', ephemeral=True, delete_after=msg_fade2)
-    elif user in waiting_room:
-        if phase == Phase.READY and user in standby:
-            await interaction.response.send_message('You cannot leave the queue while on Standby.', ephemeral=True, delete_after=msg_fade1)
-            log_async_end('handle_queue_leave')
-            return
-        waiting_room.remove(user)
-        await interaction.response.send_message(f'{user.mention} left the waiting room!', ephemeral=True, delete_after=msg_fade2)
-    elif user in queue:
-        if phase > Phase.READY: # if past the ready phase, player is already set to NOT re-queues:
-            await interaction.response.send_message('You already will not re-queue.', ephemeral=True, delete_after=msg_fade1)
-            return
-        if phase == Phase.READY:
-            await interaction.response.send_message('You cannot leave the queue during Ready Up.', ephemeral=True, delete_after=msg_fade1)
-            return
-        queue.remove(user)
-        await interaction.response.send_message(f'{user.mention} left the queue.', ephemeral=True, delete_after=msg_fade2)
-    else:
-        await interaction.response.send_message('You are not in the queue.', ephemeral=True, delete_after=msg_fade1)
-        log_async_end('handle_queue_leave')
-        return
-    
-    if phase >= Phase.PLAY:
-        await update_waiting_room_message()
-    else:
-        await update_queue_message()
-    try_save_pug() # save state automatically
-    log_async_end('handle_queue_leave')
+
+# View for the buttons to page through the waiting room list, shown to one player
+class WaitingRoomListView(PugView):
+    def __init__(self, session: PugSession):
+        super().__init__(timeout=list_page_timeout)
+        self.session = session
+        self.page = 0
+
+    # gets the embed of the current page, moving to the last page if the waiting room got shorter
+    def page_embed(self):
+        self.page = min(self.page, self.session.num_waiting_room_pages() - 1)
+        self.previous_page.disabled = self.page == 0
+        self.next_page.disabled = self.page == self.session.num_waiting_room_pages() - 1
+        return self.session.waiting_room_list_embed(self.page)
+
+    @discord.ui.button(label='Previous', style=discord.ButtonStyle.grey)
+    @async_span
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page = max(0, self.page - 1)
+        await interaction.response.edit_message(embed=self.page_embed(), view=self)
+
+    @discord.ui.button(label='Next', style=discord.ButtonStyle.grey)
+    @async_span
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page += 1
+        await interaction.response.edit_message(embed=self.page_embed(), view=self)
 
 # Replies to a user with a match history message
+@async_span
 async def reply_with_match_history(interaction: discord.Interaction):
-    log_async_start('reply_with_match_history')
-    msg = match_history_block(interaction.user)
+    msg = await match_history_msg(interaction.user)
     await interaction.response.send_message(msg, ephemeral=True, delete_after=msg_fade2)
-    log_async_end('reply_with_match_history')
    
 # Replies to a user with a help message
+@async_span
 async def reply_with_help(interaction: discord.Interaction):
-    log_async_start('reply_with_help')
     msg = f' Commands\n{command_help_block()}'
     await interaction.response.send_message(msg, ephemeral=True)
-    log_async_end('reply_with_help')
-
-# Function to get the total number of players in queue + waiting room
-def total_queue_size():
-    if current_match and phase >= Phase.PLAY:
-        return len(waiting_room) + len(current_match.re_queue)
-    return len(queue) + len(waiting_room)
-
-# Function to update the queue message (editing the original message)
-async def update_queue_message():
-    log_async_start('update_queue_message')
-    global queue_message
-    embed = queue_embed()
-
-    if queue_message:
-        if phase >= Phase.PLAY:
-            await queue_message.edit(embed=embed, view=None)  # Remove the buttons once the match is in progress
-        else:
-            await queue_message.edit(embed=embed)
-    else:
-        queue_message = await bot.get_channel(queue_message.channel.id).send(embed=embed, view=QueueView())
-
-    # If we have the required number of players, move to ready check
-    if phase == Phase.QUEUE:
-        await check_full_queue()
-    log_async_end('update_queue_message')
-
-# Function that checks if we have the required number of players, and if so moves to ready check
-async def check_full_queue():
-    log_async_start('check_full_queue')
-    global game_in_progress
-    if len(queue) == queue_size_required and not game_in_progress:
-        game_in_progress = True
-        await start_ready_check(queue_message.channel)
-    log_async_end('check_full_queue')
-
-# Function to start the ready check
-async def start_ready_check(channel):
-    log_async_start('start_ready_check')
-    global phase, queue_sorted, ready_players, bailouts_unc, bailouts, standby, ready_start, ready_end, ready_up_task
-    phase = Phase.READY
-    ready_players = set()
-    bailouts_unc = []
-    bailouts = []
-    standby = []  
-
-    # Gather all player mentions
-    mentions = ' '.join([user.mention for user in queue])
-
-    # Send a message pinging all players that the queue has popped
-    await channel.send(f"The queue is full with {len(queue)} players! {mentions} please ready up!")
-
-    # Send a DM to each player in the queue with a random message
-    for user in queue:
+
+# View for the ready up button
+class ReadyUpView(PugView):
+    def __init__(self, session: PugSession):
+        super().__init__(timeout=None)  # No timeout here, handled by the ready up timer
+        self.session = session
+        scope_custom_ids(self, f'pug:{session.channel_id}:{session.match_number}')
+
+    @discord.ui.button(label='Ready Up / Standby', style=discord.ButtonStyle.green, custom_id='ready_up')
+    @async_span
+    async def ready_up(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.session.run_action(self.session.handle_ready_up, interaction)
+            
+    @discord.ui.button(label='Bail Out', style=discord.ButtonStyle.red, custom_id='bail_out')
+    @async_span
+    async def bail_out(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.session.run_action(self.session.handle_bail_out, interaction)
+
+# Sends a ready up DM with a random message to a user, retrying with backoff if discord fails
+async def send_ready_dm(user):
+    for attempt in range(ready_dm_retries + 1):
         try:
             random_message = random.choice(ready_dm_messages)  # Select a random message
             await user.send(random_message)
+            return DmResult.SENT
         except discord.Forbidden:
             log_msg(LogLevel.WARNING, f'Could not DM {user} due to privacy settings.')
-
-    # create sorted queue
-    queue_sorted = list(queue)
-    queue_sorted.sort(key=user_sort_key)
-
-    # Get start and end times
-    ready_start = datetime.now(timezone.utc)
-    ready_end = ready_start + timedelta(seconds=ready_up_time)
-
-    # Start the ready-up process and display the message
-    await display_ready_up(channel)
-
-    # Start the ready-up timer task
-    ready_up_timed_out = False
-    ready_up_task = asyncio.create_task(countdown_ready_up(channel))
-    log_async_end('start_ready_check')
-
-# Function to display the ready-up message
-async def display_ready_up(channel):
-    log_async_start('display_ready_up')
-    global ready_message
-    embed = ready_up_embed()
-
-    # Send the ready-up message and store its reference
-    if ready_message:
-        await ready_message.edit(embed=embed)
-    else:
-        ready_message = await channel.send(embed=embed, view=ReadyUpView())
-    log_async_end('display_ready_up')
-
-# Function to update the ready-up message (players and timer)
-async def update_ready_up_message():
-    log_async_start('update_ready_up_message')
-    if ready_message:
-        embed = ready_up_embed()
-        await ready_message.edit(embed=embed)
-    log_async_end('update_ready_up_message')
+            return DmResult.BLOCKED
+        except discord.HTTPException as e:
+            log_msg(LogLevel.WARNING, f'Failed to DM {user} (attempt {attempt + 1}/{ready_dm_retries + 1}): {e}')
+            if attempt < ready_dm_retries:
+                await asyncio.sleep(ready_dm_backoff * 2 ** attempt)
+    return DmResult.FAILED
 
 # Gets a killstreak string for the number of non-ready players
 def queue_killstreak_str(num):
@@ -1013,190 +3107,8 @@ def queue_killstreak_str(num):
         return f'***{queue_kill_comments[num]}*** {"💀" * num}'
     return f'Not all players were ready.'
 
-# Countdown timer for the ready-up phase
-async def countdown_ready_up(channel):
-    log_async_start('countdown_ready_up')
-    global ready_up_timed_out
-    #  Wait the full duration, since we now have a timestamp that counts down automatically
-    await asyncio.sleep(ready_up_time)
-    # Timeout reached: proceed with ready players or reset queue
-    ready_up_timed_out = True
-    await end_ready_up(channel)
-    log_async_end('countdown_ready_up')
-
-# Ends a ready up phase, called when either the timer runs out or all players have readied/bailed
-async def end_ready_up(channel):
-    log_async_start('end_ready_up')
-    global phase, queue, waiting_room, game_in_progress, queue_message, ready_players, all_ready_sent, ready_message
-    if phase != Phase.READY or all_ready_sent:
-        log_async_end('end_ready_up')
-        return
-    all_ready_sent = True
-        
-    non_ready_players = [user for user in queue if user not in ready_players]
-    num_ready = len(ready_players)
-    num_non_ready = len(non_ready_players)
-    # remove non-ready players from queue
-    queue = [user for user in queue if user in ready_players]
-    
-    # If enough on standby to fill queue
-    if len(standby) >= num_non_ready:
-        if num_non_ready > 0:
-            fills = standby[:num_non_ready]
-            mentions = ' '.join([user.mention for user in fills])
-            # move users from standby to queue
-            queue.extend(fills)
-            ready_players = set(queue)
-            # remove queued players from waiting room
-            waiting_room = [user for user in waiting_room if user not in queue]
-            await channel.send(f"Standby players have joined the match: {mentions}.  Thank you for filling in!")
-        await proceed_to_match_setup(channel)
-        log_async_end('end_ready_up')
-        return
-    
-    # Ready up failed, move users from waiting room to queue
-    queue.extend(waiting_room[:num_non_ready])
-    del waiting_room[:num_non_ready]
-    ready_players.clear()  # Clear the ready players set for the next ready check
-    bailouts_unc.clear()
-    bailouts.clear()
-    standby.clear()
-    # Start new queue to trigger a new ready check
-    phase = Phase.QUEUE
-    game_in_progress = False
-    all_ready_sent = False
-    await channel.send(f"{queue_killstreak_str(num_non_ready)} Re-queuing {num_ready} ready players.")
-    ready_message = await remove_message(ready_message)
-    queue_message = await remove_message(queue_message)
-    await start_new_queue(channel)  # Post a new queue message with ready players
-    log_async_end('end_ready_up')
-
-# gets a string with the queue icon and display name of a user in the queue
-def queue_icon_name(user):
-    if user in ready_players:
-        return f'✅ {get_display_name(user)}'
-    if user in bailouts:
-        return f'❌ {get_display_name(user)}'
-    return f'⌛ {get_display_name(user)}'
-
-# Function to make the ready up embed
-def ready_up_embed():
-    queue_names = '\n'.join([queue_icon_name(user) for user in queue_sorted])
-
-    embed = discord.Embed(title='Match Found!',
-                          description='Please ready up!  Players in the waiting room can standby to fill.',
-                          color=discord.Color.green())
-    embed.add_field(name=f'Match Players ({len(ready_players)}/{queue_size_required})', value=queue_names, inline=True)
-    if standby:
-        standby_names = '\n'.join([get_display_name(user) for user in standby]) or '\u200b'
-        embed.add_field(name=f'On Standby ({len(standby)}/{queue_size_required - len(ready_players)})', value=standby_names, inline=True)
-    embed.add_field(name='\u200b', value=f'-# Expires: <t:{datetime_to_int(ready_end)}:R>', inline=False)
-    return embed
-
-# View for the ready up button
-class ReadyUpView(View):
-    def __init__(self):
-        super().__init__(timeout=None)  # No timeout here, handled by countdown
-
-    @discord.ui.button(label='Ready Up / Standby', style=discord.ButtonStyle.green)
-    async def ready_up(self, interaction: discord.Interaction, button: discord.ui.Button):
-        log_async_start('ready_up')
-        global standby, all_ready_sent
-        user = interaction.user
-        if user in queue:
-            if user in ready_players:
-                await interaction.response.send_message('You are already ready.', ephemeral=True, delete_after=msg_fade1)
-                return
-            if user in bailouts:
-                await interaction.response.send_message('Cannot ready after clicking bail out.', ephemeral=True, delete_after=msg_fade1)
-                return
-            
-            if user in bailouts_unc:
-                bailouts_unc.remove(user)
-            ready_players.add(user)
-            await interaction.response.send_message(f'{user.mention} is ready!', ephemeral=True, delete_after=ready_up_time)
-            await update_ready_up_message()  # Update the ready-up message with new players
-            await check_ready_complete(interaction.message.channel)
-        else:
-            if user in standby:
-                await interaction.response.send_message('You are already on standby.', ephemeral=True, delete_after=msg_fade1)
-                return
-            if user not in waiting_room:
-                waiting_room.append(user)
-                await update_queue_message()
-            # add user to standby list and order standby list by waiting room
-            standby.append(user)
-            standby = [user for user in waiting_room if user in standby]
-            await interaction.response.send_message(f'{user.mention} is on standby!', ephemeral=True, delete_after=ready_up_time)
-            await update_ready_up_message()
-            await check_ready_complete(interaction.message.channel)
-        log_async_end('ready_up')
-            
-    @discord.ui.button(label='Bail Out', style=discord.ButtonStyle.red)
-    async def bail_out(self, interaction: discord.Interaction, button: discord.ui.Button):
-        log_async_start('bail_out')
-        user = interaction.user
-        if user in ready_players or user in standby:
-            await interaction.response.send_message('Cannot bail out after clicking ready.', ephemeral=True, delete_after=msg_fade1)
-        elif user in queue:
-            if user not in bailouts_unc:
-                bailouts_unc.append(user)
-                await interaction.response.send_message('Are you sure you want to bail out?  Click again to confirm.', ephemeral=True, delete_after=ready_up_time)
-            else:
-                bailouts_unc.remove(user)
-                bailouts.append(user)
-                await interaction.response.send_message(f'{user.mention} is bailing out!', ephemeral=True, delete_after=ready_up_time)
-                await update_ready_up_message()
-                await check_ready_complete(interaction.message.channel)
-        else:
-            await interaction.response.send_message('You are not in the queue.', ephemeral=True, delete_after=msg_fade1)
-        log_async_end('bail_out')
-
-# checks if enough players have readied for the queue to go through
-async def check_ready_complete(channel):
-    log_async_start('check_ready_complete')
-    num_non_ready = queue_size_required - len(ready_players)
-    if num_non_ready == 0:  # if all users are ready
-        await end_ready_up(channel)
-        return
-    # if all non-ready are bailing out, make sure that there are enough
-    # players on standby and that they are all at the top of the waiting room
-    if (num_non_ready == len(bailouts) and
-        len(standby) >= num_non_ready and
-        standby[:num_non_ready] == waiting_room[:num_non_ready]):  
-        await end_ready_up(channel)
-    log_async_end('check_ready_complete')
-
-# proceeds to match setup
-async def proceed_to_match_setup(channel):
-    log_async_start('proceed_to_match_setup')
-    global phase, current_match, queue_message, ready_message, ready_up_task
-    phase = Phase.MAP
-    # Cancel the ready-up task to prevent it from running after this point
-    if not ready_up_timed_out and ready_up_task is not None:
-        ready_up_task.cancel()
-        ready_up_task = None
-
-    ready_message = await remove_message(ready_message)
-    queue_message = await remove_message(queue_message)
-    # create match
-    new_match = PugMatch(match_number, queue)
-    matches[match_number] = new_match
-    current_match = new_match
-    new_match.update_re_queue() # update requeue order
-    # remove old matches
-    if len(matches) > max_matches_in_memory:
-        min_match_number = min(matches)
-        del matches[min_match_number]
-    # Send a completely new queue message instead of editing the old one
-    embed = queue_embed()
-    queue_message = await channel.send(embed=embed, view=QueueView())
-    
-    await new_match.proceed_to_map_voting(channel)
-    log_async_end('proceed_to_match_setup')
-
 # Class for map voting
-class MapVotingView(View):
+class MapVotingView(PugView):
     def __init__(self, match: PugMatch):
         super().__init__(timeout=None)
         self.match = match
@@ -1204,218 +3116,204 @@ class MapVotingView(View):
             button = Button(label=str(game_map), style=discord.ButtonStyle.primary, custom_id=game_map.name)
             button.callback = self.make_callback(game_map)
             self.add_item(button)
+        scope_custom_ids(self, f'pug:{match.session.channel_id}:{match.match_number}')
 
     def make_callback(self, game_map):
         async def callback(interaction: discord.Interaction):
-            await self.match.register_map_vote(interaction, game_map)
+            await self.match.session.run_action(self.match.register_map_vote, interaction, game_map)
         return callback
 
 # View for voting on matchups
-class MatchupVotingView(View):
+class MatchupVotingView(PugView):
     def __init__(self, match: PugMatch):
         super().__init__(timeout=None)  # No timeout
         self.match = match
+        scope_custom_ids(self, f'pug:{match.session.channel_id}:{match.match_number}')
 
     @discord.ui.button(label='Matchup 1', style=discord.ButtonStyle.primary, custom_id='vote_1')
+    @async_span
     async def vote_1(self, interaction: discord.Interaction, button: discord.ui.Button):
-        log_async_start('vote_1')
-        await self.match.register_matchup_vote(interaction, 1)
-        log_async_end('vote_1')
+        await self.match.session.run_action(self.match.register_matchup_vote, interaction, 1)
 
     @discord.ui.button(label='Matchup 2', style=discord.ButtonStyle.primary, custom_id='vote_2')
+    @async_span
     async def vote_2(self, interaction: discord.Interaction, button: discord.ui.Button):
-        log_async_start('vote_2')
-        await self.match.register_matchup_vote(interaction, 2)
-        log_async_end('vote_2')
+        await self.match.session.run_action(self.match.register_matchup_vote, interaction, 2)
 
     @discord.ui.button(label='Matchup 3', style=discord.ButtonStyle.primary, custom_id='vote_3')
+    @async_span
     async def vote_3(self, interaction: discord.Interaction, button: discord.ui.Button):
-        log_async_start('vote_3')
-        await self.match.register_matchup_vote(interaction, 3)
-        log_async_end('vote_3')
+        await self.match.session.run_action(self.match.register_matchup_vote, interaction, 3)
 
     @discord.ui.button(label='Re-roll 🎲', style=discord.ButtonStyle.secondary, custom_id='vote_reroll')
+    @async_span
     async def vote_reroll(self, interaction: discord.Interaction, button: discord.ui.Button):
-        log_async_start('vote_reroll')
-        await self.match.register_matchup_vote(interaction, reroll_key)
-        log_async_end('vote_reroll')
+        await self.match.session.run_action(self.match.register_matchup_vote, interaction, reroll_key)
     
     @discord.ui.button(label='Custom', style=discord.ButtonStyle.secondary, custom_id='vote_custom')
+    @async_span
     async def vote_custom(self, interaction: discord.Interaction, button: discord.ui.Button):
-        log_async_start('vote_custom')
-        await self.match.register_matchup_vote(interaction, custom_teams_key)
-        log_async_end('vote_custom')
+        await self.match.session.run_action(self.match.register_matchup_vote, interaction, custom_teams_key)
 
 
 
 
 # View for reporting the final result of a match and resetting the queue
-class FinalMatchupView(View):
+class FinalMatchupView(PugView):
     def __init__(self, match: PugMatch):
         super().__init__(timeout=None)
         self.match = match
+        scope_custom_ids(self, f'pug:{match.session.channel_id}:{match.match_number}')
  
-    @discord.ui.button(label='Match Complete', style=discord.ButtonStyle.red)
+    @discord.ui.button(label='Match Complete', style=discord.ButtonStyle.red, custom_id='match_complete')
+    @async_span
     async def complete_match(self, interaction: discord.Interaction, button: discord.ui.Button):
-        log_async_start('complete_match')
-        await self.match.register_reset_vote(interaction)
-        log_async_end('complete_match')
-
-# Create a waiting room for players not in the Final Matchup
-async def create_waiting_room(channel):
-   log_async_start('create_waiting_room')
-   global waiting_room_message
-   embed = waiting_room_embed()
-   if waiting_room_message:
-       await waiting_room_message.edit(embed=embed)
-   else:
-       waiting_room_message = await channel.send(embed=embed, view=QueueView())
-   log_async_end('create_waiting_room')
-
-# Function to update the waiting room message
-async def update_waiting_room_message():
-   log_async_start('update_waiting_room_message')
-   if waiting_room_message:
-       embed = waiting_room_embed()
-       await waiting_room_message.edit(embed=embed)
-   log_async_end('update_waiting_room_message')
-
-# Function to make the waiting room embed
-def waiting_room_embed():
-    waiting_room_names = ', '.join(
-        [get_display_name(user) for user in waiting_room]) or 'No players in waiting room.'
-    votes_str = ''
-    if current_match and current_match.reset_queue_votes > 0:
-        votes_str = f' ({current_match.reset_queue_votes}/{reset_queue_votes_required} votes)'
-    embed = discord.Embed(
-        title="PUGs Queue",
-        description=f'Waiting for match to complete.{votes_str}',
-        color=discord.Color.purple()
-    )
-    embed.add_field(name=f'Waiting Room ({len(waiting_room)})', value=waiting_room_names, inline=False)
-    if current_match and current_match.re_queue:
-        re_queue_names = ', '.join([get_display_name(user) for user in current_match.re_queue])
-        embed.add_field(name=f'Re-Queueing ({len(current_match.re_queue)})', value=re_queue_names, inline=False)
-    return embed
-
-
-# restart queue after match is complete
-async def restart_queue(channel):
-    log_async_start('restart_queue')
-    global phase, match_number, current_match
-    phase = Phase.RESET
-    results_match.phase = Phase.RESET
-    results_match.update_end_time()
-    await update_queue_message()  # final update of old queue message
-    await results_match.update_final_matchup()  # final update of final matchup message
-    # reset queue state
-    reset_game()
-    add_waiting_room_players_to_queue()  # Now add waiting room players to the empty queue
-    match_number += 1  # increment match number
-    current_match = None
-    await start_new_queue(channel)  # Start a new queue with waiting room players
-    log_async_end('restart_queue')
-
-
-# Add waiting room players to the new queue
-def add_waiting_room_players_to_queue():
-    global queue, waiting_room
-    if current_match: # Move all players from requeue into waiting room
-        non_duplicates = [user for user in current_match.re_queue if user not in waiting_room]
-        waiting_room.extend(non_duplicates)
-    # Move players out of the waiting room until queue is full or waiting room is empty
-    queue[:] = waiting_room[:queue_size_required]  
-    waiting_room[:] = waiting_room[queue_size_required:]
-
-# Start a new queue programmatically without needing the command context
-async def start_new_queue(channel):
-   log_async_start('start_new_queue')
-   global phase, queue_message, waiting_room_message
-   phase = Phase.QUEUE
-   # Send a completely new queue message instead of editing the old one
-   embed = queue_embed()
-   queue_message = await channel.send(embed=embed, view=QueueView())
-   waiting_room_message = await remove_message(waiting_room_message)
-   try_save_pug() # save state automatically
-   await check_full_queue()
-   log_async_end('start_new_queue')
+        await self.match.session.run_action(self.match.register_reset_vote, interaction)
    
+# Sends an ephemeral reply to an interaction in the background, so the session actor can apply the next state change without waiting on discord
+def send_reply(interaction: discord.Interaction, msg, delete_after=None):
+    run_in_background(reply_to_interaction(interaction, msg, delete_after))
+
+# Replies to a click with an ephemeral message, as a followup if the click was deferred while it waited
+async def reply_to_interaction(interaction: discord.Interaction, msg, delete_after=None):
+    if await wait_for_defer(interaction):
+        await interaction.followup.send(msg, ephemeral=True)
+    else:
+        await interaction.response.send_message(msg, ephemeral=True, delete_after=delete_after)
+
+# Defers a click that has waited too long for its state change, so discord does not show it as failed
+def defer_waiting_interaction(interaction: discord.Interaction, future):
+    if not future.done() and not interaction.response.is_done() and not interaction.extras.get('answering'):
+        interaction.extras['defer_task'] = run_in_background(interaction.response.defer())
+
+# Waits for a click to be deferred if it is being deferred, returns True if it was, so it has to be answered with a followup
+async def wait_for_defer(interaction: discord.Interaction):
+    if not isinstance(interaction, discord.Interaction):
+        return False
+    interaction.extras['answering'] = True  # the click is answered now, so it must not be deferred after this
+    task = interaction.extras.get('defer_task')
+    if task:
+        await asyncio.wait([task])  # a failed defer is logged by run_in_background
+    return task is not None and interaction.response.is_done()
+
+# Runs a coroutine in a task that is not awaited, keeping a reference until it is done and logging any failure
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(on_background_task_done)
+    return task
+
+# Forgets a finished background task and logs its failure
+def on_background_task_done(task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        log_msg(LogLevel.ERROR, 'Background task failed: %s', task.exception())
+
 # Function to remove the given message (message = await remove_message(message))
+@async_span
 async def remove_message(message: discord.Message):
-   log_async_start('remove_message')
    if message:
+       edit_scheduler.cancel(message)  # no point editing a message that is being deleted
        try:
            await message.delete()
        except discord.NotFound:
            log_msg(LogLevel.WARNING, 'Message was already deleted')
-   log_async_end('remove_message')
+       except discord.HTTPException as e:  # deletes run alongside other calls of a phase transition, so don't fail them
+           log_msg(LogLevel.ERROR, f'Failed to delete message {message.id}: {e}')
    return None
 
-# initializes bot after first login
-async def init_on_first_login():
-    log_async_start('init_on_first_login')
-    global phase, queue, queue_message
-    # load saved data if it exists
-    if os.path.isfile(save_file_path):
-        queue = []
-        try:
-            with open(save_file_path, 'r') as save_file:
-                load_pug(None, save_file)
-                log_msg(LogLevel.NONE, f'PUG loaded on match #{match_number} with {total_queue_size()} players in queue')
-        except:
-            log_msg(LogLevel.ERROR, f'Failed to load saved PUG: {save_file_path}') 
-            queue = []
-            log_async_end('init_on_first_login')
-            return
-        if queue_channel_id == 0: # if no channel id stored, do not start queue
-            log_msg(LogLevel.WARNING, f'No queue channel found in loaded pug')
-            return
-        log_msg(LogLevel.NONE, f'Automatically starting queue')
-        phase = Phase.QUEUE
-        channel = bot.get_channel(queue_channel_id)
-        # send queue message
-        embed = queue_embed()
-        queue_message = await channel.send(embed=embed, view=QueueView())
-        # If we have the required number of players, move to ready check
-        await check_full_queue()
-    log_async_end('init_on_first_login')
+# Function to remove several messages at the same time, the deletes do not depend on each other
+async def remove_messages(*messages):
+    await asyncio.gather(*[remove_message(message) for message in messages])
 
-# attempts to save the pug state to a file
-def try_save_pug():
+# Function to run coroutines one after another, for discord calls whose order matters (results = await run_in_order(*coros))
+async def run_in_order(*coros):
+    results = []
+    pending = list(coros)
     try:
-        with open(save_file_path, 'w') as save_file:
-            save_pug(save_file)
-        log_msg(LogLevel.NONE, f'PUG saved on match #{match_number} with {total_queue_size()} players in queue') 
-    except:
-        log_msg(LogLevel.ERROR, 'Error saving PUG data') 
-        return False
-    return True
-
-# function to save the current PUG state to a file    
-def save_pug(file):
-    file.write(f'match\n')
-    if phase >= Phase.PLAY: # if final matchup has been posted, save the next match number
-        file.write(f'{match_number + 1}\n')
-    else:
-        file.write(f'{match_number}\n')
-    file.write(f'channel\n')
-    file.write(f'{queue_channel_id}\n')
-    file.write(f'players\n')
-    if phase < Phase.PLAY and queue:
-        file.write('\n'.join(str(user.id) for user in queue))
-        file.write('\n')
-    if waiting_room:
-        file.write('\n'.join(str(user.id) for user in waiting_room))
-        file.write('\n')
-    if phase >= Phase.PLAY and current_match and current_match.re_queue:
-        file.write('\n'.join(str(user.id) for user in current_match.re_queue))
-        file.write('\n')
-        
-# function to load the PUG state from a file    
-def load_pug(guild, file):
-    global match_number, queue_channel_id
+        while pending:
+            results.append(await pending.pop(0))
+    finally:
+        for coro in pending:  # an earlier call failed, so the later ones never run
+            coro.close()
+    return results
+
+class PugJournal():  # append-only journal of PUG events, written to disk from a background thread
+    def __init__(self, snapshot_path, journal_path, compact_events):
+        self.snapshot_path = snapshot_path  # save file that the journal is compacted into
+        self.journal_path = journal_path  # journal file that events are appended to
+        self.compact_events = compact_events  # number of events before the journal is compacted
+        self.seq = 0  # sequence number of the last recorded event
+        self.num_since_compact = 0  # number of events recorded since the last compaction
+        self.writes = SimpleQueue()  # writes waiting for the background thread
+        self.thread = None
+
+    # queues a write for the background thread, starting it if needed
+    def put(self, kind, data):
+        if not self.thread:
+            self.thread = threading.Thread(target=self.run_writer, name='pug_journal', daemon=True)
+            self.thread.start()
+        self.writes.put((kind, data))
+
+    # records an event, returns True if the journal should be compacted
+    def record(self, event_type, **data):
+        self.seq += 1
+        self.num_since_compact += 1
+        self.put('event', json.dumps({'e': event_type, 'seq': self.seq, **data}))
+        return self.num_since_compact >= self.compact_events
+
+    # replaces the save file with the given state and clears the journal, the state is serialized by the background thread
+    def compact(self, state):
+        self.num_since_compact = 0
+        self.put('snapshot', state)
+
+    # waits for all queued writes to finish and stops the background thread
+    def close(self):
+        if self.thread:
+            self.put('stop', None)
+            self.thread.join()
+            self.thread = None
+
+    # background thread loop that performs all journal disk I/O
+    def run_writer(self):
+        journal_file = open(self.journal_path, 'a')
+        while True:
+            kind, data = self.writes.get()
+            try:
+                match kind:
+                    case 'event':
+                        journal_file.write(f'{data}\n')
+                        if self.writes.empty():  # flush once per burst of events
+                            journal_file.flush()
+                    case 'snapshot':
+                        # write to a temp file and atomically replace, so a crash never leaves a partial save file
+                        temp_path = f'{self.snapshot_path}.tmp'
+                        with open(temp_path, 'w') as temp_file:
+                            json.dump(data, temp_file)
+                            temp_file.flush()
+                            os.fsync(temp_file.fileno())
+                        os.replace(temp_path, self.snapshot_path)
+                        # events up to the snapshot seq are skipped on replay, so truncating after the replace is safe
+                        journal_file.close()
+                        journal_file = open(self.journal_path, 'w')
+                        log_msg(LogLevel.VERBOSE, 'PUG journal compacted into %s', self.snapshot_path)
+                    case 'stop':
+                        break
+            except (OSError, TypeError, ValueError) as e:  # TypeError and ValueError are from serializing a snapshot
+                log_msg(LogLevel.ERROR, f'Error writing PUG journal: {e}')
+        journal_file.close()
+
+# reads the PUG state from a save file into a dict
+def read_pug_state(file, match_number=1):
+    text = file.read()
+    if text.lstrip().startswith('{'):  # JSON save file
+        state = json.loads(text)
+        if state['version'] > pug_snapshot_version:
+            raise ValueError(f'Save file version {state["version"]} is newer than the supported version {pug_snapshot_version}')
+        return state
+    state = {'match': match_number, 'channel': 0, 'seq': 0, 'players': [], 'waiting': [], 'requeue': []}
     line_type = 'match' # backwards compatibility with file that is match number followed by players
-    for id_line in file:
+    for id_line in text.splitlines():
         id_line_strip = id_line.strip()
         if not id_line_strip.isdecimal(): # non-number is line type
             if (len(id_line_strip) > 0):
@@ -1423,64 +3321,406 @@ def load_pug(guild, file):
             continue
         num = int(id_line_strip)
         match line_type:
-            case 'match':
-                match_number = num
-                line_type = 'players' # backwards compatibility with file that is match number followed by players
-            case 'channel':
-                queue_channel_id = num
-                if not guild: # if not coming from a !pug_start command, get the saved channel's guild
-                    guild = bot.get_channel(queue_channel_id).guild
-            case 'players':
-                user = guild.get_member(num) # num is user id
-                if user:
-                    if len(queue) < queue_size_required:
-                        if user not in queue:
-                            queue.append(user)
-                    else:
-                        if user not in waiting_room:
-                            waiting_room.append(user)
-                else:
-                    log_msg(LogLevel.WARNING, f'user not found: id={num}')
-
-# gets a message with commands to join a server game
-def server_commands_msg(address, port):
-    cmd1 = f'`open {address}:{port}?team=0` (TEAM 1)'
-    cmd2 = f'`open {address}:{port}?team=1` (TEAM 2)'
-    msg_lines = [cmd1]
-    if current_match and current_match.final_team1_names:
-        msg_lines.append(current_match.final_team1_names)
-        msg_lines.append('')
-    msg_lines.append(cmd2)
-    if current_match and current_match.final_team2_names:
-        msg_lines.append(current_match.final_team2_names)
-    return '\n'.join(msg_lines)
-
-# gets a message with commands to join an anhur server game
-def anhur_commands_msg(port):
-    return server_commands_msg('anhur.servegame.com', port)
-
-# gets a message with commands to join a floof server game
-def floof_commands_msg(port):
-    return server_commands_msg('floof.servegame.com', port)
-
-# gets a message with commands to join a syco server game
-def syco_commands_msg(port):
-    return server_commands_msg('syco.servegame.com', port)
-
-# gets a message with commands to join a custom server game
-def custom_server_commands_msg(port):
-    return server_commands_msg(custom_server_address, port)
-
-# gets a block of text to explain how to search a user's match history
-def match_history_block(user):
-    username = user.name
-    botname = str(bot.user)
-    return f'''Copy this into the search bar to view your match history:
-`pug_mh from: {botname} mentions: {username}`
-- this tracks your discord account, so changing your nickname or in-game name is still ok
-- add a map name to the search string to only view games on that map
-- add `before:` `during:` or `after:` to search a sepcific date range
-- add a match number to the search string to view that exact match number'''
+            case 'match' | 'channel' | 'seq':
+                state[line_type] = num
+                if line_type == 'match':
+                    line_type = 'players' # backwards compatibility with file that is match number followed by players
+            case 'players' | 'waiting' | 'requeue':
+                state[line_type].append(num)
+    return state
+
+# replays journal events recorded after the save file was written on top of the PUG state
+def replay_pug_journal(state, file):
+    for event_line in file:
+        try:
+            event = json.loads(event_line)
+        except ValueError:  # partial line from a crash mid-write
+            log_msg(LogLevel.WARNING, 'Skipping unreadable PUG journal line')
+            continue
+        if event['seq'] <= state['seq']:  # already included in the save file
+            continue
+        state['seq'] = event['seq']
+        match event['e']:
+            case 'join':
+                if event['id'] not in state[event['to']]:
+                    state[event['to']].append(event['id'])
+            case 'leave':
+                if event['id'] in state[event['section']]:
+                    state[event['section']].remove(event['id'])
+            case 'phase':
+                for key in ('match', 'channel', 'players', 'waiting', 'requeue'):
+                    state[key] = event[key]
+                state['session'] = None  # the saved session is from before this phase, so only the queue can be resumed
+            # 'result' events are a record of match results, they do not change the queue
+
+class MatchHistoryStore():  # SQLite database of finished matches, indexed for per-player lookups
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+        self.lock = threading.Lock()  # the connection is used from worker threads, one at a time
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='match_history')  # saves matches one at a time in the order they were queued
+        self.pending_saves = set()  # futures of queued saves that are not done yet
+
+    # opens the database and creates the tables if needed
+    def connect(self):
+        if not self.connection:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.row_factory = sqlite3.Row
+            self.connection.execute('PRAGMA journal_mode=WAL')  # readers don't block the writer
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.executescript('''
+                CREATE TABLE IF NOT EXISTS matches (
+                    channel_id INTEGER NOT NULL,
+                    match_number INTEGER NOT NULL,
+                    map TEXT,
+                    wound_score INTEGER NOT NULL DEFAULT 0,
+                    start_time INTEGER,
+                    end_time INTEGER,
+                    team1_names TEXT,
+                    team2_names TEXT,
+                    scoreboard_filename TEXT,
+                    PRIMARY KEY (channel_id, match_number));
+                CREATE TABLE IF NOT EXISTS match_players (
+                    channel_id INTEGER NOT NULL,
+                    match_number INTEGER NOT NULL,
+                    player_id INTEGER NOT NULL,
+                    team INTEGER NOT NULL,
+                    PRIMARY KEY (channel_id, match_number, player_id));
+                CREATE TABLE IF NOT EXISTS rating_changes (
+                    channel_id INTEGER NOT NULL,
+                    match_number INTEGER NOT NULL,
+                    player_id INTEGER NOT NULL,
+                    change REAL NOT NULL,
+                    PRIMARY KEY (channel_id, match_number, player_id));
+                CREATE INDEX IF NOT EXISTS match_players_by_player ON match_players (player_id);
+                CREATE INDEX IF NOT EXISTS matches_by_map ON matches (map, end_time);
+                CREATE INDEX IF NOT EXISTS matches_by_end_time ON matches (end_time);
+            ''')
+        return self.connection
+
+    # adds or replaces a match and its players
+    def save_match(self, row):
+        try:
+            with self.lock:
+                connection = self.connect()
+                with connection:  # one transaction
+                    connection.execute('''INSERT OR REPLACE INTO matches VALUES (
+                        :channel_id, :match_number, :map, :wound_score, :start_time, :end_time,
+                        :team1_names, :team2_names, :scoreboard_filename)''', row)
+                    connection.execute('DELETE FROM match_players WHERE channel_id = ? AND match_number = ?',
+                                       (row['channel_id'], row['match_number']))
+                    connection.executemany('INSERT INTO match_players VALUES (?, ?, ?, ?)',
+                                           [(row['channel_id'], row['match_number'], player_id, team)
+                                            for player_id, team in row['players']])
+                    connection.execute('DELETE FROM rating_changes WHERE channel_id = ? AND match_number = ?',
+                                       (row['channel_id'], row['match_number']))
+                    connection.executemany('INSERT INTO rating_changes VALUES (?, ?, ?, ?)',
+                                           [(row['channel_id'], row['match_number'], player_id, change)
+                                            for player_id, change in row['rating_changes']])
+        except sqlite3.Error as e:
+            log_msg(LogLevel.ERROR, f'Failed to save Match #{row["match_number"]} to match history: {e}')
+
+    # gets the total rating change and number of rated matches of each player
+    def rating_totals(self):
+        try:
+            with self.lock:
+                return self.connect().execute('''SELECT player_id, SUM(change), COUNT(*) FROM rating_changes
+                                                 GROUP BY player_id''').fetchall()
+        except sqlite3.Error as e:
+            log_msg(LogLevel.ERROR, f'Failed to read ratings: {e}')
+            return []
+
+    # replays every match result with replay_ratings and replaces all saved rating changes with the new ones,
+    # returns a dict of the new rating changes of each match ((channel id, match number), dict (user id, change))
+    def recompute_rating_changes(self, replay_ratings):
+        with self.lock:  # hold the lock throughout so that no match is saved in between
+            connection = self.connect()
+            keys = []
+            teams = defaultdict(lambda: ([], []))
+            results = []
+            for row in connection.execute('''SELECT channel_id, match_number, wound_score FROM matches
+                                             WHERE wound_score != 0 AND end_time IS NOT NULL
+                                             ORDER BY end_time, channel_id, match_number'''):
+                keys.append((row['channel_id'], row['match_number']))
+                results.append(row['wound_score'])
+            for row in connection.execute('SELECT channel_id, match_number, player_id, team FROM match_players'):
+                teams[(row['channel_id'], row['match_number'])][row['team'] - 1].append(row['player_id'])
+            match_changes = dict(zip(keys, replay_ratings([(*teams[key], wound_score) for key, wound_score in zip(keys, results)])))
+            with connection:  # one transaction
+                connection.execute('DELETE FROM rating_changes')
+                connection.executemany('INSERT INTO rating_changes VALUES (?, ?, ?, ?)',
+                                       [(channel_id, match_number, player_id, change)
+                                        for (channel_id, match_number), changes in match_changes.items()
+                                        for player_id, change in changes.items()])
+            return match_changes
+
+    # gets the matches of a queue channel that ended after min_end_time (seconds), each with the ids of its players
+    def recent_matches(self, channel_id, min_end_time):
+        try:
+            with self.lock:
+                connection = self.connect()
+                matches = {row['match_number']: dict(row, player_ids=[]) for row in connection.execute(
+                    '''SELECT match_number, wound_score, start_time, end_time FROM matches
+                       WHERE channel_id = ? AND end_time >= ?''', (channel_id, min_end_time))}
+                for row in connection.execute('''SELECT p.match_number, p.player_id FROM match_players p
+                                                 JOIN matches m ON m.channel_id = p.channel_id AND m.match_number = p.match_number
+                                                 WHERE m.channel_id = ? AND m.end_time >= ?''', (channel_id, min_end_time)):
+                    matches[row['match_number']]['player_ids'].append(row['player_id'])
+                return list(matches.values())
+        except sqlite3.Error as e:
+            log_msg(LogLevel.ERROR, f'Failed to read recent matches: {e}')
+            return []
+
+    # gets the most recent matches that a player was in, optionally only on one map
+    def player_matches(self, player_id, map_name=None, limit=10):
+        query = '''SELECT m.*, p.team FROM match_players p
+                   JOIN matches m ON m.channel_id = p.channel_id AND m.match_number = p.match_number
+                   WHERE p.player_id = ?'''
+        params = [player_id]
+        if map_name:
+            query += ' AND m.map = ?'
+            params.append(map_name)
+        query += ' ORDER BY m.end_time DESC LIMIT ?'
+        params.append(limit)
+        try:
+            with self.lock:
+                return [dict(row) for row in self.connect().execute(query, params)]
+        except sqlite3.Error as e:
+            log_msg(LogLevel.ERROR, f'Failed to read match history: {e}')
+            return []
+
+    # queues a save of a match, saves are written in order so a newer result of the same match is never overwritten by an older one
+    def save_later(self, row):
+        future = asyncio.get_running_loop().run_in_executor(self.writer, self.save_match, row)
+        self.pending_saves.add(future)
+        future.add_done_callback(self.pending_saves.discard)
+
+    # waits for the queued saves to be written
+    async def wait_for_saves(self):
+        await asyncio.gather(*list(self.pending_saves), return_exceptions=True)
+
+    # closes the database once the queued saves are written
+    def close(self):
+        self.writer.submit(lambda: None).result()
+        with self.lock:
+            if self.connection:
+                self.connection.close()
+                self.connection = None
+
+match_history = MatchHistoryStore(history_db_path)
+
+# saves a finished match to the match history database from the history writer thread
+def save_match_history(match):
+    match_history.save_later(match.history_row())
+
+class ScoreboardStore():  # scoreboard images on disk, named by the sha256 of their content so the same image is stored once
+    def __init__(self, path):
+        self.path = path  # folder of stored images, downscaled copies are kept in its preview folder
+        self.num_stored = 0  # number of images added to the store
+        self.num_deduplicated = 0  # number of uploaded images that were already stored
+
+    # gets the path of a stored image or of its downscaled copy
+    def file_path(self, filename, preview=False):
+        if preview:
+            return os.path.join(self.path, 'preview', filename)
+        return os.path.join(self.path, filename)
+
+    # streams an attachment to the store a chunk at a time, returns its stored filename or None if it could not be stored
+    # the disk I/O and hashing run in worker threads, so a large image does not block the event loop
+    async def store(self, attachment: discord.Attachment):
+        temp_path = os.path.join(self.path, f'.{attachment.id}.part')
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            file = await asyncio.to_thread(self.open_temp_file, temp_path)
+            try:
+                async with aiohttp.ClientSession() as http_session:
+                    async with http_session.get(attachment.url) as response:
+                        response.raise_for_status()
+                        async for chunk in response.content.iter_chunked(scoreboard_chunk_size):
+                            size += len(chunk)
+                            if size >= scoreboard_max_bytes:
+                                raise ValueError(f'image is larger than {scoreboard_max_bytes} bytes')
+                            await asyncio.to_thread(self.write_chunk, file, digest, chunk)
+            finally:
+                await asyncio.to_thread(file.close)
+            extension = os.path.splitext(attachment.filename)[1].lower() or '.png'
+            filename = f'{digest.hexdigest()}{extension}'
+            if await asyncio.to_thread(self.add_file, temp_path, filename):
+                self.num_stored += 1
+            else:
+                self.num_deduplicated += 1
+            return filename
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError, ValueError) as e:
+            log_msg(LogLevel.ERROR, f'Failed to store scoreboard image {attachment.filename}: {e}')
+            return None
+        finally:
+            await asyncio.to_thread(self.remove_temp_file, temp_path)
+
+    # creates the store folder and opens the file that an image is downloaded to, run in a worker thread
+    def open_temp_file(self, temp_path):
+        os.makedirs(self.path, exist_ok=True)
+        return open(temp_path, 'wb')
+
+    # writes a downloaded chunk of an image and adds it to the hash of its content, run in a worker thread
+    def write_chunk(self, file, digest, chunk):
+        digest.update(chunk)
+        file.write(chunk)
+
+    # moves a downloaded image into the store under its content name, returns False if it was already stored, run in a worker thread
+    def add_file(self, temp_path, filename):
+        if os.path.exists(self.file_path(filename)):
+            return False
+        os.replace(temp_path, self.file_path(filename))
+        return True
+
+    # removes the file of a download that failed or was already stored, run in a worker thread
+    def remove_temp_file(self, temp_path):
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    # makes a downscaled copy of a stored image once, returns the path of the file to show in discord
+    # run in a worker thread, decoding and resizing a large image would block the event loop
+    def make_preview(self, filename):
+        image_path = self.file_path(filename)
+        preview_path = self.file_path(filename, preview=True)
+        if Image is None:  # without Pillow, the full image is shown
+            return image_path
+        if os.path.exists(preview_path):
+            return preview_path
+        try:
+            with Image.open(image_path) as image:
+                if max(image.size) <= scoreboard_preview_size:
+                    return image_path
+                image_format = image.format
+                image.thumbnail((scoreboard_preview_size, scoreboard_preview_size))
+                os.makedirs(os.path.dirname(preview_path), exist_ok=True)
+                image.save(f'{preview_path}.part', format=image_format)
+            os.replace(f'{preview_path}.part', preview_path)
+            return preview_path
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            log_msg(LogLevel.WARNING, f'Failed to downscale scoreboard image {filename}: {e}')
+            return image_path
+
+scoreboard_store = ScoreboardStore(scoreboard_dir)
+
+class RatingEngine():  # Elo style player ratings, updated from the remaining wounds of each match result
+    def __init__(self):
+        self.ratings = {}  # dict of player ratings (user id, [rating, number of rated matches])
+
+    # gets the rating and number of rated matches of a player
+    def get(self, player_id):
+        rating, num_games = self.ratings.get(player_id, (rating_initial, 0))
+        return rating, num_games
+
+    # gets the position of a player when all rated players are ordered by rating
+    def rank(self, player_id):
+        rating, num_games = self.get(player_id)
+        return 1 + sum([1 for other_rating, other_games in self.ratings.values() if other_games and other_rating > rating])
+
+    # replaces all ratings with ones made from the total rating change and number of rated matches of each player
+    def load(self, totals):
+        self.ratings = {player_id: [rating_initial + total_change, num_games] for player_id, total_change, num_games in totals}
+
+    # gets the average rating of a team
+    def team_rating(self, player_ids):
+        return sum([self.get(player_id)[0] for player_id in player_ids]) / len(player_ids)
+
+    # applies a match result to the ratings of its players, returns the rating changes (user id, change)
+    def apply_result(self, team1_ids, team2_ids, wound_score):
+        if wound_score == 0 or not team1_ids or not team2_ids:  # no result
+            return {}
+        change = team1_rating_change(self.team_rating(team1_ids), self.team_rating(team2_ids), wound_score)
+        changes = {player_id: change for player_id in team1_ids}
+        changes.update({player_id: -change for player_id in team2_ids})
+        for player_id, player_change in changes.items():
+            rating = self.ratings.setdefault(player_id, [rating_initial, 0])
+            rating[0] += player_change
+            rating[1] += 1
+        return changes
+
+    # removes rating changes that were returned by apply_result, skipping players whose ratings were reset or recomputed since
+    def revert(self, changes):
+        for player_id, change in changes.items():
+            rating = self.ratings.get(player_id)
+            if not rating:
+                continue
+            rating[0] -= change
+            rating[1] -= 1
+
+player_ratings = RatingEngine()
+
+# gets the rating change for each player on team 1 from a match result, team 2 players get the negative of this
+def team1_rating_change(team1_rating, team2_rating, wound_score):
+    expected = 1 / (1 + 10 ** ((team2_rating - team1_rating) / 400))  # chance of team 1 winning
+    actual = 1.0 if wound_score > 0 else 0.0
+    weight = 1 + rating_wound_weight * (abs(wound_score) - 1)
+    return rating_k_factor * weight * (actual - expected)
+
+# gets the rating changes of each result (team1 ids, team2 ids, wound score) when applied in order starting from no ratings
+def replay_ratings(results):
+    rating_engine = RatingEngine()
+    return [rating_engine.apply_result(team1_ids, team2_ids, wound_score) for team1_ids, team2_ids, wound_score in results]
+
+# loads the saved ratings from the match history database
+async def load_ratings():
+    player_ratings.load(await asyncio.to_thread(match_history.rating_totals))
+    log_msg(LogLevel.INFO, 'Loaded ratings of %d players', len(player_ratings.ratings))
+
+# recomputes all ratings from the match history database, returns the number of match results used
+async def recompute_ratings():
+    match_changes = await asyncio.to_thread(match_history.recompute_rating_changes, replay_ratings)
+    totals = defaultdict(lambda: [0.0, 0])
+    for changes in match_changes.values():
+        for player_id, change in changes.items():
+            totals[player_id][0] += change
+            totals[player_id][1] += 1
+    player_ratings.load([(player_id, total_change, num_games) for player_id, (total_change, num_games) in totals.items()])
+    # matches still in memory may have their results changed later, so they need their new rating changes
+    for session in sessions.values():
+        for match in session.matches.values():
+            match.rating_changes = match_changes.get((session.channel_id, match.match_number), {})
+    return sum([1 for changes in match_changes.values() if changes])
+
+# gets a message with a user's most recent matches from the match history database
+async def match_history_msg(user, game_map=None):
+    rows = await asyncio.to_thread(match_history.player_matches, user.id, game_map.name if game_map else None, history_max_results)
+    map_str = f' on {game_map}' if game_map else ''
+    if not rows:
+        return f'No finished matches found for {get_display_name(user)}{map_str}.'
+    lines = [f'**Match history for {get_display_name(user)}{map_str}** (last {len(rows)})']
+    for row in rows:
+        lines.append(match_history_line(row))
+    return '\n'.join(lines)
+
+# gets a line describing a match from a match history row
+def match_history_line(row):
+    game_map = find_game_map(row['map'] or '')
+    map_str = str(game_map) if game_map else (row['map'] or 'Unknown map')
+    if row['wound_score'] == 0:
+        result_str = 'No result'
+    elif (row['wound_score'] > 0) == (row['team'] == 1):
+        result_str = f'Won {"❤️" * abs(row["wound_score"])}'
+    else:
+        result_str = f'Lost {"❤️" * abs(row["wound_score"])}'
+    length_str = ''
+    if row['start_time'] and row['end_time']:
+        length_str = f'{int(round((row["end_time"] - row["start_time"]) / 60))} min - '
+    return f'#{row["match_number"]} **{map_str}** - {result_str} - {length_str}<t:{row["end_time"]}:d>'
+
+# finds the map with a name that starts with the given text, ignoring case
+def find_game_map(name):
+    name = name.casefold()
+    if not name:
+        return None
+    for game_map in map_choices:
+        if game_map.name.casefold().startswith(name):
+            return game_map
+    return None
+
+# gets the commands to join each team of a server game
+def server_join_commands(address, port):
+    return f'`open {address}:{port}?team=0` (TEAM 1)', f'`open {address}:{port}?team=1` (TEAM 2)'
 
 # gets the code block of command help
 def command_help_block():
@@ -1493,374 +3733,441 @@ def is_user_admin(ctx):
 
 # Command to end the PUG system
 @bot.command(name='end_pug')
+@async_span
+@session_command
 async def end_pug_cmd(ctx):
-   log_async_start('end_pug_cmd')
-   global phase, waiting_room, matches, current_match, results_match, game_in_progress, queue_message
    if not is_user_admin(ctx):
        await ctx.send('You do not have permission to use this command.', ephemeral=True, delete_after=msg_fade1)
        return
-   if game_in_progress or queue_message:
-       log_msg(LogLevel.NONE, 'Ending PUGs')
-       try_save_pug() # save pug state to file
+   session = sessions.get(ctx.message.channel.id)
+   if session and (session.game_in_progress or session.queue_message):
+       log_msg(LogLevel.NONE, f'Ending PUGs in #{ctx.message.channel}')
+       session.try_save_pug(full=False) # save pug state to file, without the match so it is not resumed on restart
+       for match in (session.current_match, *session.active_matches.values()):
+           if match:
+               match.cancel_timers()
        # Reset the game state
-       reset_game()
-       phase = Phase.NONE
-       waiting_room = []
-       current_match = None
-       results_match = None
-       matches = {}
+       session.reset_game()
+       session.phase = Phase.NONE
+       session.waiting_room = OrderedUserSet()
+       session.current_match = None
+       session.results_match = None
+       session.active_matches = {}
+       session.matches = {}
+       server_pool.release_session(session)
+       session.player_activity = PlayerActivityIndex()
        await ctx.send('The current PUG session has been ended. You can start a new queue with `!start_pug`.')
    else:
        await ctx.send('No PUG session is currently active.')
-   log_async_end('end_pug_cmd')
 
 
 # Command to start the PUG system
 @bot.command(name='start_pug')
+@async_span
+@session_command
 async def start_pug_cmd(ctx):
-   log_async_start('start_pug_cmd')
-   global queue_channel_id, phase, queue, queue_message, game_in_progress
    if not is_user_admin(ctx):
        await ctx.send('You do not have permission to use this command.', ephemeral=True, delete_after=msg_fade1)
        return
-   if not game_in_progress and not queue_message:
-      log_msg(LogLevel.NONE, 'Starting PUGs')
-      phase = Phase.QUEUE
+   session = get_session(ctx.message.channel.id) # run the PUG in the channel that command was used
+   if not session.game_in_progress and not session.queue_message:
+      log_msg(LogLevel.NONE, f'Starting PUGs in #{ctx.message.channel}')
+      session.phase = Phase.QUEUE
       # load data if it exists
-      if os.path.isfile(save_file_path):
-         queue = []
+      if session.has_saved_pug():
+         session.queue = OrderedUserSet()
          try:
-            with open(save_file_path, 'r') as save_file:
-               load_pug(ctx.message.guild, save_file)
-            log_msg(LogLevel.NONE, f'PUG loaded on match #{match_number} with {total_queue_size()} players in queue')
+            session.restore_pug(ctx.message.guild)
+            await session.load_recent_activity()
+            log_msg(LogLevel.NONE, f'PUG loaded on match #{session.match_number} with {session.total_queue_size()} players in queue')
+            run_in_background(fetch_restored_members())
             #os.remove(save_file_path)
          except:
-            log_msg(LogLevel.ERROR, f'Failed to load saved PUG: {save_file_path}') 
-            queue = []
+            log_msg(LogLevel.ERROR, f'Failed to load saved PUG: {session.save_file_path}') 
+            session.queue = OrderedUserSet()
       
-      queue_channel_id = ctx.message.channel.id # save channel that command was used
       # send queue message
-      embed = queue_embed()
-      queue_message = await ctx.send(embed=embed, view=QueueView())
+      embed = session.queue_embed()
+      session.queue_message = await edit_scheduler.send(ctx, embed=embed, view=QueueView(session))
       # If we have the required number of players, move to ready check
-      await check_full_queue()
+      await session.check_full_queue()
    else:
        await ctx.send('A match is already in progress or the queue is active.')
-   log_async_end('start_pug_cmd')
-
-# Command to show the server join commands for anhur.servegame.com port 7777
-@bot.command(name='a7')
-async def a7_cmd(ctx):
-    log_async_start('a7_cmd')
-    await ctx.send(anhur_commands_msg(7777))
-    if current_match:
-        current_match.update_start_time()
-    log_async_end('a7_cmd')
-    
-# Command to show the server join commands for anhur.servegame.com port 7778
-@bot.command(name='a8')
-async def a8_cmd(ctx):
-    log_async_start('a8_cmd')
-    await ctx.send(anhur_commands_msg(7778))
-    if current_match:
-        current_match.update_start_time()
-    log_async_end('a8_cmd')
-
-# Command to show the server join commands for floof.servegame.com port 7777
-@bot.command(name='f7')
-async def f7_cmd(ctx):
-    log_async_start('f7_cmd')
-    await ctx.send(floof_commands_msg(7777))
-    if current_match:
-        current_match.update_start_time()
-    log_async_end('f7_cmd')
-    
-# Command to show the server join commands for floof.servegame.com port 7778
-@bot.command(name='f8')
-async def f8_cmd(ctx):
-    log_async_start('f8_cmd')
-    await ctx.send(floof_commands_msg(7778))
-    if current_match:
-        current_match.update_start_time()
-    log_async_end('f8_cmd')
-
-# Command to show the server join commands for syco.servegame.com port 7777
-@bot.command(name='s7')
-async def s7_cmd(ctx):
-    log_async_start('s7_cmd')
-    await ctx.send(syco_commands_msg(7777))
-    if current_match:
-        current_match.update_start_time()
-    log_async_end('s7_cmd')
-    
-# Command to show the server join commands for syco.servegame.com port 7778
-@bot.command(name='s8')
-async def s8_cmd(ctx):
-    log_async_start('s8_cmd')
-    await ctx.send(syco_commands_msg(7778))
-    if current_match:
-        current_match.update_start_time()
-    log_async_end('s8_cmd')
-    
-# Command to show the server join commands for syco.servegame.com port 7779
-@bot.command(name='s9')
-async def s9_cmd(ctx):
-    log_async_start('s9_cmd')
-    await ctx.send(syco_commands_msg(7779))
-    if current_match:
-        current_match.update_start_time()
-    log_async_end('s9_cmd')
-    
-# Command to show the server join commands for syco.servegame.com port 7780
-@bot.command(name='s0')
-async def s0_cmd(ctx):
-    log_async_start('s0_cmd')
-    await ctx.send(syco_commands_msg(7780))
-    if current_match:
-        current_match.update_start_time()
-    log_async_end('s0_cmd')
+
+# Command to show how many message edits have been merged
+@bot.command(name='edit_stats')
+@async_span
+async def edit_stats_cmd(ctx):
+    if not is_user_admin(ctx):
+       await ctx.send('You do not have permission to use this command.', ephemeral=True, delete_after=msg_fade1)
+       return
+    await ctx.send(f'Message edits: {edit_scheduler.stats_str()}.')
+
+# Command to show or change the log level
+@bot.command(name='log_level')
+@async_span
+async def log_level_cmd(ctx, level_name: str = ''):
+    global log_level
+    if not is_user_admin(ctx):
+       await ctx.send('You do not have permission to use this command.', ephemeral=True, delete_after=msg_fade1)
+       return
+    if level_name:
+        if level_name.upper() not in LogLevel.__members__:
+            await ctx.send(f'Unknown log level: {level_name}.  Log levels are: {", ".join(LogLevel.__members__)}.')
+            return
+        log_level = LogLevel[level_name.upper()]
+        log_msg(LogLevel.NONE, 'Log level set to %s by %s', log_level.name, ctx.message.author)
+    await ctx.send(f'Log level is {log_level.name}.')
+
+# makes the command to show the join commands of a game server, the match of the player is then played on the server if it is free
+def make_server_command(server):
+    async def server_cmd(ctx):
+        session = await get_command_session(ctx)
+        if not session:
+            return
+        match = session.played_match(ctx.message.author)
+        msg = session.server_commands_msg(server.address, server.port, match)
+        if server.up is False:
+            msg += f'\n⚠️ {server} did not accept a connection in the last check.'
+        if match:
+            match.update_start_time()
+            if match.phase == Phase.PLAY and match.server is not server:
+                if server.match:
+                    msg += f'\n⚠️ Match #{server.match.match_number} is being played on this server.'
+                else:
+                    server_pool.occupy(server, match)
+                    session.refresh_later(match.update_final_matchup)
+        await ctx.send(msg)
+    server_cmd.__name__ = server_cmd.__qualname__ = f'{server.name}_cmd'
+    return async_span(session_command(server_cmd))
+
+# Commands to show the server join commands for each game server
+for game_server in server_pool.servers.values():
+    bot.command(name=game_server.name)(make_server_command(game_server))
+
+# Command to show which game servers are up and which matches are being played on them
+@bot.command(name='servers')
+@async_span
+async def servers_cmd(ctx):
+    lines = []
+    for server in server_pool.servers.values():
+        match_str = f' - Match #{server.match.match_number}' if server.match else ''
+        lines.append(f'!{server.name} {server} - {server.status_str()}{match_str}')
+    await ctx.send('\n'.join(lines) or 'No game servers are configured.')
 
 # Command to set the custom server used for c7 and c8 commands
 @bot.command(name='custom_server')
+@async_span
+@session_command
 async def custom_server_cmd(ctx, address: str = ''):
-    log_async_start('custom_server_cmd')
-    global custom_server_address
-    custom_server_address = address
-    await ctx.send(f'Custom server address has been set to: {custom_server_address}')
-    log_async_end('custom_server_cmd')
+    session = await get_command_session(ctx)
+    if not session:
+        return
+    session.custom_server_address = address
+    await ctx.send(f'Custom server address has been set to: {session.custom_server_address}')
 
 # Command to show the server join commands for the custom server port 7777
 @bot.command(name='c7')
+@async_span
 async def c7_cmd(ctx):
-    log_async_start('c7_cmd')
-    await ctx.send(custom_server_commands_msg(7777))
-    if current_match:
-        current_match.update_start_time()
-    log_async_end('c7_cmd')
+    session = await get_command_session(ctx)
+    if not session:
+        return
+    match = session.played_match(ctx.message.author)
+    await ctx.send(session.custom_server_commands_msg(7777, match))
+    if match:
+        match.update_start_time()
     
 # Command to show the server join commands for the custom server port 7778
 @bot.command(name='c8')
+@async_span
 async def c8_cmd(ctx):
-    log_async_start('c8_cmd')
-    await ctx.send(custom_server_commands_msg(7778))
-    if current_match:
-        current_match.update_start_time()
-    log_async_end('c8_cmd')
+    session = await get_command_session(ctx)
+    if not session:
+        return
+    match = session.played_match(ctx.message.author)
+    await ctx.send(session.custom_server_commands_msg(7778, match))
+    if match:
+        match.update_start_time()
 
 # Command to manually add users to the queue
 @bot.command(name='queue_users')
+@async_span
+@session_command
 async def queue_users_cmd(ctx, members: commands.Greedy[discord.Member]):
-    log_async_start('queue_users_cmd')
     if not is_user_admin(ctx):
        await ctx.send('You do not have permission to use this command.', ephemeral=True, delete_after=msg_fade1)
        return
-    if queue_message:
+    session = await get_command_session(ctx)
+    if not session:
+        return
+    if session.queue_message:
         total_added = 0
         for member in members:
-            if len(queue) < queue_size_required:
-                if member not in queue:
-                    queue.append(member)
+            if len(session.queue) < queue_size_required:
+                if member not in session.queue:
+                    session.queue.append(member)
+                    session.journal_event('join', id=member.id, to='players')
                     total_added += 1
             else:
-                if member not in queue and member not in waiting_room:
-                    waiting_room.append(member)
+                if member not in session.queue and member not in session.waiting_room:
+                    session.waiting_room.append(member)
+                    session.journal_event('join', id=member.id, to='waiting')
                     total_added += 1
         await ctx.send(f'Added {total_added} players to queue.')
-        if phase >= Phase.PLAY:
-            await update_waiting_room_message()
+        if session.phase >= Phase.PLAY:
+            session.refresh_later(session.update_waiting_room_message)
         else:
-            await update_queue_message()
-        try_save_pug() # save state automatically
+            session.refresh_later(session.update_queue_message)
     else:
         await ctx.send('Cannot queue players, queue message not found.')
-    log_async_end('queue_users_cmd')
 
 # Command to set custom team 1
 @bot.command(name='ct1')
+@async_span
+@session_command
 async def ct1_cmd(ctx, members: commands.Greedy[discord.Member]):
-    log_async_start('ct1_cmd')
-    if not current_match:
+    session = await get_command_session(ctx)
+    if not session:
+        return
+    match = session.match_of_players(members)
+    if not match:
         await ctx.send('Cannot set custom teams until players are in a match.')
-        log_async_end('ct1_cmd')
         return
-    if current_match.phase > Phase.PLAY:
+    if match.phase > Phase.PLAY:
         await ctx.send('Cannot set custom teams once a match is complete.')
-        log_async_end('ct1_cmd')
         return
-    if current_match.phase == Phase.PLAY and current_match.selected_matchup != custom_teams_key:
+    if match.phase == Phase.PLAY and match.selected_matchup != custom_teams_key:
         await ctx.send('Cannot set custom teams once a non-custom matchup has won the vote.')
-        log_async_end('ct1_cmd')
         return
-    players_in_match = [p for p in members if p in current_match.players]
+    players_in_match = [p for p in members if p in match.players]
     if len(players_in_match) != team_size:
         await ctx.send(f'Must set a custom team of {team_size} players in the current match.')
-        log_async_end('ct1_cmd')
         return 
-    current_match.custom_team1 = list(players_in_match)
-    current_match.custom_team2 = list(set(current_match.players) - set(current_match.custom_team1))
-    await current_match.on_custom_teams_changed(ctx.message.channel)
-    custom_team1_names = ', '.join([get_display_name(user) for user in current_match.custom_team1])
-    custom_team2_names = ', '.join([get_display_name(user) for user in current_match.custom_team2])
+    match.custom_team1 = list(players_in_match)
+    match.custom_team2 = list(set(match.players) - set(match.custom_team1))
+    await match.on_custom_teams_changed(ctx.message.channel)
+    custom_team1_names = ', '.join([get_display_name(user) for user in match.custom_team1])
+    custom_team2_names = ', '.join([get_display_name(user) for user in match.custom_team2])
     await ctx.send(f'Custom Team 1 has been set to: {custom_team1_names}.\nCustom Team 2 has been set to: {custom_team2_names}.')
-    log_async_end('ct1_cmd')
 
 # Command to set custom team 2
 @bot.command(name='ct2')
+@async_span
+@session_command
 async def ct2_cmd(ctx, members: commands.Greedy[discord.Member]):
-    log_async_start('ct2_cmd')
-    if not current_match:
+    session = await get_command_session(ctx)
+    if not session:
+        return
+    match = session.match_of_players(members)
+    if not match:
         await ctx.send('Cannot set custom teams until players are in a match.')
-        log_async_end('ct2_cmd')
         return
-    if current_match.phase > Phase.PLAY:
+    if match.phase > Phase.PLAY:
         await ctx.send('Cannot set custom teams once a match is complete.')
-        log_async_end('ct2_cmd')
         return
-    if current_match.phase == Phase.PLAY and current_match.selected_matchup != custom_teams_key:
+    if match.phase == Phase.PLAY and match.selected_matchup != custom_teams_key:
         await ctx.send('Cannot set custom teams once a non-custom matchup has won the vote.')
-        log_async_end('ct2_cmd')
         return
-    players_in_match = [p for p in members if p in current_match.players]
+    players_in_match = [p for p in members if p in match.players]
     if len(players_in_match) != team_size:
         await ctx.send(f'Must set a custom team of {team_size} players in the current match.')
-        log_async_end('ct2_cmd')
         return 
-    current_match.custom_team2 = list(players_in_match)
-    current_match.custom_team1 = list(set(current_match.players) - set(current_match.custom_team2))
-    await current_match.on_custom_teams_changed(ctx.message.channel)
-    custom_team1_names = ', '.join([get_display_name(user) for user in current_match.custom_team1])
-    custom_team2_names = ', '.join([get_display_name(user) for user in current_match.custom_team2])
+    match.custom_team2 = list(players_in_match)
+    match.custom_team1 = list(set(match.players) - set(match.custom_team2))
+    await match.on_custom_teams_changed(ctx.message.channel)
+    custom_team1_names = ', '.join([get_display_name(user) for user in match.custom_team1])
+    custom_team2_names = ', '.join([get_display_name(user) for user in match.custom_team2])
     await ctx.send(f'Custom Team 1 has been set to: {custom_team1_names}.\nCustom Team 2 has been set to: {custom_team2_names}.')
-    log_async_end('ct2_cmd')
 
 # Command to trade two players on opposite teams
 @bot.command(name='trade')
+@async_span
+@session_command
 async def trade_cmd(ctx, members: commands.Greedy[discord.Member]):
-    log_async_start('trade_cmd')
-    if not current_match:
+    session = await get_command_session(ctx)
+    if not session:
+        return
+    match = session.match_of_players(members)
+    if not match:
         await ctx.send('Cannot trade players until players are in a match.')
-        log_async_end('trade_cmd')
         return
-    if current_match.phase <= Phase.MATCHUP:
+    if match.phase <= Phase.MATCHUP:
         await ctx.send('Cannot trade players until a final matchup has been set.')
-        log_async_end('trade_cmd')
         return
-    if current_match.phase > Phase.PLAY:
+    if match.phase > Phase.PLAY:
         await ctx.send('Cannot trade players once a match is complete.')
-        log_async_end('trade_cmd')
         return
     # find which players are on which team
-    team1_players = [p for p in members if p in current_match.final_team1]
-    team2_players = [p for p in members if p in current_match.final_team2]
+    team1_players = [p for p in members if p in match.final_team1]
+    team2_players = [p for p in members if p in match.final_team2]
     if len(team1_players) != 1 or len(team2_players) != 1:
         await ctx.send(f'Must trade two players on opposite teams.')
-        log_async_end('trade_cmd')
         return
     p1 = team1_players[0]
     p2 = team2_players[0]
     # perform trade
-    replace_list_item(current_match.final_team1, p1, p2)
-    replace_list_item(current_match.final_team2, p2, p1)
-    await current_match.on_final_teams_changed(ctx.message.channel)
+    replace_list_item(match.final_team1, p1, p2)
+    replace_list_item(match.final_team2, p2, p1)
+    await match.on_final_teams_changed(ctx.message.channel)
     await ctx.send(f'{get_display_name(p1)} has been traded to Team 2 and {get_display_name(p2)} has been traded to Team 1.')
-    log_async_end('trade_cmd')
 
 # Command to replace a player in the match with one not in the match
 @bot.command(name='fill')
+@async_span
+@session_command
 async def fill_cmd(ctx, members: commands.Greedy[discord.Member]):
-    log_async_start('fill_cmd')
-    if not current_match:
+    session = await get_command_session(ctx)
+    if not session:
+        return
+    match = session.match_of_players(members)
+    if not match:
         await ctx.send('Cannot fill for a player until players are in a match.')
-        log_async_end('fill_cmd')
         return
-    if current_match.phase > Phase.PLAY:
+    if match.phase > Phase.PLAY:
         await ctx.send('Cannot fill for a player once a match is complete.')
-        log_async_end('fill_cmd')
         return
     # find which players are in the match
-    in_players = [p for p in members if p in current_match.players]
-    out_players = [p for p in members if p not in current_match.players]
+    in_players = [p for p in members if p in match.players]
+    out_players = [p for p in members if p not in match.players]
     if len(in_players) != 1 or len(out_players) != 1:
         await ctx.send(f'Must fill a player in the match with one not in the match.')
-        log_async_end('fill_cmd')
         return
     p_in = in_players[0]  # player in match
     p_out = out_players[0]  # player not in match
-    await current_match.replace_player(p_in, p_out, ctx.message.channel)
-    if p_in in queue:
-        replace_list_item(queue, p_in, p_out)
-    if p_out in waiting_room:
-        waiting_room.remove(p_out)
+    await match.replace_player(p_in, p_out, ctx.message.channel)
+    if p_in in session.queue:
+        session.queue.replace(p_in, p_out)
+    if p_out in session.waiting_room:
+        session.waiting_room.remove(p_out)
     await ctx.send(f'{get_display_name(p_out)} is filling in for {get_display_name(p_in)}.')
-    if phase >= Phase.PLAY:
-        await update_waiting_room_message()
+    if session.phase >= Phase.PLAY:
+        session.refresh_later(session.update_waiting_room_message)
     else:
-        await update_queue_message()
-    try_save_pug() # save state automatically
-    log_async_end('fill_cmd')
+        session.refresh_later(session.update_queue_message)
+    session.journal_phase()  # record the replaced players
 
 # Command to set scoreboard
+# the image is downloaded, hashed and downscaled before running on the session actor, so clicks are not held up by it
 @bot.command(name='sb')
-async def sb_cmd(ctx, score_str: str = 'x'):
-    log_async_start('sb_cmd')
-    if not results_match:
-        await ctx.send('Cannot update scoreboard, no match is active.')
-        log_async_end('sb_cmd')
+@async_span
+async def sb_cmd(ctx, score_str: str = 'x', match_number: Optional[int] = None):
+    session = await get_command_session(ctx)
+    if not session:
+        return
+    match = session.played_match(ctx.message.author, match_number)  # checked again on the actor once the image is stored
+    if not match:
+        await ctx.send('Cannot update scoreboard, no match is active.' if match_number is None else f'Cannot update scoreboard, Match #{match_number} has not started.')
         return
     if not ctx.message.attachments:
         await ctx.send('No image attached, must attach an image of the scoreboard.')
-        log_async_end('sb_cmd')
         return
     if not ctx.message.attachments[0].content_type.startswith('image'):
         await ctx.send(f'Must attach an image, you attached a {ctx.message.attachments[0].content_type}.')
-        log_async_end('sb_cmd')
         return
     # check file size
-    size_mb = ctx.message.attachments[0].size / 1000000
-    if size_mb >= 10:
-        await ctx.send(f'Image must be less than 10 MB, you attached a {size_mb} MB image.')
-        log_async_end('sb_cmd')
+    if ctx.message.attachments[0].size >= scoreboard_max_bytes:
+        await ctx.send(f'Image must be less than {scoreboard_max_bytes / 1000000:g} MB, you attached a {ctx.message.attachments[0].size / 1000000} MB image.')
         return
     
-    # convert attached image to a file to attach to our own message
-    scoreboard_file = await ctx.message.attachments[0].to_file()
-    #sb_filename = f'sb/sb{results_match.match_number}.png'
-    #sb_saved = await ctx.message.attachments[0].save(sb_filename)
-    #scoreboard_file = discord.File(sb_filename)
-    await results_match.update_scoreboard(ctx, scoreboard_file)
-    #os.remove(sb_filename)  # delete scoreboard file
+    # stream the attached image to the scoreboard store, to attach it to our own message
+    scoreboard_filename = await scoreboard_store.store(ctx.message.attachments[0])
+    if not scoreboard_filename:
+        await ctx.send('Failed to save the scoreboard image, please try again.')
+        return
+    upload_path = await asyncio.to_thread(scoreboard_store.make_preview, scoreboard_filename)
+    try:
+        await session.run_action(set_scoreboard, ctx, session, match.match_number, scoreboard_filename, upload_path, score_str)
+    except SessionClosedError:  # the bot restarted while the image was downloading
+        await ctx.send(handing_off_msg)
+
+# Sets the scoreboard and wounds of a match from a stored image, run on the session actor
+async def set_scoreboard(ctx, session, match_number, scoreboard_filename, upload_path, score_str):
+    match = session.played_match(ctx.message.author, match_number)
+    if not match:  # the match ended and was forgotten while the image was downloading
+        await ctx.send(f'Cannot update scoreboard, Match #{match_number} is no longer active.')
+        return
+    await match.update_scoreboard(ctx, scoreboard_filename, upload_path)
     
     try:
         score = int(score_str)
     except ValueError:
-        log_async_end('sb_cmd')
         return
-    await results_match.update_wounds(ctx, score)
-    log_async_end('sb_cmd')
+    await match.update_wounds(ctx, score)
 
 # Alternate command for capital letters
 @bot.command(name='SB')
-async def sb_caps_cmd(ctx, score_str: str = 'x'):
-    log_async_start('sb_caps_cmd')
-    await sb_cmd(ctx, score_str)
-    log_async_end('sb_caps_cmd')
+@async_span
+async def sb_caps_cmd(ctx, score_str: str = 'x', match_number: Optional[int] = None):
+    await sb_cmd(ctx, score_str, match_number)
     
 # Command to set remaining wounds score
 @bot.command(name='wounds')
-async def wounds_cmd(ctx, score_str: str = 'x'):
-    log_async_start('wounds_cmd')
-    if not results_match:
-        await ctx.send('Cannot update wounds, no match is active.')
-        log_async_end('wounds_cmd')
+@async_span
+@session_command
+async def wounds_cmd(ctx, score_str: str = 'x', match_number: Optional[int] = None):
+    session = await get_command_session(ctx)
+    if not session:
+        return
+    match = session.played_match(ctx.message.author, match_number)
+    if not match:
+        await ctx.send('Cannot update wounds, no match is active.' if match_number is None else f'Cannot update wounds, Match #{match_number} has not started.')
         return
     try:
         score = int(score_str)
     except ValueError:
         await ctx.send(f'Unable to parse number of wounds from !wounds {score_str}.')
-        log_async_end('wounds_cmd')
         return
-    await results_match.update_wounds(ctx, score) 
-    log_async_end('wounds_cmd')
-
-# Run the bot
-bot.run(TOKEN)
\ No newline at end of file
+    await match.update_wounds(ctx, score)
+
+# Command to show the match history of a user
+@bot.command(name='history')
+@async_span
+async def history_cmd(ctx, member: Optional[discord.Member] = None, *, map_name: str = ''):
+    game_map = None
+    if map_name:
+        game_map = find_game_map(map_name)
+        if not game_map:
+            await ctx.send(f'Unknown map: {map_name}')
+            return
+    await ctx.send(await match_history_msg(member or ctx.message.author, game_map))
+
+# Command to show the rating of a user
+@bot.command(name='rating')
+@async_span
+async def rating_cmd(ctx, member: Optional[discord.Member] = None):
+    user = member or ctx.message.author
+    rating, num_games = player_ratings.get(user.id)
+    if num_games == 0:
+        await ctx.send(f'{get_display_name(user)} has no rated matches yet.')
+    else:
+        num_rated = sum([1 for other_rating, other_games in player_ratings.ratings.values() if other_games])
+        await ctx.send(f'{get_display_name(user)} has a rating of {round(rating)} from {num_games} matches'
+                       f' (#{player_ratings.rank(user.id)} of {num_rated} players).')
+
+# Command to recompute all ratings from the match history, used after changing the rating settings
+@bot.command(name='recompute_ratings')
+@async_span
+async def recompute_ratings_cmd(ctx):
+    if not is_user_admin(ctx):
+       await ctx.send('You do not have permission to use this command.', ephemeral=True, delete_after=msg_fade1)
+       return
+    start_time = datetime.now(timezone.utc)
+    try:
+        num_results = await recompute_ratings()
+    except sqlite3.Error as e:
+        log_msg(LogLevel.ERROR, f'Failed to recompute ratings: {e}')
+        await ctx.send('Failed to recompute ratings.')
+        return
+    seconds = (datetime.now(timezone.utc) - start_time).total_seconds()
+    await ctx.send(f'Recomputed ratings of {len(player_ratings.ratings)} players from {num_results} match results in {seconds:.2f} seconds.')
+
+# Run the bot, unless imported by another script such as loadgen.py
+if __name__ == '__main__':
+    start_logging(log_file_path)
+    bot.run(TOKEN)
+    for session in sessions.values():
+        session.pug_journal.close()  # finish writing any queued journal events
+    match_history.close()
+    member_directory.save(member_directory.current_names())
+    stop_logging()
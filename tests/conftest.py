@@ -0,0 +1,71 @@
+# Shared setup of the pugsbot tests, run with: python -m pytest tests
+# Each test gets its own folder for saved PUGs and the match history, and fresh copies of the bot's global services
+import os
+import sys
+import logging
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pugsbot
+from loadgen import RestRecorder, FakeMember, FakeChannel, FakeInteraction
+
+pugsbot.logger.addHandler(logging.NullHandler())
+
+@pytest.fixture(autouse=True)
+def fresh_bot(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # the timer service and edit scheduler hold asyncio objects that belong to the event loop of one test
+    monkeypatch.setattr(pugsbot, 'timers', pugsbot.TimerService())
+    monkeypatch.setattr(pugsbot, 'edit_scheduler', pugsbot.MessageEditScheduler(0))
+    monkeypatch.setattr(pugsbot, 'sessions', {})
+    monkeypatch.setattr(pugsbot, 'member_directory', pugsbot.MemberDirectory(pugsbot.display_names_file_path))
+    monkeypatch.setattr(pugsbot, 'match_history', pugsbot.MatchHistoryStore(pugsbot.history_db_path))
+    monkeypatch.setattr(pugsbot, 'player_ratings', pugsbot.RatingEngine())
+    monkeypatch.setattr(pugsbot, 'display_name_cache', {})
+    monkeypatch.setattr(pugsbot, 'sort_key_cache', {})
+    monkeypatch.setattr(pugsbot, 'input_state', pugsbot.InputState.ACCEPTING)
+    yield
+    pugsbot.match_history.close()
+    for session in pugsbot.sessions.values():
+        session.pug_journal.close()
+
+class FakeQueueChannel(FakeChannel):  # queue channel that keeps the messages it sent, so a resumed PUG can reattach to them
+    def __init__(self, channel_id, num_players):
+        super().__init__(RestRecorder(0), channel_id)
+        self.players = [FakeMember(self.rest, user_id) for user_id in range(1000, 1000 + num_players)]
+        self.guild.members = {player.id: player for player in self.players}
+        self.messages = {}  # dict of sent messages (message id, FakeMessage)
+
+    async def send(self, content=None, view=None, **kwargs):
+        message = await super().send(content, view, **kwargs)
+        self.messages[message.id] = message
+        return message
+
+    def get_partial_message(self, message_id):
+        return self.messages[message_id]
+
+@pytest.fixture
+def channel(monkeypatch):
+    channel = FakeQueueChannel(1, 30)
+    monkeypatch.setattr(pugsbot.bot, 'get_channel', lambda channel_id: channel)
+    return channel
+
+# clicks the button with a label on a message, as a player
+# clicks go to the view the bot registered for the message if there is one, like discord.py does for the views of resumed messages
+async def click(message, label, user):
+    view = pugsbot.bot._connection._view_store._synced_message_views.get(message.id, message.view)
+    for item in view.children:
+        if getattr(item, 'label', None) == label:
+            interaction = FakeInteraction(user, message)
+            if await view.interaction_check(interaction):
+                await item.callback(interaction)
+            return
+    raise KeyError(f'No {label} button on message')
+
+# starts the queue of a session and fills it with the first players of the channel, so the ready up starts
+async def fill_queue(session, channel):
+    session.phase = pugsbot.Phase.QUEUE
+    session.queue_message = await pugsbot.edit_scheduler.send(channel, embed=session.queue_embed(), view=pugsbot.QueueView(session))
+    for player in channel.players[:pugsbot.queue_size_required]:
+        await click(session.queue_message, 'Join Queue', player)
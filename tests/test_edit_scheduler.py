@@ -0,0 +1,71 @@
+# Tests of merging bursts of message edits into single edits, and of sending them in the responses to clicks
+import asyncio
+
+import pugsbot
+from loadgen import RestRecorder, FakeChannel, FakeInteraction
+
+class RecordedMessage():  # stand-in for discord.Message that keeps the edits sent to it
+    def __init__(self, message_id):
+        self.id = message_id
+        self.edits = []
+
+    async def edit(self, **kwargs):
+        self.edits.append(kwargs)
+
+class RecordedChannel():  # stand-in for discord.TextChannel that sends RecordedMessages
+    def __init__(self):
+        self.num_sent = 0
+
+    async def send(self, **kwargs):
+        self.num_sent += 1
+        return RecordedMessage(self.num_sent)
+
+def test_edits_in_a_window_are_merged():
+    async def run():
+        scheduler = pugsbot.MessageEditScheduler(0.05)
+        message = RecordedMessage(1)
+        scheduler.request_edit(message, content='one')
+        scheduler.request_edit(message, content='two', view=None)
+        scheduler.request_edit(message, content='three')
+        await asyncio.sleep(0.1)
+        assert message.edits == [{'content': 'three', 'view': None}]
+        assert (scheduler.num_sent, scheduler.num_saved) == (1, 2)
+    asyncio.run(run())
+
+def test_edits_that_change_nothing_are_dropped():
+    async def run():
+        scheduler = pugsbot.MessageEditScheduler(0)
+        message = await scheduler.send(RecordedChannel(), content='queue')
+        scheduler.request_edit(message, content='queue')
+        await scheduler.flush_all()
+        assert message.edits == [] and scheduler.num_unchanged == 1
+        scheduler.request_edit(message, content='queue', embed=None)
+        await scheduler.flush_all()
+        assert message.edits == [{'embed': None}]  # only the changed field is sent
+    asyncio.run(run())
+
+def test_pending_edit_is_sent_in_the_click_response():
+    async def run():
+        scheduler = pugsbot.MessageEditScheduler(10)
+        channel = FakeChannel(RestRecorder(0), 1)
+        message = await scheduler.send(channel, content='queue')
+        scheduler.request_edit(message, content='queue with a player')
+        await scheduler.edit_in_response(FakeInteraction(None, message), 'Joined')
+        await scheduler.flush_all()
+        assert channel.rest.counts == {'send_message': 1, 'interaction_response': 1}  # no edit of its own
+        assert scheduler.num_in_response == 1 and not scheduler.pending
+        await scheduler.edit_in_response(FakeInteraction(None, message), 'Joined')  # nothing to edit, so the msg is the response
+        assert channel.rest.counts['interaction_response'] == 2 and scheduler.num_in_response == 1
+    asyncio.run(run())
+
+def test_deferred_click_is_answered_with_edit_original_response():
+    async def run():
+        scheduler = pugsbot.MessageEditScheduler(10)
+        channel = FakeChannel(RestRecorder(0), 1)
+        message = await scheduler.send(channel, content='queue')
+        interaction = FakeInteraction(None, message)
+        pugsbot.defer_waiting_interaction(interaction, asyncio.get_running_loop().create_future())
+        scheduler.request_edit(message, content='queue with a player')
+        await scheduler.edit_in_response(interaction)
+        assert channel.rest.counts == {'send_message': 1, 'defer': 1, 'edit_original_response': 1}
+    asyncio.run(run())
@@ -0,0 +1,49 @@
+# Tests of handing a PUG session off to a new bot process: late state changes and the recent activity of players
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import pugsbot
+
+# saves an ended match of channel 1 straight to the match history, as the writer thread does
+def save_history_match(match_number, ended_ago, player_ids, wound_score, length=timedelta(minutes=30)):
+    end_time = datetime.now(timezone.utc) - ended_ago
+    pugsbot.match_history.save_match({
+        'channel_id': 1, 'match_number': match_number, 'map': None, 'wound_score': wound_score,
+        'start_time': pugsbot.datetime_to_int(end_time - length), 'end_time': pugsbot.datetime_to_int(end_time),
+        'team1_names': '', 'team2_names': '', 'scoreboard_filename': None,
+        'players': [(player_id, 1 + index % 2) for index, player_id in enumerate(player_ids)], 'rating_changes': []})
+
+def test_state_changes_after_close_are_rejected():
+    async def run():
+        session = pugsbot.PugSession(1)
+        applied = []
+        async def change(name):
+            applied.append(name)
+        # queued before the close, so applied, then queued behind it, so rejected
+        before = asyncio.create_task(session.run_action(change, 'before'))
+        closing = asyncio.create_task(session.run_action(session.close))
+        after = asyncio.create_task(session.run_action(change, 'after'))
+        await asyncio.gather(before, closing, after, return_exceptions=True)
+        assert applied == ['before']
+        assert isinstance(after.exception(), pugsbot.SessionClosedError)
+        with pytest.raises(pugsbot.SessionClosedError):
+            await session.run_action(change, 'late')
+        assert session.save_task is None  # a closed session never saves over the new bot process's files
+    asyncio.run(run())
+
+def test_recent_activity_is_loaded_from_match_history():
+    save_history_match(1, timedelta(minutes=40), [10, 11, 12, 13], wound_score=2)
+    save_history_match(2, timedelta(minutes=5), [10, 11], wound_score=-3, length=timedelta(minutes=20))
+    save_history_match(3, pugsbot.recent_time + timedelta(minutes=10), [10, 12], wound_score=1)  # too long ago
+    async def run():
+        session = pugsbot.PugSession(1)
+        await session.load_recent_activity()
+        return session.player_activity
+    activity = asyncio.run(run())
+    min_end_time = datetime.now(timezone.utc) - pugsbot.recent_time
+    user = pugsbot.SavedUser(10, 'player10', None)
+    assert activity.recent_totals(user, min_end_time) == (3000.0, 2, 4 + 3)
+    assert activity.recent_totals(pugsbot.SavedUser(12, 'player12', None), min_end_time) == (1800.0, 1, 4)
+    assert activity.recent_totals(pugsbot.SavedUser(99, 'player99', None), min_end_time) == (0.0, 0, 0)
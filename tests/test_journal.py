@@ -0,0 +1,143 @@
+# Tests of saving PUGs: the journal of queue changes, its replay on top of the save file, and when the full state is saved
+import io
+import json
+import random
+import asyncio
+import itertools
+
+import pugsbot
+from pugsbot import Phase
+from conftest import click, fill_queue
+
+# plays the ready up and the votes of a full queue until its match is being played, and returns the match
+async def start_match(session):
+    for player in list(session.queue):
+        await click(session.ready_message, 'Ready Up / Standby', player)
+    match = session.current_match
+    for player in itertools.cycle(match.players):
+        if match.phase != Phase.MAP:
+            break
+        await click(match.map_voting_message, str(pugsbot.map_choices[0]), player)
+    for player in itertools.cycle(match.players):
+        if match.phase != Phase.MATCHUP:
+            break
+        await click(match.voting_message, 'Matchup 1', player)
+    assert match.phase == Phase.PLAY
+    return match
+
+# starts the queue of a session without filling it, recording each full save of the session
+async def start_queue(channel):
+    session = pugsbot.get_session(channel.id)
+    session.phase = Phase.QUEUE
+    session.queue_message = await pugsbot.edit_scheduler.send(channel, embed=session.queue_embed(), view=pugsbot.QueueView(session))
+    session.try_save_pug()  # a new phase is saved soon, so start from a saved queue
+    saves = []
+    compact = session.pug_journal.compact
+    def record_compact(state):
+        saves.append(state)
+        compact(state)
+    session.pug_journal.compact = record_compact
+    return session, saves
+
+def test_clicks_are_saved_once_per_interval(channel, monkeypatch):
+    monkeypatch.setattr(pugsbot, 'pug_snapshot_delay', 0.01)
+    monkeypatch.setattr(pugsbot, 'pug_snapshot_interval', 0.3)
+    async def run():
+        session, saves = await start_queue(channel)
+        for player in channel.players[:3]:
+            await click(session.queue_message, 'Join Queue', player)
+        await asyncio.sleep(0.1)
+        assert saves == []  # the joins are in the journal until the interval is up
+        await asyncio.sleep(0.3)
+        assert len(saves) == 1
+        assert saves[0]['players'] == [player.id for player in channel.players[:3]]
+    asyncio.run(run())
+
+def test_phase_changes_are_saved_soon(channel, monkeypatch):
+    monkeypatch.setattr(pugsbot, 'pug_snapshot_delay', 0.01)
+    monkeypatch.setattr(pugsbot, 'pug_snapshot_interval', 60)
+    async def run():
+        session, saves = await start_queue(channel)
+        for player in channel.players[:pugsbot.queue_size_required]:
+            await click(session.queue_message, 'Join Queue', player)
+        await asyncio.sleep(0.1)
+        assert [state['session']['phase'] for state in saves] == [Phase.READY]
+        session.reset_game()
+    asyncio.run(run())
+
+def test_snapshot_is_written_by_the_journal_thread(channel):
+    async def run():
+        session = pugsbot.get_session(channel.id)
+        await fill_queue(session, channel)
+        assert session.try_save_pug()
+        session.pug_journal.close()  # waits for the write
+        with open(session.save_file_path) as save_file:
+            saved = json.load(save_file)
+        expected = io.StringIO()
+        session.save_pug(expected)
+        assert saved == json.loads(expected.getvalue())
+        assert saved['session']['phase'] == Phase.READY
+        session.reset_game()
+    asyncio.run(run())
+
+def test_journal_is_replayed_on_top_of_the_save_file():
+    save_file = io.StringIO(json.dumps({'version': pugsbot.pug_snapshot_version, 'match': 4, 'channel': 1, 'seq': 2,
+                                        'players': [10, 11], 'waiting': [12], 'requeue': [], 'session': {'phase': 1}}))
+    state = pugsbot.read_pug_state(save_file)
+    journal_file = io.StringIO(
+        '{"e": "join", "seq": 2, "id": 99, "to": "players"}\n'  # already in the save file
+        '{"e": "join", "seq": 3, "id": 13, "to": "waiting"}\n'
+        '{"e": "leave", "seq": 4, "id": 10, "section": "players"}\n'
+        '{"e": "result", "seq": 5, "match": 3, "wounds": 2, "end": 0}\n'
+        '{"e": "join", "seq": 6, "id": 14, "to": "req')  # cut off by a crash
+    pugsbot.replay_pug_journal(state, journal_file)
+    assert (state['seq'], state['players'], state['waiting']) == (5, [11], [12, 13])
+    assert state['session'] == {'phase': 1}  # no phase change, so the saved session can be resumed
+    pugsbot.replay_pug_journal(state, io.StringIO(
+        '{"e": "phase", "seq": 6, "match": 5, "channel": 1, "players": [12, 13], "waiting": [], "requeue": [11]}\n'))
+    assert (state['match'], state['players'], state['requeue']) == (5, [12, 13], [11])
+    assert state['session'] is None
+
+def test_old_save_files_are_read():
+    state = pugsbot.read_pug_state(io.StringIO('7\n10\n11\nwaiting\n12\n'))
+    assert (state['match'], state['players'], state['waiting'], state['seq']) == (7, [10, 11], [12], 0)
+
+def test_compaction_replaces_the_save_file_and_clears_the_journal(tmp_path):
+    journal = pugsbot.PugJournal(str(tmp_path / 'pug.json'), str(tmp_path / 'pug.journal'), 3)
+    assert not journal.record('join', id=10, to='players')
+    assert not journal.record('join', id=11, to='players')
+    assert journal.record('join', id=12, to='waiting')  # compact now
+    state = {'version': pugsbot.pug_snapshot_version, 'match': 1, 'channel': 1, 'seq': journal.seq,
+             'players': [10, 11], 'waiting': [12], 'requeue': []}
+    journal.compact(state)
+    journal.record('leave', id=11, section='players')
+    journal.close()
+    with open(tmp_path / 'pug.json') as save_file:
+        saved = pugsbot.read_pug_state(save_file)
+    assert saved == state
+    with open(tmp_path / 'pug.journal') as journal_file:
+        assert [json.loads(line)['seq'] for line in journal_file] == [4]  # only the event after the compaction is left
+    with open(tmp_path / 'pug.journal') as journal_file:
+        pugsbot.replay_pug_journal(saved, journal_file)
+    assert (saved['seq'], saved['players'], saved['waiting']) == (4, [10], [12])
+
+def test_saved_session_round_trips(channel):
+    random.seed(1)
+    async def run():
+        session = pugsbot.get_session(channel.id)
+        await fill_queue(session, channel)
+        match = await start_match(session)
+        await click(session.queue_message, 'Join Queue', channel.players[-1])  # the queue started again for the next match
+        await click(session.queue_message, 'Leave Queue', match.players[0])  # out of the re-queue
+        await pugsbot.edit_scheduler.flush_all()
+        saved = session.saved_state()
+        assert saved['session']['active_matches'] == [match.match_number]
+        assert len(saved['players']) == 1 and len(saved['requeue']) == pugsbot.queue_size_required - 1
+        pugsbot.member_directory.saved_names.update(pugsbot.display_name_cache)
+        resumed = pugsbot.PugSession(channel.id)
+        assert resumed.load_pug(channel.guild, io.StringIO(json.dumps(saved)), full=True)
+        assert json.loads(json.dumps(resumed.saved_state())) == json.loads(json.dumps(saved))
+        assert resumed.active_matches[match.match_number].players == match.players
+        session.reset_game()
+        resumed.reset_game()
+    asyncio.run(run())
@@ -0,0 +1,57 @@
+# Tests of the insertion-ordered user set that holds the queue, waiting room and re-queues
+import pytest
+
+import pugsbot
+from pugsbot import OrderedUserSet
+
+# gets stand-in users for user ids
+def users(*user_ids):
+    return [pugsbot.SavedUser(user_id, f'player{user_id}', None) for user_id in user_ids]
+
+# checks that the set holds exactly these user objects in this order, users with the same id compare equal
+def assert_users(user_set, expected):
+    assert [id(user) for user in user_set] == [id(user) for user in expected]
+
+def test_users_keep_their_order_and_are_added_once():
+    a, b, c = users(1, 2, 3)
+    user_set = OrderedUserSet([a, b])
+    assert user_set.append(c)
+    assert not user_set.append(pugsbot.SavedUser(1, 'renamed', None))  # same user id
+    user_set.extend([b, a])
+    assert_users(user_set, [a, b, c])
+    assert len(user_set) == 3
+    assert pugsbot.SavedUser(2, 'other', None) in user_set  # users are matched by id
+    assert user_set[0] is a and user_set[-1] is c
+    assert user_set[:2] == [a, b] and user_set[1:] == [b, c] and user_set[::2] == [a, c]
+
+def test_removed_users_leave_the_order_of_the_rest():
+    a, b, c, d = users(1, 2, 3, 4)
+    user_set = OrderedUserSet([a, b, c, d])
+    user_set.remove(b)
+    user_set.discard(b)  # already removed
+    with pytest.raises(ValueError):
+        user_set.remove(b)
+    assert_users(user_set, [a, c, d])
+    assert user_set.position(a) < user_set.position(c) < user_set.position(d)
+    user_set.append(b)  # added again at the end
+    assert_users(user_set, [a, c, d, b])
+    assert user_set.pop_front(2) == [a, c]
+    assert_users(user_set, [d, b])
+    assert a not in user_set
+    assert user_set.pop_front(5) == [d, b] and len(user_set) == 0
+
+def test_replace_keeps_the_position():
+    a, b, c = users(1, 2, 3)
+    user_set = OrderedUserSet([a, b, c])
+    member = pugsbot.SavedUser(2, 'member', None)  # the fetched member of a stand-in
+    user_set.replace(b, member)
+    assert_users(user_set, [a, member, c])
+    user_set.replace(a, c)  # a different user takes the position, and is not in the set twice
+    assert_users(user_set, [c, member])
+
+def test_sort_reorders_the_users():
+    a, b, c = users(3, 1, 2)
+    user_set = OrderedUserSet([a, b, c])
+    user_set.sort(key=lambda user: user.id)
+    assert_users(user_set, [b, c, a])
+    assert user_set.position(b) < user_set.position(c) < user_set.position(a)
@@ -0,0 +1,46 @@
+# Tests of the Elo style ratings that are updated from the remaining wounds of each match result
+import pytest
+
+import pugsbot
+
+def test_even_teams_gain_and_lose_by_the_wounds_left():
+    ratings = pugsbot.RatingEngine()
+    changes = ratings.apply_result([1, 2], [3, 4], 3)
+    change = pugsbot.rating_k_factor * (1 + 2 * pugsbot.rating_wound_weight) * 0.5
+    assert changes == {1: pytest.approx(change), 2: pytest.approx(change), 3: pytest.approx(-change), 4: pytest.approx(-change)}
+    assert ratings.get(1) == (pytest.approx(pugsbot.rating_initial + change), 1)
+    assert ratings.get(3) == (pytest.approx(pugsbot.rating_initial - change), 1)
+    assert ratings.get(5) == (pugsbot.rating_initial, 0)
+    assert ratings.rank(1) == 1 and ratings.rank(3) == 3
+
+def test_upsets_change_ratings_more():
+    ratings = pugsbot.RatingEngine()
+    ratings.load([(1, 200.0, 10), (2, -200.0, 10)])
+    expected_win = ratings.apply_result([1], [2], 1)[1]
+    ratings.load([(1, 200.0, 10), (2, -200.0, 10)])
+    upset = ratings.apply_result([1], [2], -1)[2]
+    assert 0 < expected_win < upset
+
+def test_no_result_changes_nothing():
+    ratings = pugsbot.RatingEngine()
+    assert ratings.apply_result([1], [2], 0) == {}
+    assert ratings.apply_result([], [2], 2) == {}
+    assert ratings.ratings == {}
+
+def test_revert_undoes_a_result():
+    ratings = pugsbot.RatingEngine()
+    ratings.apply_result([1, 2], [3, 4], 1)
+    changes = ratings.apply_result([1, 3], [2, 4], -2)
+    ratings.revert(changes)
+    assert ratings.get(1)[1] == 1 and ratings.get(3)[1] == 1
+    assert ratings.get(1)[0] == pytest.approx(ratings.get(2)[0])
+    ratings.ratings.pop(4)  # recomputed since the result was applied
+    ratings.revert({4: 10.0, 1: 0.0})
+    assert ratings.get(4) == (pugsbot.rating_initial, 0)
+
+def test_replay_applies_results_in_order():
+    results = [([1, 2], [3, 4], 2), ([1, 2], [3, 4], -1), ([2, 3], [1, 4], 3)]
+    ratings = pugsbot.RatingEngine()
+    expected = [ratings.apply_result(*result) for result in results]
+    assert pugsbot.replay_ratings(results) == expected
+    assert expected[1] != pugsbot.RatingEngine().apply_result(*results[1])  # depends on the earlier results
@@ -0,0 +1,82 @@
+# Tests of saving a PUG and resuming it in a new session, as happens after a restart or a handoff
+import io
+import asyncio
+
+import pugsbot
+from pugsbot import Phase
+from loadgen import FakeMember
+from conftest import click, fill_queue
+
+# saves the full state of a session and resumes it in a new session, with only stand-ins for players when no members are cached
+def resume(session, channel, cached_members=True):
+    save_file = io.StringIO()
+    session.save_pug(save_file)
+    pugsbot.member_directory.saved_names.update(pugsbot.display_name_cache)  # saved by the old process on shutdown
+    pugsbot.display_name_cache.clear()
+    pugsbot.sort_key_cache.clear()
+    members = channel.guild.members
+    if not cached_members:
+        channel.guild.members = {}
+    resumed = pugsbot.PugSession(session.channel_id)
+    assert resumed.load_pug(channel.guild, io.StringIO(save_file.getvalue()), full=True)
+    channel.guild.members = members
+    return resumed
+
+# starts a ready up with some players ready, waiting for the ready up DMs to be sent
+async def start_ready_up(channel):
+    session = pugsbot.get_session(channel.id)
+    await fill_queue(session, channel)
+    assert session.phase == Phase.READY
+    for player in list(session.queue)[:3]:
+        await click(session.ready_message, 'Ready Up / Standby', player)
+    await session.ready_dm_task
+    return session
+
+def test_resume_during_ready_check(channel):
+    async def run():
+        session = await start_ready_up(channel)
+        resumed = resume(session, channel, cached_members=False)
+        assert resumed.phase == Phase.READY
+        assert [user.id for user in resumed.queue_sorted] == [user.id for user in session.queue_sorted]
+        embed = resumed.ready_up_embed()
+        assert embed.fields[0].name == f'Match Players (3/{pugsbot.queue_size_required})'
+        assert len(embed.fields[0].value.splitlines()) == pugsbot.queue_size_required
+        assert resumed.dm_results_str().endswith(f'{pugsbot.queue_size_required}/{pugsbot.queue_size_required}')
+        resumed.reset_game()
+    asyncio.run(run())
+
+def test_resumed_stand_ins_are_replaced_by_members(channel):
+    async def run():
+        session = await start_ready_up(channel)
+        resumed = resume(session, channel, cached_members=False)
+        assert len(resumed.queue_sorted) == pugsbot.queue_size_required
+        assert all(isinstance(user, pugsbot.SavedUser) for user in resumed.queue_sorted)
+        await resumed.replace_saved_users(channel.guild.members)
+        assert all(user is channel.guild.members[user.id] for user in resumed.queue_sorted)
+        assert all(user is channel.guild.members[user.id] for user in resumed.queue)
+        resumed.reset_game()
+    asyncio.run(run())
+
+def test_ready_click_after_resume(channel):
+    async def run():
+        session = await start_ready_up(channel)
+        resumed = resume(session, channel)
+        pugsbot.sessions[channel.id] = resumed
+        not_ready = [user for user in resumed.queue if user not in resumed.ready_players]
+        await click(resumed.ready_message, 'Ready Up / Standby', not_ready[0])
+        assert len(resumed.ready_players) == 4
+        resumed.reset_game()
+    asyncio.run(run())
+
+def test_clicks_refresh_changed_names(channel):
+    async def run():
+        session = await start_ready_up(channel)
+        player = list(session.queue)[5]
+        assert pugsbot.get_display_name(player) == player.name
+        renamed = FakeMember(channel.rest, player.id)  # the member of a later click, after a nickname change without an update event
+        renamed.nick = 'Renamed'
+        await click(session.ready_message, 'Ready Up / Standby', renamed)
+        assert pugsbot.get_display_name(player) == 'Renamed'
+        assert 'Renamed' in session.ready_up_embed().fields[0].value
+        session.reset_game()
+    asyncio.run(run())
@@ -0,0 +1,92 @@
+# Tests of storing scoreboard images and attaching them to the final matchup message
+import os
+import asyncio
+import hashlib
+
+from aiohttp import web
+
+import pugsbot
+
+image_data = b'\x89PNG\r\n\x1a\n' + bytes(range(256)) * 1000  # not a real image, the store only hashes and copies it
+
+class StubAttachment():  # stand-in for discord.Attachment
+    def __init__(self, attachment_id, url, filename='Scoreboard.PNG'):
+        self.id = attachment_id
+        self.url = url
+        self.filename = filename
+
+class EditedMessage():  # stand-in for discord.Message that keeps the edits sent to it
+    def __init__(self, message_id):
+        self.id = message_id
+        self.edits = []
+
+    async def edit(self, **kwargs):
+        self.edits.append(kwargs)
+        for attachment in kwargs.get('attachments', []):
+            attachment.fp.read()  # sent, discord.py closes the files after this
+
+# serves the image, a missing image and a large image from a local stub server, then runs a test against it
+def with_image_server(test):
+    async def run():
+        async def image(request):
+            return web.Response(body=image_data, content_type='image/png')
+        async def missing(request):
+            return web.Response(status=404)
+        async def large(request):
+            return web.Response(body=bytes(pugsbot.scoreboard_max_bytes), content_type='image/png')
+        app = web.Application()
+        app.router.add_get('/sb.png', image)
+        app.router.add_get('/missing.png', missing)
+        app.router.add_get('/large.png', large)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        try:
+            await test(f'http://127.0.0.1:{port}')
+        finally:
+            await runner.cleanup()
+    asyncio.run(run())
+
+def test_store_names_images_by_content():
+    async def test(url):
+        store = pugsbot.ScoreboardStore('scoreboards')
+        filename = await store.store(StubAttachment(1, f'{url}/sb.png'))
+        assert filename == f'{hashlib.sha256(image_data).hexdigest()}.png'
+        with open(store.file_path(filename), 'rb') as file:
+            assert file.read() == image_data
+        assert await store.store(StubAttachment(2, f'{url}/sb.png', 'other.png')) == filename
+        assert (store.num_stored, store.num_deduplicated) == (1, 1)
+        assert os.listdir('scoreboards') == [filename]  # no temporary files are left
+    with_image_server(test)
+
+def test_store_rejects_missing_and_large_images():
+    async def test(url):
+        store = pugsbot.ScoreboardStore('scoreboards')
+        assert await store.store(StubAttachment(1, f'{url}/missing.png')) is None
+        assert await store.store(StubAttachment(2, f'{url}/large.png')) is None
+        assert os.listdir('scoreboards') == []
+    with_image_server(test)
+
+def test_merged_and_dropped_attachments_leave_no_open_files(tmp_path):
+    paths = []
+    for name in ('first.png', 'second.png'):
+        paths.append(tmp_path / name)
+        paths[-1].write_bytes(image_data)
+    async def run():
+        scheduler = pugsbot.MessageEditScheduler(0.01)
+        message = EditedMessage(1)
+        scheduler.request_edit(message, attachments=[pugsbot.AttachmentFile(str(paths[0]), 'first.png')])
+        scheduler.request_edit(message, attachments=[pugsbot.AttachmentFile(str(paths[1]), 'second.png')])  # merged, the first is never opened
+        await scheduler.flush_all()
+        [edit] = message.edits
+        [file] = edit['attachments']
+        assert file.filename == 'second.png'
+        assert file.fp.closed
+        dropped = EditedMessage(2)
+        scheduler.request_edit(dropped, attachments=[pugsbot.AttachmentFile(str(paths[0]), 'first.png')])
+        scheduler.cancel(dropped)
+        await scheduler.flush_all()
+        assert dropped.edits == []
+    asyncio.run(run())
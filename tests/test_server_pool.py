@@ -0,0 +1,91 @@
+# Tests of probing game servers and assigning them to matches, against stub listeners on localhost
+# Usage: python -m unittest discover tests
+import os
+import sys
+import asyncio
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pugsbot
+
+class StubMatch():  # stand-in for PugMatch, with only what the server pool uses
+    def __init__(self, match_number, session=None):
+        self.match_number = match_number
+        self.session = session
+        self.server = None
+
+class ServerPoolTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.listeners = [await asyncio.start_server(self.accept, '127.0.0.1', 0) for _ in range(2)]
+        self.up_ports = [listener.sockets[0].getsockname()[1] for listener in self.listeners]
+        closed = await asyncio.start_server(self.accept, '127.0.0.1', 0)  # a port that nothing listens on once closed
+        self.down_port = closed.sockets[0].getsockname()[1]
+        closed.close()
+        await closed.wait_closed()
+
+    async def asyncTearDown(self):
+        for listener in self.listeners:
+            listener.close()
+            await listener.wait_closed()
+
+    # accepts a probe connection and closes it, like a web admin port would after a request
+    async def accept(self, reader, writer):
+        writer.close()
+
+    async def test_probe_marks_servers_up_and_down(self):
+        pool = pugsbot.ServerPool([('up', '127.0.0.1', 7777, self.up_ports[0]),
+                                   ('down', '127.0.0.1', 7777, self.down_port),
+                                   ('unchecked', '127.0.0.1', 7777, None)])
+        await pool.probe_all()
+        self.assertIs(pool.servers['up'].up, True)
+        self.assertIsNotNone(pool.servers['up'].latency)
+        self.assertIs(pool.servers['down'].up, False)
+        self.assertIsNone(pool.servers['unchecked'].up)
+        self.assertEqual(pool.servers['unchecked'].status_str(), 'not checked')
+
+    async def test_assign_prefers_probed_servers_that_are_up(self):
+        pool = pugsbot.ServerPool([('unchecked', '127.0.0.1', 7777, None),
+                                   ('down', '127.0.0.1', 7778, self.down_port),
+                                   ('up1', '127.0.0.1', 7779, self.up_ports[0]),
+                                   ('up2', '127.0.0.1', 7780, self.up_ports[1])])
+        await pool.probe_all()
+        matches = [StubMatch(match_number) for match_number in range(1, 5)]
+        assigned = [pool.assign(match) for match in matches]
+        self.assertEqual({assigned[0].name, assigned[1].name}, {'up1', 'up2'})  # lowest latency first
+        self.assertEqual(assigned[2].name, 'unchecked')  # then servers that are not probed, which are assumed to be up
+        self.assertIsNone(assigned[3])  # the server that is down is never assigned
+        for match, server in zip(matches, assigned[:3]):
+            self.assertIs(match.server, server)
+            self.assertIs(server.match, match)
+
+    async def test_released_server_is_assigned_again(self):
+        pool = pugsbot.ServerPool([('up', '127.0.0.1', 7777, self.up_ports[0])])
+        await pool.probe_all()
+        first, second = StubMatch(1), StubMatch(2)
+        server = pool.assign(first)
+        self.assertIsNone(pool.assign(second))
+        pool.release(first)
+        self.assertIs(first.server, server)  # the match keeps showing where it was played
+        self.assertIs(pool.assign(second), server)
+
+    async def test_server_that_goes_down_is_not_assigned(self):
+        pool = pugsbot.ServerPool([('up', '127.0.0.1', 7777, self.up_ports[0])])
+        await pool.probe_all()
+        self.listeners[0].close()
+        await self.listeners[0].wait_closed()
+        await pool.probe_all()
+        self.assertIs(pool.servers['up'].up, False)
+        self.assertIsNone(pool.assign(StubMatch(1)))
+
+    async def test_release_session(self):
+        pool = pugsbot.ServerPool([('unchecked1', '127.0.0.1', 7777, None), ('unchecked2', '127.0.0.1', 7778, None)])
+        session, other_session = object(), object()
+        pool.assign(StubMatch(1, session))
+        kept = pool.assign(StubMatch(2, other_session))
+        pool.release_session(session)
+        self.assertIsNone(pool.servers['unchecked1'].match)
+        self.assertIs(pool.servers['unchecked2'], kept)
+        self.assertIsNotNone(kept.match)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+# Tests of ranking the ways to split the match players into two teams, used to pick the matchup choices
+import math
+import random
+
+import pugsbot
+
+def test_each_rank_is_a_different_even_split():
+    for num_players in (2, 4, 8, 12):
+        num_splits = pugsbot.num_team_splits(num_players)
+        assert num_splits == math.comb(num_players, num_players // 2) // 2  # swapping the teams is the same split
+        masks = [pugsbot.team_split_mask(num_players, rank) for rank in range(num_splits)]
+        assert len(set(masks)) == num_splits
+        for mask in masks:
+            assert mask & 1  # the first player's team
+            assert bin(mask).count('1') == num_players // 2
+            assert mask < 1 << num_players
+
+def test_ranks_are_in_order():
+    # the first player's teammates are picked from the lowest indexes first
+    assert [pugsbot.team_split_mask(4, rank) for rank in range(3)] == [0b0011, 0b0101, 0b1001]
+
+def test_random_splits_skip_excluded_splits():
+    random.seed(1)
+    num_players = 8
+    excluded = {pugsbot.team_split_mask(num_players, rank) for rank in range(30)}  # 30 of the 35 splits
+    splits = pugsbot.random_team_splits(num_players, 3, excluded)
+    assert len(splits) == 3 and len(set(splits)) == 3
+    assert not excluded & set(splits)
+    remaining = pugsbot.random_team_splits(num_players, 10, excluded)  # only 5 splits are left
+    assert sorted(remaining) == sorted([pugsbot.team_split_mask(num_players, rank) for rank in range(30, 35)])
@@ -0,0 +1,43 @@
+# Tests of the timer service that runs the deadlines of ready checks, votes and matches from one background task
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pugsbot
+
+def test_deadlines_fire_in_order_once():
+    fired = []
+    async def fire(key):
+        fired.append(key)
+    async def run():
+        now = datetime.now(timezone.utc)
+        timers = pugsbot.timers
+        timers.arm('late', now + timedelta(seconds=0.15), fire, 'late')
+        timers.arm('early', now + timedelta(seconds=0.05), fire, 'early')
+        timers.arm('past', now - timedelta(seconds=1), fire, 'past')
+        await asyncio.sleep(0.1)
+        assert fired == ['past', 'early']
+        assert timers.deadline('early') is None and timers.deadline('late') is not None
+        await asyncio.sleep(0.1)
+        assert fired == ['past', 'early', 'late']
+    asyncio.run(run())
+
+def test_cancelled_and_moved_deadlines():
+    fired = []
+    async def fire(key):
+        fired.append(key)
+    async def run():
+        now = datetime.now(timezone.utc)
+        timers = pugsbot.timers
+        timers.arm('cancelled', now + timedelta(seconds=0.05), fire, 'cancelled')
+        timers.arm('moved', now + timedelta(seconds=0.05), fire, 'moved')
+        timers.arm('sooner', now + timedelta(seconds=10), fire, 'sooner')
+        timers.cancel('cancelled')
+        timers.arm('moved', now + timedelta(seconds=0.15), fire, 'moved')  # replaces the earlier deadline of the key
+        timers.arm('sooner', now + timedelta(seconds=0.02), fire, 'sooner')  # wakes the waiting task up early
+        assert timers.deadline('cancelled') is None
+        assert timers.deadline('moved') == now + timedelta(seconds=0.15)
+        await asyncio.sleep(0.1)
+        assert fired == ['sooner']
+        await asyncio.sleep(0.1)
+        assert fired == ['sooner', 'moved']
+    asyncio.run(run())